@@ -54,6 +54,7 @@ function help() {
     echo "###   ${bold}--flexpart${normal}       Activate FLEXPART simulation"
     echo "###   ${bold}--softio${normal}         Activate SOFT-io computations"
     echo "###   ${bold}--footprints${normal}     Activate creation of the footprint image"
+    echo "###   ${bold}--multi-release${normal}  Simulate all release heights of the station in one FLEXPART run (with --flexpart)"
     echo "###"
     echo "### Arguments:"
     echo "###   ${bold}-n        station_name_code${normal}   ID code (short_name) of one of the stations from your configuration file"                                   
@@ -67,9 +68,22 @@ function help() {
     echo "###    ROOT_WDIR=\"/path/to/root/working/folder/for/subfolders\""
     echo "###    FLEXPART_OUT_DIR=\"/path/to/folder/for/flexpart/output\""
     echo "###    SOFTIO_OUT_DIR=\"/path/to/folder/for/softio/output\""
-    echo "###    SOFTIO_DATABASE=\"/path/to/output/softio/database.nc\""
+    echo "###    SOFTIO_DATABASE=\"/path/to/output/softio/database.zarr\""
     echo "###    FOOTPRINTS_DATABASE=\"/path/to/output/footprints/images/database.zarr\""
     echo "###    STATIONS_CONF=\"/path/to/file/with/stations/configuration.json\""
+    echo "###    FLEXPART_CACHE_DIR=\"/path/to/shared/folder/with/compiled/flexpart/executables\"   (optional)"
+    echo "###    FOOTPRINTS_STAGING_DIR=\"/path/to/folder/with/pending/footprints\"   (optional)"
+    echo "###    FPOUT_CACHE_DIR=\"/path/to/shared/folder/with/regridded/pixel/areas\"   (optional)"
+    echo "###    ENFILES_STAGING_DIR=\"/path/to/node-local/folder/where/to/stage/ECMWF/files\"   (optional)"
+    echo "###    ENFILES_STAGING_MAX_SIZE=200   (optional, maximum size of the staged ECMWF files in GB)"
+    echo "###    FOOTPRINTS_WORKERS=\"number of processes computing footprints\"   (optional, default 1)"
+    echo "###    FLEXPART_RELEASE_PARTS=100000   (optional, number of particles per release of the stations without release_parts)"
+    echo "###    FLEXPART_OUTPUT_PROFILE=\"full\"   (optional, full, softio or footprint-only: FLEXPART outputs are compacted,"
+    echo "###                                     summed over height for footprint-only; default full)"
+    echo "###    SOFTIO_INVENTORIES=\"gfas ceds2\"   (optional, emission inventories of SOFT-io, default gfas ceds2)"
+    echo "###    SOFTIO_WORKERS=\"number of processes applying SOFT-io\"   (optional, default 1)"
+    echo "###    PROVENANCE_LEDGER=\"/path/to/provenance/ledger.jsonl\"   (optional, SOFT-io and footprints already computed from the same"
+    echo "###                                     FLEXPART outputs are skipped)"
     echo "###"
     echo "### Stations configuration file is a JSON file with syntaxe as follows :"
     echo "###    ["
@@ -79,7 +93,10 @@ function help() {
     echo "###           \"longitude\":2.964886,"
     echo "###           \"latitude\":45.772223,"
     echo "###           \"altitude\":1465,"
-    echo "###           \"release_heights\":\"500 1500\""
+    echo "###           \"release_heights\":\"500 1500\","
+    echo "###           \"release_parts\":50000,   (optional, number of particles per release)"
+    echo "###           \"outgrid\":{\"lon_min\":-40,\"lon_max\":60,\"lat_min\":10,\"lat_max\":80},   (optional, regional output grid)"
+    echo "###           \"outgrid_nest\":{\"lon_min\":-5,\"lon_max\":10,\"lat_min\":40,\"lat_max\":50,\"resolution\":0.25}   (optional)"
     echo "###       },"
     echo "###       {...},"
     echo "###       {...}"
@@ -135,20 +152,8 @@ function check_args(){
 }
 
 function check_station_id(){
-    ids=($(cat ${STATIONS_CONF} | jq '.[].short_name'))
-    index=-1
-    for ii in "${!ids[@]}"; do
-        ids[${ii}]=${ids[${ii}]//\"/""}
-        if [[ "${ids[${ii}]}" == "${STATION_CODE}" ]]; then
-            index=${ii}
-            break
-        fi
-    done
-    if [ "${index}" == -1 ]; then
-        return 1
-    else
-        return 0
-    fi
+    # Station variables are read once from the stations registry, get_station_info sets them
+    station_info=$(python3 ${SRC_DIR}/stations.py -c ${STATIONS_CONF} shell ${STATION_CODE})
 }
 
 function check_config(){
@@ -206,6 +211,21 @@ function check_config(){
         mkdir -p ${FLEXPART_OUT_DIR}
     fi
 
+    if [ ! -z ${FOOTPRINTS_STAGING_DIR} ] && [ ! -d ${FOOTPRINTS_STAGING_DIR} ]; then
+        info "Creating ${FOOTPRINTS_STAGING_DIR} as FOOTPRINTS_STAGING_DIR..."
+        mkdir -p ${FOOTPRINTS_STAGING_DIR}
+    fi
+
+    if [ ! -z ${FPOUT_CACHE_DIR} ] && [ ! -d ${FPOUT_CACHE_DIR} ]; then
+        info "Creating ${FPOUT_CACHE_DIR} as FPOUT_CACHE_DIR..."
+        mkdir -p ${FPOUT_CACHE_DIR}
+    fi
+
+    if [ ! -z ${FLEXPART_CACHE_DIR} ] && [ ! -d ${FLEXPART_CACHE_DIR} ]; then
+        info "Creating ${FLEXPART_CACHE_DIR} as FLEXPART_CACHE_DIR..."
+        mkdir -p ${FLEXPART_CACHE_DIR}
+    fi
+
     if [ ! -d ${SOFTIO_OUT_DIR} ]; then
         warning "SOFTIO_OUT_DIR does not exist, it will be created if permissions allow it"
         info "Creating ${SOFTIO_OUT_DIR} as SOFTIO_OUT_DIR..."
@@ -217,47 +237,61 @@ function check_config(){
     if [ ${SOFTIO_FLAG} == 1 ]; then
         info "Directory for SOFT-io output  : ${SOFTIO_OUT_DIR}"
         info "SOFT-io database              : ${SOFTIO_DATABASE}"
+        if [ "${FLEXPART_OUTPUT_PROFILE}" == "footprint-only" ]; then
+            warning "FLEXPART outputs of the footprint-only profile are summed over height, SOFT-io needs the softio or full profile"
+        fi
     fi
     if [ ${FOOTPRINTS_FLAG} == 1 ]; then info "Footprints image database     : ${FOOTPRINTS_DATABASE}"; fi
 }
 
-function perform_flexpart_simulation(){
+function write_release_node(){
+    # Prints a <release> node of the simulation configuration file
+    #   $1 : release name (FLEXPART release comment, names the per-release output in the multi-release mode)
+    #   $2 : release altitude
+    cat <<EOF
+                <release name='${1}'>
+                    <start_date>${release_start_date}</start_date>
+                    <start_time>${release_start_time}</start_time>
+                    <duration>00000000</duration>
+                    <altitude_min>${2}</altitude_min>
+                    <altitude_max>$((${2} + 50))</altitude_max>
+                    <parts>${_station_parts:-${FLEXPART_RELEASE_PARTS:-100000}}</parts>
+                    <zones>
+                        <zone name='${_station_name}'>
+                            <latmin>${lat_min}</latmin>
+                            <latmax>${lat_max}</latmax>
+                            <lonmin>${lon_min}</lonmin>
+                            <lonmax>${lon_max}</lonmax>
+                        </zone>
+                    </zones>
+                </release>
+EOF
+}
 
-    echo "+---------------------------------------------------------------------------------------------------------------------------+"
-    echo "|     ⣄⠇⠁       ⠠⠎  ⠈⠑⣄                       ⢀ ⣴⠋                                                                          |"
-    echo "|    ⠂⠋               ⠠⠟⠕⠦⡀                ⠤⢆⡋⠰⠸⠗                                                                           |"
-    echo "|   ⡁                    ⢡⠇               ⢼⣱⠁    ⢀⢠⠏⠒                                                                       |"
-    echo "|   ⠁⠐⠐⠄    ⢀         ⣀⡀⠖⠛            ⠠⠰⠺⡁⡛⠁    ⣜       ███████╗██╗     ███████╗██╗  ██╗██████╗  █████╗ ██████╗ ████████╗   |"
-    echo "|      ⠙⠁⠄⠆⡸⠓⡆⠠  ⢀⡞⠤⠠⠐⠁           ⣀⠐⡷⡾⡃⠉     ⢠⠰⠰⢇⠨⠦⡵    ██╔════╝██║     ██╔════╝╚██╗██╔╝██╔══██╗██╔══██╗██╔══██╗╚══██╔══╝   |"
-    echo "|             ⠈⠉ ⠁              ⣴⠋⠉ ⠉⠟    ⣄⡃⠉      ⠁    █████╗  ██║     █████╗   ╚███╔╝ ██████╔╝███████║██████╔╝   ██║      |"
-    echo "|      ⡀ ⡀⡀                   ⠠⢅⠃        ⣠⠃             ██╔══╝  ██║     ██╔══╝   ██╔██╗ ██╔═══╝ ██╔══██║██╔══██╗   ██║      |"
-    echo "|   ⡀⡵⠁⠁⠉⠘⠁⢢⣰ ⠄                ⠽⣯⡀                      ██║     ███████╗███████╗██╔╝ ██╗██║     ██║  ██║██║  ██║   ██║      |"
-    echo "|   ⠁        ⠉⣥⡕⢀ ⡀⢀            ⠪⡯                      ╚═╝     ╚══════╝╚══════╝╚═╝  ╚═╝╚═╝     ╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝      |"
-    echo "|              ⠊⡟⠭⠊⠊⠉⠓⠥⠰⡀       ⠐⡅                                                                                          |"
-    echo "|   ⡄⡀                 ⠉⢯⠄  ⡀    ⠉⣦⠄⠠⠠⠠⠂                                                                                    |"
-    echo "|   ⠉⠋⠻⢖⣤⢥⡦⣤⠷⣀⢄⡀      ⣰⡽⠃⠈⠁⠙⠁⣅⡠      ⠁⠈                                                                                     |"
-    echo "+---------------------------------------------------------------------------------------------------------------------------+"
+function write_outgrid_nest_node(){
+    # Prints the <outGridNest> node of the simulation configuration file, if the station has a nested output grid
+    if [ -z "${_outgrid_nest_resolution}" ]; then return; fi
+    cat <<EOF
+            <outGridNest>
+                <longitude>
+                    <min>${_outgrid_nest_lon_min}</min>
+                    <max>${_outgrid_nest_lon_max}</max>
+                </longitude>
+                <latitude>
+                    <min>${_outgrid_nest_lat_min}</min>
+                    <max>${_outgrid_nest_lat_max}</max>
+                </latitude>
+                <resolution>${_outgrid_nest_resolution}</resolution>
+            </outGridNest>
+EOF
+}
 
-    info "Getting FLEXPART simulation parameters..."
-    date=${START_DATE:0:8}
-    hour=${START_DATE:8:2}
-    simu_start_date=$(date -d "${date} - 10 days" "+%Y%m%d")
-    simu_end_date=${date}
-    simu_start_time=${hour}0000
-    simu_end_time=${hour}0000
-    release_start_date=$(date -d "@$(($(date -d "${simu_end_date} ${hour}:00:00" +"%s") - 3600))" +"%Y%m%d")
-    release_start_time=$(date -d "@$(($(date -d "${simu_end_date} ${hour}:00:00" +"%s") - 3600))" +"%H%M")00
-    lat_min=$(echo "${_station_lat} - 0.25" | bc)
-    lat_max=$(echo "${_station_lat} + 0.25" | bc)
-    lon_min=$(echo "${_station_lon} - 0.25" | bc)
-    lon_max=$(echo "${_station_lon} + 0.25" | bc)
-    for alt_value in ${_station_alts}; do
-        wdir="${station_working_dir}/wdir-${date}${hour}-${alt_value}"
-        if [ ! -d ${wdir} ]; then mkdir -p ${wdir}; fi
-        alt_min=${alt_value}
-        alt_max=$((alt_min + 50))
-        simulation_config_file=${wdir}/actris-config.xml
-        cat <<EOF > ${simulation_config_file}
+function write_simulation_config_file(){
+    # Writes the XML configuration file of a FLEXPART simulation read by actris.py
+    #   $1 : path to the configuration file
+    #   $2 : simulation working directory
+    #   $3 : <release> nodes
+    cat <<EOF > ${1}
 <?xml version="1.0" encoding="UTF-8"?>
 <config>
     <actris>
@@ -275,6 +309,7 @@ function perform_flexpart_simulation(){
         </ecmwf_time>
         <flexpart>
             <root>/usr/local/flexpart_v10.4_3d7eebf/</root>
+            <output_profile>${FLEXPART_OUTPUT_PROFILE:-full}</output_profile>
             <par_mod_parameters>
                 <nxmax>360</nxmax>
                 <nymax>181</nymax>
@@ -284,12 +319,12 @@ function perform_flexpart_simulation(){
             </par_mod_parameters>
             <outGrid>
                 <longitude>
-                    <min>-179</min>
-                    <max>181</max>
+                    <min>${_outgrid_lon_min:--179}</min>
+                    <max>${_outgrid_lon_max:-181}</max>
                 </longitude>
                 <latitude>
-                    <min>-90</min>
-                    <max>90</max>
+                    <min>${_outgrid_lat_min:--90}</min>
+                    <max>${_outgrid_lat_max:-90}</max>
                 </latitude>
                 <resolution>1</resolution>
                 <height>
@@ -307,6 +342,7 @@ function perform_flexpart_simulation(){
                     <level>50000.0</level>
                 </height>
             </outGrid>
+$(write_outgrid_nest_node)
             <command>
                 <forward>-1</forward>
                 <time>
@@ -316,47 +352,137 @@ function perform_flexpart_simulation(){
             </command>
             <releases>
                 <species>24</species>
-                <release name='Release1'>
-                    <start_date>${release_start_date}</start_date>
-                    <start_time>${release_start_time}</start_time>
-                    <duration>00000000</duration>
-                    <altitude_min>${alt_min}</altitude_min>
-                    <altitude_max>${alt_max}</altitude_max>
-                    <zones>
-                        <zone name='${_station_name}'>
-                            <latmin>${lat_min}</latmin>
-                            <latmax>${lat_max}</latmax>
-                            <lonmin>${lon_min}</lonmin>
-                            <lonmax>${lon_max}</lonmax>
-                        </zone>
-                    </zones>
-                </release>
+${3}
             </releases>
         </flexpart>
         <paths>
-            <working_dir>${wdir}</working_dir>
+            <working_dir>${2}</working_dir>
             <ecmwf_dir>${DATA_DIR}</ecmwf_dir>
+            <flexpart_cache_dir>${FLEXPART_CACHE_DIR}</flexpart_cache_dir>
+            <staging_dir>${ENFILES_STAGING_DIR}</staging_dir>
+            <staging_max_size>${ENFILES_STAGING_MAX_SIZE}</staging_max_size>
         </paths>
     </actris>
 </config>
 EOF
-        # exit 0
-        module load singularity/3.10.2
-        # +----------------------------------+
-        # | Launch simulation                |
-        # +----------------------------------+
-        flexpart_output_file="${FLEXPART_OUT_DIR}/${_station_id}-${date}${hour}-${simu_start_date}-${alt_value}.nc"
-        singularity exec --bind ${DATA_DIR},${ROOT_WDIR} \
+}
+
+function run_flexpart(){
+    # Launches actris.py in the container, compacts the FLEXPART output as set by the output profile
+    # and returns the path to the native FLEXPART output
+    #   $1 : path to the configuration file
+    #   $2 : simulation working directory
+    module load singularity/3.10.2
+    if [ ! -z ${ENFILES_STAGING_DIR} ] && [ ! -d ${ENFILES_STAGING_DIR} ]; then mkdir -p ${ENFILES_STAGING_DIR}; fi
+    singularity exec --bind ${DATA_DIR},${ROOT_WDIR}${FLEXPART_CACHE_DIR:+,${FLEXPART_CACHE_DIR}}${ENFILES_STAGING_DIR:+,${ENFILES_STAGING_DIR}} \
+        ${SINGULARITY_FILEPATH} \
+        /usr/local/py_envs/actris_env/bin/python ${SRC_DIR}/actris.py \
+        --config ${1} 1>&2
+    # FLEXPART writes its output at startup: only a simulation marked as completed by actris.py has a valid output
+    if [ ! -f ${2}/SIMULATION_COMPLETED ]; then
+        echo ""
+        return
+    fi
+    # grid_time_nest_*.nc, the nested output if any, is excluded
+    _native_output_file=$(find ${2}/output -iname "grid_time_[0-9]*.nc")
+    if [ -f "${_native_output_file}" ] && [ "${FLEXPART_OUTPUT_PROFILE:-full}" != "full" ]; then
+        singularity exec --bind ${ROOT_WDIR} \
             ${SINGULARITY_FILEPATH} \
-            /usr/local/py_envs/actris_env/bin/python ${SRC_DIR}/actris.py \
-            --config ${simulation_config_file}
-        _flexpart_native_output_file=$(find ${wdir}/output -iname "grid_time*.nc")
-        if [ -f ${_flexpart_native_output_file} ]; then
-            mv ${_flexpart_native_output_file} ${flexpart_output_file}
+            /usr/local/py_envs/footprints_env/bin/python ${SRC_DIR}/compact-output.py \
+            -f ${_native_output_file} \
+            -c ${1} 1>&2
+    fi
+    echo ${_native_output_file}
+}
+
+function get_nest_file(){
+    # Prints the path to the nested output of a native FLEXPART output (see fpout.get_nest_url)
+    #   $1 : path to the native FLEXPART output grid_time_*.nc
+    echo "$(dirname ${1})/grid_time_nest_$(basename ${1#*grid_time_})"
+}
+
+function perform_flexpart_simulation(){
+
+    echo "+---------------------------------------------------------------------------------------------------------------------------+"
+    echo "|     ⣄⠇⠁       ⠠⠎  ⠈⠑⣄                       ⢀ ⣴⠋                                                                          |"
+    echo "|    ⠂⠋               ⠠⠟⠕⠦⡀                ⠤⢆⡋⠰⠸⠗                                                                           |"
+    echo "|   ⡁                    ⢡⠇               ⢼⣱⠁    ⢀⢠⠏⠒                                                                       |"
+    echo "|   ⠁⠐⠐⠄    ⢀         ⣀⡀⠖⠛            ⠠⠰⠺⡁⡛⠁    ⣜       ███████╗██╗     ███████╗██╗  ██╗██████╗  █████╗ ██████╗ ████████╗   |"
+    echo "|      ⠙⠁⠄⠆⡸⠓⡆⠠  ⢀⡞⠤⠠⠐⠁           ⣀⠐⡷⡾⡃⠉     ⢠⠰⠰⢇⠨⠦⡵    ██╔════╝██║     ██╔════╝╚██╗██╔╝██╔══██╗██╔══██╗██╔══██╗╚══██╔══╝   |"
+    echo "|             ⠈⠉ ⠁              ⣴⠋⠉ ⠉⠟    ⣄⡃⠉      ⠁    █████╗  ██║     █████╗   ╚███╔╝ ██████╔╝███████║██████╔╝   ██║      |"
+    echo "|      ⡀ ⡀⡀                   ⠠⢅⠃        ⣠⠃             ██╔══╝  ██║     ██╔══╝   ██╔██╗ ██╔═══╝ ██╔══██║██╔══██╗   ██║      |"
+    echo "|   ⡀⡵⠁⠁⠉⠘⠁⢢⣰ ⠄                ⠽⣯⡀                      ██║     ███████╗███████╗██╔╝ ██╗██║     ██║  ██║██║  ██║   ██║      |"
+    echo "|   ⠁        ⠉⣥⡕⢀ ⡀⢀            ⠪⡯                      ╚═╝     ╚══════╝╚══════╝╚═╝  ╚═╝╚═╝     ╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝      |"
+    echo "|              ⠊⡟⠭⠊⠊⠉⠓⠥⠰⡀       ⠐⡅                                                                                          |"
+    echo "|   ⡄⡀                 ⠉⢯⠄  ⡀    ⠉⣦⠄⠠⠠⠠⠂                                                                                    |"
+    echo "|   ⠉⠋⠻⢖⣤⢥⡦⣤⠷⣀⢄⡀      ⣰⡽⠃⠈⠁⠙⠁⣅⡠      ⠁⠈                                                                                     |"
+    echo "+---------------------------------------------------------------------------------------------------------------------------+"
+
+    info "Getting FLEXPART simulation parameters..."
+    date=${START_DATE:0:8}
+    hour=${START_DATE:8:2}
+    simu_start_date=$(date -d "${date} - 10 days" "+%Y%m%d")
+    simu_end_date=${date}
+    simu_start_time=${hour}0000
+    simu_end_time=${hour}0000
+    release_start_date=$(date -d "@$(($(date -d "${simu_end_date} ${hour}:00:00" +"%s") - 3600))" +"%Y%m%d")
+    release_start_time=$(date -d "@$(($(date -d "${simu_end_date} ${hour}:00:00" +"%s") - 3600))" +"%H%M")00
+    lat_min=${_release_lat_min}
+    lat_max=${_release_lat_max}
+    lon_min=${_release_lon_min}
+    lon_max=${_release_lon_max}
+    if [ ${MULTI_RELEASE_FLAG} == 1 ]; then
+        # +----------------------------------------------------+
+        # | One simulation with a release per height, split    |
+        # | afterwards into one output file per release        |
+        # +----------------------------------------------------+
+        wdir="${station_working_dir}/wdir-${date}${hour}-multi"
+        if [ ! -d ${wdir} ]; then mkdir -p ${wdir}; fi
+        release_nodes=""
+        for alt_value in ${_station_alts}; do
+            release_name="${_station_id}-${date}${hour}-${simu_start_date}-${alt_value}"
+            release_nodes="${release_nodes}$(write_release_node ${release_name} ${alt_value})"$'\n'
+        done
+        simulation_config_file=${wdir}/actris-config.xml
+        write_simulation_config_file ${simulation_config_file} ${wdir} "${release_nodes%$'\n'}"
+        _flexpart_native_output_file=$(run_flexpart ${simulation_config_file} ${wdir})
+        if [ -f "${_flexpart_native_output_file}" ]; then
+            module load singularity/3.10.2
+            singularity exec --bind ${ROOT_WDIR},${FLEXPART_OUT_DIR} \
+                ${SINGULARITY_FILEPATH} \
+                /usr/local/py_envs/footprints_env/bin/python ${SRC_DIR}/split-releases.py \
+                -f ${_flexpart_native_output_file} \
+                -o ${FLEXPART_OUT_DIR}
+            if [ $? == 0 ]; then
+                rm -f ${_flexpart_native_output_file} $(get_nest_file ${_flexpart_native_output_file})
+            else
+                error "Something went wrong while splitting the FLEXPART output by release..."
+            fi
         else
             error "Something went wrong with FLEXPART simulation..."
         fi
-    done
+    else
+        for alt_value in ${_station_alts}; do
+            wdir="${station_working_dir}/wdir-${date}${hour}-${alt_value}"
+            if [ ! -d ${wdir} ]; then mkdir -p ${wdir}; fi
+            simulation_config_file=${wdir}/actris-config.xml
+            write_simulation_config_file ${simulation_config_file} ${wdir} "$(write_release_node Release1 ${alt_value})"
+            # +----------------------------------+
+            # | Launch simulation                |
+            # +----------------------------------+
+            flexpart_output_file="${FLEXPART_OUT_DIR}/${_station_id}-${date}${hour}-${simu_start_date}-${alt_value}.nc"
+            _flexpart_native_output_file=$(run_flexpart ${simulation_config_file} ${wdir})
+            if [ -f "${_flexpart_native_output_file}" ]; then
+                mv ${_flexpart_native_output_file} ${flexpart_output_file}
+                _flexpart_native_nest_file=$(get_nest_file ${_flexpart_native_output_file})
+                if [ -f "${_flexpart_native_nest_file}" ]; then
+                    mv ${_flexpart_native_nest_file} ${flexpart_output_file%.nc}_nest.nc
+                fi
+            else
+                error "Something went wrong with FLEXPART simulation..."
+            fi
+        done
+    fi
 }
 
 function apply_softio(){
@@ -377,18 +503,23 @@ function apply_softio(){
     echo "+-----------------------------------------------------------------------------------------------------------+"
 
     module load singularity/3.10.2
-    files_to_process=($(find ${FLEXPART_OUT_DIR} -iname "${_station_id}-${START_DATE}*.nc"))
+    files_to_process=($(find ${FLEXPART_OUT_DIR} -iname "${_station_id}-${START_DATE}*.nc" ! -iname "*_nest.nc"))
     if [ ! -z ${files_to_process} ]; then
-        for flexpart_output_file in ${files_to_process[@]}; do
-            singularity exec \
-                --bind /o3p,/home/wolp/data,${FLEXPART_OUT_DIR},${SOFTIO_OUT_DIR},$(dirname ${SOFTIO_DATABASE}) \
-                ${SINGULARITY_FILEPATH} \
-                /usr/local/py_envs/softio_env/bin/python ${SRC_DIR}/apply-softio.py \
-                -f ${flexpart_output_file} \
-                -n ${_station_id} \
-                -d ${SOFTIO_OUT_DIR} \
-                -o ${SOFTIO_DATABASE}
-        done
+        # All FLEXPART outputs are processed by a single apply-softio.py call, the list is given as a manifest
+        manifest_file=$(mktemp -p ${FLEXPART_OUT_DIR} ${_station_id}-${START_DATE}-softio.XXXXXX)
+        printf "%s\n" "${files_to_process[@]}" > ${manifest_file}
+        singularity exec \
+            --bind /o3p,/home/wolp/data,${FLEXPART_OUT_DIR},${SOFTIO_OUT_DIR},$(dirname ${SOFTIO_DATABASE})${PROVENANCE_LEDGER:+,$(dirname ${PROVENANCE_LEDGER})} \
+            ${SINGULARITY_FILEPATH} \
+            /usr/local/py_envs/softio_env/bin/python ${SRC_DIR}/apply-softio.py \
+            -m ${manifest_file} \
+            -n ${_station_id} \
+            -d ${SOFTIO_OUT_DIR} \
+            -o ${SOFTIO_DATABASE} \
+            -i ${SOFTIO_INVENTORIES:-gfas ceds2} \
+            -j ${SOFTIO_WORKERS:-1} \
+            ${PROVENANCE_LEDGER:+--ledger ${PROVENANCE_LEDGER}}
+        rm -f ${manifest_file}
     else
         warning "No FLEXPART output were found for this configuration to run SOFT-IO computations on it. Verify your configuration and/or FLEXPART output and try again."
         exit 1
@@ -413,17 +544,38 @@ function create_footprints_image(){
     echo "+-------------------------------------------------------------------------------------------------------------------------------------------+"
     
     module load singularity/3.10.2
-    files_to_process=($(find ${FLEXPART_OUT_DIR} -iname "${_station_id}-${START_DATE}*.nc"))
+    files_to_process=($(find ${FLEXPART_OUT_DIR} -iname "${_station_id}-${START_DATE}*.nc" ! -iname "*_nest.nc"))
     if [ ! -z ${files_to_process} ]; then
-        for flexpart_output_file in ${files_to_process[@]}; do
+        # All FLEXPART outputs are processed by a single create-footprints.py call, the list is given as a manifest
+        manifest_file=$(mktemp -p ${FLEXPART_OUT_DIR} ${_station_id}-${START_DATE}-footprints.XXXXXX)
+        printf "%s\n" "${files_to_process[@]}" > ${manifest_file}
+        # fpout caches the pixel areas regridded to the FLEXPART output grid in FPOUT_CACHE_DIR
+        if [ ! -z ${FPOUT_CACHE_DIR} ]; then export SINGULARITYENV_FPOUT_CACHE_DIR=${FPOUT_CACHE_DIR}; fi
+        if [ -z ${FOOTPRINTS_STAGING_DIR} ]; then
             singularity exec \
-                --bind ${FLEXPART_OUT_DIR},$(dirname ${FOOTPRINTS_DATABASE}) \
+                --bind ${FLEXPART_OUT_DIR},$(dirname ${FOOTPRINTS_DATABASE})${FPOUT_CACHE_DIR:+,${FPOUT_CACHE_DIR}}${PROVENANCE_LEDGER:+,$(dirname ${PROVENANCE_LEDGER})} \
                 ${SINGULARITY_FILEPATH} \
                 /usr/local/py_envs/footprints_env/bin/python ${SRC_DIR}/create-footprints.py \
-                -f ${flexpart_output_file} \
+                -m ${manifest_file} \
                 -n ${_station_id} \
-                -o ${FOOTPRINTS_DATABASE}
-        done
+                -j ${FOOTPRINTS_WORKERS:-1} \
+                -o ${FOOTPRINTS_DATABASE} \
+                ${PROVENANCE_LEDGER:+--ledger ${PROVENANCE_LEDGER}}
+        else
+            # Footprints are staged as fragments, then all pending fragments are merged into the database at once
+            singularity exec \
+                --bind ${FLEXPART_OUT_DIR},${FOOTPRINTS_STAGING_DIR},$(dirname ${FOOTPRINTS_DATABASE})${FPOUT_CACHE_DIR:+,${FPOUT_CACHE_DIR}}${PROVENANCE_LEDGER:+,$(dirname ${PROVENANCE_LEDGER})} \
+                ${SINGULARITY_FILEPATH} \
+                /usr/local/py_envs/footprints_env/bin/python ${SRC_DIR}/create-footprints.py \
+                -m ${manifest_file} \
+                -n ${_station_id} \
+                -j ${FOOTPRINTS_WORKERS:-1} \
+                -s ${FOOTPRINTS_STAGING_DIR} \
+                -o ${FOOTPRINTS_DATABASE} \
+                --consolidate \
+                ${PROVENANCE_LEDGER:+--ledger ${PROVENANCE_LEDGER}}
+        fi
+        rm -f ${manifest_file}
     else
         warning "No FLEXPART output were found for this configuration to create footprints images from it. Verify your configuration and/or FLEXPART output and try again."
         exit 1
@@ -431,29 +583,10 @@ function create_footprints_image(){
 }
 
 function get_station_info(){
-    ids=($(cat ${STATIONS_CONF} | jq '.[].short_name'))
-    index=-1
-    for ii in "${!ids[@]}"; do
-        # ids[${ii}]=${ids[${ii}]//\"/""}
-        if [[ "${ids[${ii}]}" == "\"${STATION_CODE}\"" ]]; then
-            index=${ii}
-            break
-        fi
-    done
-    _station_id=${STATION_CODE}
-    readarray -t arr < <(jq -r '.[].standard_name' "${STATIONS_CONF}")
-    _station_name=${arr[${index}]}
-    arr=($(cat ${STATIONS_CONF} | jq '.[].latitude'))
-    _station_lat=${arr[${index}]}
-    arr=($(cat ${STATIONS_CONF} | jq '.[].longitude'))
-    _station_lon=${arr[${index}]}
-    _station_coords="${_station_lat} ${_station_lon}"
-    readarray -t arr < <(jq -r '.[].release_heights' "${STATIONS_CONF}")
-    _station_alts=${arr[${index}]}
-    # echo "_station_id      : ${_station_id}"
-    # echo "_station_name    : ${_station_name}"
-    # echo "_station_coords  : ${_station_coords}"
-    # echo "_station_alts    : ${_station_alts}"  
+    # Sets _station_id, _station_name, _station_lat, _station_lon, _station_coords, _station_alts, _station_parts,
+    # the release box _release_lat_min, _release_lat_max, _release_lon_min, _release_lon_max and the regional
+    # and nested output grids _outgrid_* and _outgrid_nest_* (empty for the global output grid without nest)
+    eval "${station_info}"
 }
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -491,8 +624,9 @@ function main(){
 SOFTIO_FLAG=0
 FLEXPART_FLAG=0
 FOOTPRINTS_FLAG=0
+MULTI_RELEASE_FLAG=0
 
-opts=$(getopt --longoptions "help,conf:,softio,flexpart,footprints" --name "$(basename "$0")" --options "h,n:,d:,c:" -- "$@")
+opts=$(getopt --longoptions "help,conf:,softio,flexpart,footprints,multi-release" --name "$(basename "$0")" --options "h,n:,d:,c:" -- "$@")
 eval set -- "$opts"
 
 while [[ $# -gt 0 ]]; do
@@ -504,6 +638,7 @@ while [[ $# -gt 0 ]]; do
         --softio) shift; SOFTIO_FLAG=1;;
         --flexpart) shift; FLEXPART_FLAG=1;;
         --footprints) shift; FOOTPRINTS_FLAG=1;;
+        --multi-release) shift; MULTI_RELEASE_FLAG=1;;
         \?) shift; error "Unrecognized options"; exit 1; shift;;
         --) break;;
     esac
@@ -73,40 +73,17 @@ function help() {
 }
 
 function get_station_ids(){
-	exec 2< "${PATHS_CONF_FILEPATH}"
-    while read -r line <&2; do
-        var_name=$(echo ${line} | cut -d= -f1)
-        var_value=$(echo ${line} | cut -d= -f2)
-        if [ "${var_name}" == "STATIONS_CONF" ]; then
-            var_value=${var_value//\"/""}
-            station_ids=($(cat ${var_value} | jq '.[].short_name'))
-            break
-        fi
-    done
-    for ii in "${!station_ids[@]}"; do
-        station_ids[${ii}]=${station_ids[${ii}]//\"/""}
-    done
-    exec 2<&-
+    station_ids=($(python3 ${SRC_DIR}/stations.py -c $(source ${PATHS_CONF_FILEPATH} && echo ${STATIONS_CONF}) ids))
 }
 
 function get_source_dir(){
-	exec 2< "${PATHS_CONF_FILEPATH}"
-    while read -r line <&2; do
-        var_name=$(echo ${line} | cut -d= -f1)
-        var_value=$(echo ${line} | cut -d= -f2)
-        if [ "${var_name}" == "SRC_DIR" ]; then
-            var_value=${var_value//\"/""}
-            SRC_DIR=${var_value}
-            break
-        fi
-    done
-    exec 2<&-
+    SRC_DIR=$(source ${PATHS_CONF_FILEPATH} && echo ${SRC_DIR})
 }
 
 function main(){
     _simu_date=$1
-    get_station_ids
     get_source_dir
+    get_station_ids
     jobIDs=""
     # for station in "PDM" "PUY" "RUN" "LTO" "SAC" "OPE"; do
     for station in ${station_ids[@]}; do
@@ -9,11 +9,45 @@ import netCDF4 as nc
 import numpy as np
 import shutil
 import math
+import hashlib
+import fcntl
+import json
+import re
+import time
+import asyncio
+import signal
+import dataclasses
+from dataclasses import dataclass, field
 import numpy.ma as ma
 
+from common.enfiles import ENFilesIndex, ENFilesStagingCache, get_required_ENfilenames
+
 FLEXPART_ROOT   = "/usr/local/flexpart_v10.4_3d7eebf"
 FLEXPART_EXE    = "/usr/local/flexpart_v10.4_3d7eebf/src/FLEXPART"
 
+# Files of the FLEXPART source tree which determine the compiled executable (par_mod.f90 is generated per run)
+FLEXPART_SRC_SUFFIXES = (".f90", ".f", ".F90", ".F", ".h")
+FLEXPART_MAKEFILES    = ("makefile", "Makefile")
+
+# Number of particles of a release, if not given in the configuration file
+DEFAULT_RELEASE_PARTS = 100000
+
+# Time step lines of the FLEXPART standard output, e.g.
+#       -10800 Seconds simulated:         99999 Particles:    Uncertainty:   0.000  0.000  0.000
+#  Simulated    3.0 hours (        10800 s),         99999 particles
+FLEXPART_PROGRESS_PATTERNS = [re.compile(r"^\s*(-?\d+)\s+seconds simulated:\s+(\d+)\s+particles", re.IGNORECASE),
+                              re.compile(r"^\s*simulated\s+[-\d.]+\s+hours\s+\(\s*(-?\d+)\s+s\),\s+(\d+)\s+particles", re.IGNORECASE)]
+# A run is considered stalled if FLEXPART does not report a time step for this number of seconds
+FLEXPART_STALL_TIMEOUT = 3600
+# Maximum length of an output line of FLEXPART in bytes, longer lines are discarded
+STREAM_LINE_LIMIT = 1024*1024
+# Marker file written in the working directory of a simulation once it has succeeded: FLEXPART writes its
+# netCDF output at startup, so that the output of a crashed or killed run cannot tell if it has succeeded
+COMPLETED_MARKER_FILENAME = "SIMULATION_COMPLETED"
+
+# Read-only inputs of the FLEXPART options directory, shared by all working directories of a plan
+FLEXPART_STATIC_OPTIONS = ("IGBP_int1.dat", "surfdata.t", "surfdepo.t", "SPECIES")
+
 DEFAULT_PARAMS = {"pi":3.14159265,
                   "r_earth":6.371e6,
                   "r_air":287.05,
@@ -57,6 +91,348 @@ DEFAULT_PARAMS = {"pi":3.14159265,
                   "cblFlag":0,
                   "ageclass":172800}
 
+# Parameters of the <command> node, in the order of the COMMAND file, with the matching FLEXPART keys
+COMMAND_PARAMS = [("forward", "LDIRECT"),
+                  ("output", "LOUTSTEP"),
+                  ("averageOutput", "LOUTAVER"),
+                  ("sampleRate", "LOUTSAMPLE"),
+                  ("particleSplitting", "ITSPLIT"),
+                  ("synchronisation", "LSYNCTIME"),
+                  ("ctl", "CTL"),
+                  ("ifine", "IFINE"),
+                  ("iOut", "IOUT"),
+                  ("ipOut", "IPOUT"),
+                  ("lSubGrid", "LSUBGRID"),
+                  ("lConvection", "LCONVECTION"),
+                  ("lAgeSpectra", "LAGESPECTRA"),
+                  ("ipIn", "IPIN"),
+                  ("iOfr", "IOUTPUTFOREACHRELEASE"),
+                  ("iFlux", "IFLUX"),
+                  ("mDomainFill", "MDOMAINFILL"),
+                  ("indSource", "IND_SOURCE"),
+                  ("indReceptor", "IND_RECEPTOR"),
+                  ("mQuasilag", "MQUASILAG"),
+                  ("nestedOutput", "NESTED_OUTPUT"),
+                  ("lInitCond", "LINIT_COND"),
+                  ("surfOnly", "SURF_ONLY"),
+                  ("cblFlag", "CBLFLAG")]
+COMMAND_TIME_PARAMS = ["output", "averageOutput", "sampleRate", "particleSplitting", "synchronisation"]
+
+@dataclass(frozen=True)
+class OutputProfile:
+    """
+    Output profile of the simulations, chosen after the post-processing of their outputs: the FLEXPART options it
+    enforces and how compact-output.py rewrites the FLEXPART output once the simulation is over
+
+    Attributes:
+        command    (dict): parameters of the <command> node enforced by the profile, by name
+        compact    (bool): if False, the FLEXPART output is kept as written by FLEXPART
+        sum_height (bool): if True, the fields are summed over the output levels when the output is compacted
+    """
+    command: dict
+    compact: bool
+    sum_height: bool
+
+# "footprint-only" outputs are read by create-footprints.py only, which sums them over height;
+# "softio" outputs keep the output levels for SOFT-io
+OUTPUT_PROFILES = {"full": OutputProfile(command={}, compact=False, sum_height=False),
+                   "softio": OutputProfile(command={"ipOut": "0", "iFlux": "0"}, compact=True, sum_height=False),
+                   "footprint-only": OutputProfile(command={"ipOut": "0", "iFlux": "0"}, compact=True, sum_height=True)}
+DEFAULT_OUTPUT_PROFILE = "full"
+
+@dataclass
+class ReleaseConfig:
+    """
+    A <release> node of the configuration file; values are kept as written in the file
+    """
+    name: str
+    start_date: str
+    start_time: str
+    duration: str
+    lon_min: str
+    lon_max: str
+    lat_min: str
+    lat_max: str
+    altitude_min: str
+    altitude_max: str
+    parts: int = DEFAULT_RELEASE_PARTS
+
+@dataclass
+class OutGridConfig:
+    """
+    The <outGrid> node of the configuration file; values are kept as written in the file
+    """
+    lon_min: str
+    lon_max: str
+    lat_min: str
+    lat_max: str
+    resolution: str
+    heights: list
+
+@dataclass
+class OutGridNestConfig:
+    """
+    The <outGridNest> node of the configuration file: nested output grid, at a finer resolution than the output
+    grid, written by FLEXPART into grid_time_nest_*.nc; values are kept as written in the file
+    """
+    lon_min: str
+    lon_max: str
+    lat_min: str
+    lat_max: str
+    resolution: str
+
+@dataclass
+class ReceptorConfig:
+    """
+    A receptor of the <receptor> node of the configuration file
+    """
+    name: str
+    longitude: str
+    latitude: str
+
+@dataclass
+class SimulationConfig:
+    """
+    Configuration of a FLEXPART simulation, read once from the xml configuration file (or built in memory)
+    and shared by all FLEXPART option writers. It is serialised to a dict/JSON with to_dict/to_json.
+
+    Attributes:
+        working_dir        (str) : simulation working directory
+        ecmwf_dir          (str) : directory with the ECMWF ENFILES
+        flexpart_cache_dir (str) : directory with compiled FLEXPART executables, "" if not used
+        start_date         (str) : simulation start date, YYYYMMDD
+        start_time         (str) : simulation start time, HHMMSS
+        end_date           (str) : simulation end date, YYYYMMDD
+        end_time           (str) : simulation end time, HHMMSS
+        ecmwf_dtime        (int) : time step of the ECMWF data in hours
+        species            (str) : species number of the releases
+        outgrid            (OutGridConfig): output grid
+        outgrid_nest       (OutGridNestConfig): nested output grid, None if there is no <outGridNest> node
+        output_profile     (str) : output profile of the simulation, a key of OUTPUT_PROFILES
+        releases           (list): ReleaseConfig of the releases
+        command            (dict): parameters of the <command> node given in the file, by name
+        receptors          (list): ReceptorConfig of the receptors, None if there is no <receptor> node
+        ageclasses         (list): ages of the <ageclass> node, None if there is no such node
+        par_mod_parameters (dict): parameters of the <par_mod_parameters> node given in the file, by name
+        staging_dir        (str) : node-local directory where the ECMWF files are staged, "" if not used
+        staging_max_size   (float): maximum size of the staged ECMWF files in GB, None for no limit
+    """
+    working_dir: str
+    ecmwf_dir: str
+    flexpart_cache_dir: str
+    start_date: str
+    start_time: str
+    end_date: str
+    end_time: str
+    ecmwf_dtime: int
+    species: str
+    outgrid: OutGridConfig
+    releases: list
+    command: dict = field(default_factory=dict)
+    receptors: list = None
+    ageclasses: list = None
+    par_mod_parameters: dict = field(default_factory=dict)
+    staging_dir: str = ""
+    staging_max_size: float = None
+    outgrid_nest: OutGridNestConfig = None
+    output_profile: str = DEFAULT_OUTPUT_PROFILE
+
+    @classmethod
+    def from_xml(cls, config_xml_filepath: str) -> "SimulationConfig":
+        root = ET.parse(config_xml_filepath).getroot().find("actris")
+
+        def text(path, default=None):
+            node = root.find(path)
+            if node is None or node.text is None:
+                return default
+            return node.text.strip()
+
+        command = {}
+        for name, _ in COMMAND_PARAMS:
+            value = text(f"flexpart/command/time/{name}" if name in COMMAND_TIME_PARAMS else f"flexpart/command/{name}")
+            if value is not None:
+                command[name] = value
+        receptors = None
+        if root.find("flexpart/receptor") is not None:
+            receptors = [ReceptorConfig(node.attrib["name"], node.attrib["longitude"], node.attrib["latitude"])
+                         for node in root.find("flexpart/receptor")]
+        ageclasses = None
+        if root.find("flexpart/ageclass") is not None:
+            ageclasses = sorted(int(node.text) for node in root.findall("flexpart/ageclass/class"))
+        par_mod_parameters = {}
+        if root.find("flexpart/par_mod_parameters") is not None:
+            for node in root.find("flexpart/par_mod_parameters"):
+                if node.text is not None and node.text.strip() != "":
+                    par_mod_parameters[node.tag] = float(node.text) if "." in node.text else int(node.text)
+        releases = []
+        for node in root.find("flexpart/releases"):
+            if node.tag == "release":
+                releases.append(ReleaseConfig(name=node.attrib["name"],
+                                              start_date=node.find("start_date").text,
+                                              start_time=node.find("start_time").text,
+                                              duration=node.find("duration").text,
+                                              lon_min=node.find("zones/zone/lonmin").text,
+                                              lon_max=node.find("zones/zone/lonmax").text,
+                                              lat_min=node.find("zones/zone/latmin").text,
+                                              lat_max=node.find("zones/zone/latmax").text,
+                                              altitude_min=node.find("altitude_min").text,
+                                              altitude_max=node.find("altitude_max").text,
+                                              parts=int(node.find("parts").text)
+                                                    if node.find("parts") is not None and (node.find("parts").text or "").strip()!=""
+                                                    else DEFAULT_RELEASE_PARTS))
+        outgrid = None
+        if root.find("flexpart/outGrid") is not None:
+            outgrid = OutGridConfig(lon_min=text("flexpart/outGrid/longitude/min"),
+                                    lon_max=text("flexpart/outGrid/longitude/max"),
+                                    lat_min=text("flexpart/outGrid/latitude/min"),
+                                    lat_max=text("flexpart/outGrid/latitude/max"),
+                                    resolution=text("flexpart/outGrid/resolution"),
+                                    heights=[node.text for node in root.find("flexpart/outGrid/height")])
+        outgrid_nest = None
+        if root.find("flexpart/outGridNest") is not None:
+            outgrid_nest = OutGridNestConfig(lon_min=text("flexpart/outGridNest/longitude/min"),
+                                             lon_max=text("flexpart/outGridNest/longitude/max"),
+                                             lat_min=text("flexpart/outGridNest/latitude/min"),
+                                             lat_max=text("flexpart/outGridNest/latitude/max"),
+                                             resolution=text("flexpart/outGridNest/resolution"))
+        dtime = text("ecmwf_time/dtime")
+        staging_max_size = text("paths/staging_max_size", "")
+        return cls(working_dir=text("paths/working_dir"),
+                   ecmwf_dir=text("paths/ecmwf_dir"),
+                   flexpart_cache_dir=text("paths/flexpart_cache_dir", ""),
+                   start_date=text("simulation_start/date"),
+                   start_time=text("simulation_start/time"),
+                   end_date=text("simulation_end/date"),
+                   end_time=text("simulation_end/time"),
+                   ecmwf_dtime=int(dtime) if dtime is not None else None,
+                   species=text("flexpart/releases/species"),
+                   outgrid=outgrid,
+                   releases=releases,
+                   command=command,
+                   receptors=receptors,
+                   ageclasses=ageclasses,
+                   par_mod_parameters=par_mod_parameters,
+                   staging_dir=text("paths/staging_dir", ""),
+                   staging_max_size=float(staging_max_size) if staging_max_size!="" else None,
+                   outgrid_nest=outgrid_nest,
+                   output_profile=text("flexpart/output_profile", DEFAULT_OUTPUT_PROFILE))
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "SimulationConfig":
+        d = dict(d)
+        d["outgrid"] = OutGridConfig(**d["outgrid"]) if d.get("outgrid") is not None else None
+        d["outgrid_nest"] = OutGridNestConfig(**d["outgrid_nest"]) if d.get("outgrid_nest") is not None else None
+        d["releases"] = [ReleaseConfig(**release) for release in d["releases"]]
+        if d.get("receptors") is not None:
+            d["receptors"] = [ReceptorConfig(**receptor) for receptor in d["receptors"]]
+        return cls(**d)
+
+    @classmethod
+    def from_json(cls, json_filepath: str) -> "SimulationConfig":
+        with open(json_filepath) as file:
+            return cls.from_dict(json.load(file))
+
+    @classmethod
+    def from_file(cls, config_filepath: str) -> "SimulationConfig":
+        """
+        Reads a configuration file, either in xml or in JSON (written by to_json)
+        """
+        if config_filepath.endswith(".json"):
+            return cls.from_json(config_filepath)
+        return cls.from_xml(config_filepath)
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+    def to_json(self, json_filepath: str) -> None:
+        with open(json_filepath, "w") as file:
+            json.dump(self.to_dict(), file)
+
+    def get_errors(self) -> list:
+        """
+        Checks the configuration
+
+        Returns:
+            list: error messages, empty if the configuration is correct
+        """
+        errors = []
+        mandatory = {"simulation_start/date": self.start_date, "simulation_start/time": self.start_time,
+                     "simulation_end/date": self.end_date, "simulation_end/time": self.end_time,
+                     "ecmwf_time/dtime": self.ecmwf_dtime, "paths/working_dir": self.working_dir,
+                     "paths/ecmwf_dir": self.ecmwf_dir, "flexpart/outGrid": self.outgrid,
+                     "flexpart/releases/species": self.species}
+        for node, value in mandatory.items():
+            if value is None:
+                errors.append(f"<{node}> node is missing or its children nodes are in incorrect format, check your configuration file!")
+        if len(errors) > 0:
+            return errors
+        # ________________________________________________________
+        # Simulation dates and times
+        try:
+            begin_date = datetime.datetime.strptime(self.start_date,"%Y%m%d")
+        except ValueError:
+            errors.append("Begin date of the simulation is incorrect. Correct pattern : YYYYMMDD")
+        try:
+            end_date = datetime.datetime.strptime(self.end_date,"%Y%m%d")
+        except ValueError:
+            errors.append("End date of the simulation is incorrect. Correct pattern : YYYYMMDD")
+        if len(errors) == 0 and begin_date > end_date:
+            errors.append("Begin date have to be earlier that the end date or be equal to the end date, check your configuration file")
+        try:
+            begin_time = datetime.datetime.strptime(self.start_date+"-"+self.start_time,"%Y%m%d-%H%M%S")
+            end_time = datetime.datetime.strptime(self.end_date+"-"+self.end_time,"%Y%m%d-%H%M%S")
+            if begin_time > end_time:
+                errors.append("Begin and end date/time of the simulation are inconsistent; begin date and time of the simulation should always be before the end date and time of the simulation; check your configuration file!")
+        except ValueError:
+            errors.append("Begin or end time of the simulation is incorrect. Correct pattern : HHMMSS")
+        # ________________________________________________________
+        # Output grid
+        try:
+            resolution = float(self.outgrid.resolution)
+            Nx = int((float(self.outgrid.lon_max) - float(self.outgrid.lon_min))/resolution)
+            Ny = int((float(self.outgrid.lat_max) - float(self.outgrid.lat_min))/resolution)
+        except (TypeError, ValueError, ZeroDivisionError):
+            errors.append("<flexpart/outGrid> node is missing or its children nodes are in incorrect format, check your configuration file!")
+            return errors
+        if (float(self.outgrid.lat_max)>90) or (float(self.outgrid.lat_min)<-90):
+            errors.append("Minimim or maximum latitude are out of possible range (-90 deg ; +90 deg), check your configuration file!")
+        if (Nx<=0) or (Ny<=0):
+            errors.append("Minimum latitude and longitude should always be inferior to the maximum values, resolution should be consistent with chosen lat/lon window to avoid zero-size image in X and Y direction, check your configuration file!")
+        if resolution<=0:
+            errors.append("Spatial resolution should be positive, check your configuration file!")
+        if np.any([float(elem)<0 for elem in self.outgrid.heights]):
+            errors.append("Height values can only be positive, check your configuration file!")
+        if self.output_profile not in OUTPUT_PROFILES:
+            errors.append(f"Output profile {self.output_profile} is unknown, use one of {', '.join(OUTPUT_PROFILES)}, check your configuration file!")
+        # ________________________________________________________
+        # Nested output grid
+        if self.outgrid_nest is not None:
+            nest = self.outgrid_nest
+            try:
+                nest_resolution = float(nest.resolution)
+                Nx = int((float(nest.lon_max) - float(nest.lon_min))/nest_resolution)
+                Ny = int((float(nest.lat_max) - float(nest.lat_min))/nest_resolution)
+            except (TypeError, ValueError, ZeroDivisionError):
+                errors.append("<flexpart/outGridNest> node is incomplete or its children nodes are in incorrect format, check your configuration file!")
+                return errors
+            if (Nx<=0) or (Ny<=0) or nest_resolution<=0:
+                errors.append("Nested output grid is empty, check the limits and the resolution of <flexpart/outGridNest> in your configuration file!")
+            if (float(nest.lon_min)<float(self.outgrid.lon_min)) or (float(nest.lon_max)>float(self.outgrid.lon_max)) or \
+               (float(nest.lat_min)<float(self.outgrid.lat_min)) or (float(nest.lat_max)>float(self.outgrid.lat_max)):
+                errors.append("Nested output grid should be inside the output grid, check your configuration file!")
+            if nest_resolution>resolution:
+                errors.append("Resolution of the nested output grid should be finer than the one of the output grid, check your configuration file!")
+        # ________________________________________________________
+        # Releases
+        for release in self.releases:
+            if release.parts<=0:
+                errors.append(f"Number of particles of the release {release.name} should be positive, check your configuration file!")
+        # ________________________________________________________
+        # Age classes
+        if self.command.get("lAgeSpectra", str(DEFAULT_PARAMS["lAgeSpectra"])) not in ("0", "1"):
+            errors.append("lAgeSpectra must be either 0 or 1 if it is set in the XML file, check your configuration file and try again.")
+        return errors
+
 def print_header_in_terminal() -> None:
     LOGGER.info("╔═══════════════════════════════════════════════╗")
     LOGGER.info("║                 |    *                        ║")
@@ -84,94 +460,12 @@ def verif_xml_file(xml_filepath: str) -> None:
         LOGGER.error(os.path.basename(xml_filepath)+" file does not exist")
         sys.exit(1)
 
-def get_simulation_date(xml_file: str) -> dict:
-    xml  = ET.parse(xml_file)
-    # ________________________________________________________
-    # Check if all nodes are present
-    xml_nodes = ["actris/simulation_start",
-                 "actris/simulation_start/date",
-                 "actris/simulation_end",
-                 "actris/simulation_end/date",
-                 "actris/ecmwf_time",
-                 "actris/ecmwf_time/dtime"]
-    for node in xml_nodes:
-        try:
-            found_node = xml.getroot().find(node)
-        except:
-            LOGGER.error("<simulation_start[end]> date node is missing or its children nodes are in incorrect format, check your configuration file!")
-            sys.exit(1)
-    # ________________________________________________________
-    # Get date from the xml
-    xml  = xml.getroot().find("actris")
-    date = {}
-    date["begin"] = xml.find("simulation_start").find("date").text
-    date["end"]   = xml.find("simulation_end").find("date").text
-    date["dtime"] = int(xml.find("ecmwf_time").find("dtime").text)
-    # ________________________________________________________
-    # Check if strings are correct
-    try:
-        begin_date = datetime.datetime.strptime(date["begin"],"%Y%m%d")
-    except:
-        LOGGER.error("Begin date of the simulation is incorrect. Correct pattern : YYYYMMDD")
-        sys.exit(1)
-    try:
-        end_date = datetime.datetime.strptime(date["end"],"%Y%m%d")
-    except:
-        LOGGER.error("End date of the simulation is incorrect. Correct pattern : YYYYMMDD")
-        sys.exit(1)
-    # if (date["dtime"]!=3) and (date["dtime"]!=6):
-    #     LOGGER.error("ECMWF delta step of the data should be either 3 or 6 hours, check your configuration file!")
-    #     sys.exit(1)
-    if begin_date > end_date:
-        LOGGER.error("Begin date have to be earlier that the end date or be equal to the end date, check your configuration file")
-        sys.exit(1)
-    return date
-
-def get_simulation_time(xml_file: str) -> dict:
-    simul_date = get_simulation_date(xml_file)
-    xml  = ET.parse(xml_file)
-    # ________________________________________________________
-    # Check if all nodes are present
-    xml_nodes = ["girafe/simulation_start",
-                 "girafe/simulation_start/time",
-                 "girafe/simulation_end",
-                 "girafe/simulation_end/time"]
-    for node in xml_nodes:
-        try:
-            found_node = xml.getroot().find(node)
-        except:
-            LOGGER.error("<simulation_start[end]> time node is missing or its children nodes are in incorrect format, check your configuration file!")
-            sys.exit(1)
-    # ________________________________________________________
-    # Get time from the xml file
-    xml  = xml.getroot().find("actris")
-    time = {}
-    time["begin"] = xml.find("simulation_start").find("time").text
-    time["end"]   = xml.find("simulation_end").find("time").text
-    # ________________________________________________________
-    # Check if strings are correct
-    try:
-        begin_time = datetime.datetime.strptime(simul_date["begin"]+"-"+time["begin"],"%Y%m%d-%H%M%S")
-    except:
-        LOGGER.error("Begin time of the simulation is incorrect. Correct pattern : HHMMSS")
-        sys.exit(1)
-    try:
-        end_time = datetime.datetime.strptime(simul_date["end"]+"-"+time["end"],"%Y%m%d-%H%M%S")
-    except:
-        LOGGER.error("End time of the simulation is incorrect. Correct pattern : HHMMSS")
-        sys.exit(1)
-    if begin_time > end_time:
-        LOGGER.error("Begin and end date/time of the simulation are inconsistent; begin date and time of the simulation should always be before the end date and time of the simulation; check your configuration file!")
-        sys.exit(1)
-    return time
-
-def write_available_file(config_xml_filepath: str, working_dir: str) -> None:
+def write_available_file(config: SimulationConfig, working_dir: str) -> None:
     LOGGER.info("Preparing AVAILABLE file for FLEXPART")
-    simul_date = get_simulation_date(config_xml_filepath)
     # 	20120101 000000      EA12010100      ON DISK
-    start_date = datetime.datetime.strptime(simul_date["begin"]+"T00:00:00","%Y%m%dT%H:%M:%S")
-    end_date   = datetime.datetime.strptime(simul_date["end"]+"T23:59:59","%Y%m%dT%H:%M:%S")
-    hour_delta = datetime.timedelta(hours=simul_date["dtime"])
+    start_date = datetime.datetime.strptime(config.start_date+"T00:00:00","%Y%m%dT%H:%M:%S")
+    end_date   = datetime.datetime.strptime(config.end_date+"T23:59:59","%Y%m%dT%H:%M:%S")
+    hour_delta = datetime.timedelta(hours=config.ecmwf_dtime)
     file_date  = start_date
     with open(working_dir+"/AVAILABLE","w") as file:
         file.write("XXXXXX EMPTY LINES XXXXXXXXX\n")
@@ -186,60 +480,42 @@ def write_available_file(config_xml_filepath: str, working_dir: str) -> None:
             file.write(line)
             file_date = file_date + hour_delta
 
-def get_ECMWF_pool_path(config_xml_filepath: str) -> str:
-    xml  = ET.parse(config_xml_filepath)
-    return xml.getroot().find("actris").find("paths").find("ecmwf_dir").text
-
-def write_pathnames_file(config_xml_filepath: str, working_dir: str) -> None:
+def write_pathnames_file(config: SimulationConfig, working_dir: str, ecmwf_dir: str="") -> None:
     # options_folder/
     # output_folder/
     # ECMWF_data_folder/
     # path_to_AVAILABLE_file/AVAILABLE
     LOGGER.info("Preparing pathnames file for FLEXPART")
     with open(working_dir+"/pathnames","w") as file:
-        file.write(wdir+"/options/\n")
-        file.write(wdir+"/output/\n")
-        file.write(get_ECMWF_pool_path(config_xml_filepath)+"\n")
-        file.write(wdir+"/AVAILABLE")
+        file.write(working_dir+"/options/\n")
+        file.write(working_dir+"/output/\n")
+        file.write((ecmwf_dir if ecmwf_dir!="" else config.ecmwf_dir)+"\n")
+        file.write(working_dir+"/AVAILABLE")
 
-def write_command_file(config_xml_filepath: str, working_dir: str) -> None:
+def write_command_file(config: SimulationConfig, working_dir: str) -> None:
     LOGGER.info("Preparing COMMAND file for FLEXPART")
-    xml  = ET.parse(config_xml_filepath)
-    xml  = xml.getroot().find("actris")
-    xml_keys = ["flexpart/command/forward",
-                "simulation_start/date",
-                "simulation_start/time",
-                "simulation_end/date",
-                "simulation_end/time",
-                "flexpart/command/time/output",
-                "flexpart/command/time/averageOutput",
-                "flexpart/command/time/sampleRate",
-                "flexpart/command/time/particleSplitting",
-                "flexpart/command/time/synchronisation",
-                "flexpart/command/ctl",
-                "flexpart/command/ifine",
-                "flexpart/command/iOut",
-                "flexpart/command/ipOut",
-                "flexpart/command/lSubGrid",
-                "flexpart/command/lConvection",
-                "flexpart/command/lAgeSpectra",
-                "flexpart/command/ipIn",
-                "flexpart/command/iOfr",
-                "flexpart/command/iFlux",
-                "flexpart/command/mDomainFill",
-                "flexpart/command/indSource",
-                "flexpart/command/indReceptor",
-                "flexpart/command/mQuasilag",
-                "flexpart/command/nestedOutput",
-                "flexpart/command/lInitCond",
-                "flexpart/command/surfOnly",
-                "flexpart/command/cblFlag"]
-    flexpart_keys = ["LDIRECT","IBDATE","IBTIME","IEDATE","IETIME","LOUTSTEP","LOUTAVER","LOUTSAMPLE","ITSPLIT","LSYNCTIME","CTL",
-                     "IFINE","IOUT","IPOUT","LSUBGRID","LCONVECTION","LAGESPECTRA","IPIN","IOUTPUTFOREACHRELEASE","IFLUX","MDOMAINFILL",
-                     "IND_SOURCE","IND_RECEPTOR","MQUASILAG","NESTED_OUTPUT","LINIT_COND","SURF_ONLY","CBLFLAG"]
-    backward_flag = int(xml.find(xml_keys[0]).text)
-    if backward_flag == -1:
-        DEFAULT_PARAMS["iOfr"] = 1
+    backward_flag = int(config.command.get("forward", DEFAULT_PARAMS["forward"]))
+    # backward runs write an output for each release (iOfr); DEFAULT_PARAMS is shared by the simulations
+    # of the process and is left untouched
+    default_params = dict(DEFAULT_PARAMS, iOfr=1) if backward_flag == -1 else DEFAULT_PARAMS
+    profile_command = OUTPUT_PROFILES[config.output_profile].command
+    values = []
+    for name, flexpart_key in COMMAND_PARAMS:
+        if name == "nestedOutput" and config.outgrid_nest is not None:
+            # OUTGRID_NEST is only read by FLEXPART with nested output
+            values.append((flexpart_key, "1"))
+            continue
+        if name in profile_command:
+            if name in config.command and config.command[name] != profile_command[name]:
+                LOGGER.warning(f"{name} is set to {profile_command[name]} by the output profile {config.output_profile}")
+            values.append((flexpart_key, profile_command[name]))
+            continue
+        values.append((flexpart_key, config.command.get(name, str(default_params[name]))))
+        if name == "forward":
+            values += [("IBDATE", config.start_date),
+                       ("IBTIME", config.start_time),
+                       ("IEDATE", config.end_date),
+                       ("IETIME", config.end_time)]
     with open(working_dir+"/options/COMMAND","w") as file:
         file.write("***************************************************************************************************************\n")
         file.write("*                                                                                                             *\n")
@@ -248,63 +524,20 @@ def write_command_file(config_xml_filepath: str, working_dir: str) -> None:
         file.write("*                                                                                                             *\n")
         file.write("***************************************************************************************************************\n")
         file.write("&COMMAND\n")
-        for ii in range(len(xml_keys)):
-            try:
-                value = xml.find(xml_keys[ii]).text
-            except:
-                try:
-                    value = str(DEFAULT_PARAMS[os.path.basename(xml_keys[ii])])
-                except:
-                    LOGGER.error(f"<{xml_keys[ii]}> node is mandatory but missing, check your configuration file!")
+        for flexpart_key, value in values:
             file.write(" "+
-                       flexpart_keys[ii]+"="+
-                       " "*(24-len(flexpart_keys[ii])-1-len(value))+
+                       flexpart_key+"="+
+                       " "*(24-len(flexpart_key)-1-len(value))+
                        value+
                        ",\n")
         file.write(" OHFIELDS_PATH=\""+FLEXPART_ROOT+"/flexin\",\n")
         file.write(" /\n")
 
-def write_outgrid_file(config_xml_filepath: str, working_dir: str) -> None:
+def write_outgrid_file(config: SimulationConfig, working_dir: str) -> None:
     LOGGER.info("Preparing OUTGRID file for FLEXPART")
-    xml  = ET.parse(config_xml_filepath)
-    # ________________________________________________________
-    # Check if all nodes are present
-    xml_nodes = ["actris/flexpart/outGrid",
-                 "actris/flexpart/outGrid/longitude/min",
-                 "actris/flexpart/outGrid/longitude/max",
-                 "actris/flexpart/outGrid/latitude/min",
-                 "actris/flexpart/outGrid/latitude/max",
-                 "actris/flexpart/outGrid/resolution"]
-    for node in xml_nodes:
-        try:
-            found_node = xml.getroot().find(node)
-        except:
-            LOGGER.error("<flexpart/outGrid> node is missing or its children nodes are in incorrect format, check your configuration file!")
-            sys.exit(1)
-    # ________________________________________________________
-    # Get data from the xml file
-    xml  = xml.getroot().find("actris/flexpart/outGrid")
-    Nx = int((float(xml.find("longitude/max").text) - float(xml.find("longitude/min").text))/float(xml.find("resolution").text))
-    Ny = int((float(xml.find("latitude/max").text) - float(xml.find("latitude/min").text))/float(xml.find("resolution").text))
-    height_levels = [node.text for node in xml.find("height")]
-    # ________________________________________________________
-    # Check if data is correct
-    # if (float(xml.find("longitude/max").text)>180) or (float(xml.find("longitude/min").text)<-180):
-    #     LOGGER.error("Minimim or maximum longitude are out of possible range (-180 deg ; +180 deg), check your configuration file!")
-    #     sys.exit(1)
-    if (float(xml.find("latitude/max").text)>90) or (float(xml.find("latitude/min").text)<-90):
-        LOGGER.error("Minimim or maximum latitude are out of possible range (-90 deg ; +90 deg), check your configuration file!")
-        sys.exit(1)
-    if (Nx<=0) or (Ny<=0):
-        LOGGER.error("Minimum latitude and longitude should always be inferior to the maximum values, resolution should be consistent with chosen lat/lon window to avoid zero-size image in X and Y direction, check your configuration file!")
-        sys.exit(1)
-    if float(xml.find("resolution").text)<=0:
-        LOGGER.error("Spatial resolution should be positive, check your configuration file!")
-        sys.exit(1)
-    check_height_levels = [float(elem)<0 for elem in height_levels]
-    if np.any(check_height_levels):
-        LOGGER.error("Height values can only be positive, check your configuration file!")
-        sys.exit(1)
+    outgrid = config.outgrid
+    Nx = int((float(outgrid.lon_max) - float(outgrid.lon_min))/float(outgrid.resolution))
+    Ny = int((float(outgrid.lat_max) - float(outgrid.lat_min))/float(outgrid.resolution))
     # ________________________________________________________
     # Write OUTGRID file
     with open(working_dir+"/options/OUTGRID","w") as file:
@@ -322,26 +555,55 @@ def write_outgrid_file(config_xml_filepath: str, working_dir: str) -> None:
         file.write("! OUTHEIGHTS = HEIGHT OF LEVELS (UPPER BOUNDARY)                               *\n")
         file.write("!*******************************************************************************\n")
         file.write("&OUTGRID\n")
-        file.write(" OUTLON0="+" "*(18-8-len(xml.find("longitude/min").text))+xml.find("longitude/min").text+",\n")
-        file.write(" OUTLAT0="+" "*(18-8-len(xml.find("latitude/min").text))+xml.find("latitude/min").text+",\n")
+        file.write(" OUTLON0="+" "*(18-8-len(outgrid.lon_min))+outgrid.lon_min+",\n")
+        file.write(" OUTLAT0="+" "*(18-8-len(outgrid.lat_min))+outgrid.lat_min+",\n")
         file.write(" NUMXGRID="+" "*(18-9-len(str(Nx)))+str(Nx)+",\n")
         file.write(" NUMYGRID="+" "*(18-9-len(str(Ny)))+str(Ny)+",\n")
-        file.write(" DXOUT="+" "*(18-6-len(xml.find("resolution").text))+xml.find("resolution").text+",\n")
-        file.write(" DYOUT="+" "*(18-6-len(xml.find("resolution").text))+xml.find("resolution").text+",\n")
-        file.write(" OUTHEIGHTS= "+", ".join(height_levels)+",\n")
+        file.write(" DXOUT="+" "*(18-6-len(outgrid.resolution))+outgrid.resolution+",\n")
+        file.write(" DYOUT="+" "*(18-6-len(outgrid.resolution))+outgrid.resolution+",\n")
+        file.write(" OUTHEIGHTS= "+", ".join(outgrid.heights)+",\n")
         file.write(" /\n")
         
-def write_receptors_file(config_xml_filepath: str, working_dir: str) -> None:
+def write_outgrid_nest_file(config: SimulationConfig, working_dir: str) -> None:
+    if config.outgrid_nest is None:
+        return
+    LOGGER.info("Preparing OUTGRID_NEST file for FLEXPART")
+    nest = config.outgrid_nest
+    Nx = int((float(nest.lon_max) - float(nest.lon_min))/float(nest.resolution))
+    Ny = int((float(nest.lat_max) - float(nest.lat_min))/float(nest.resolution))
+    # ________________________________________________________
+    # Write OUTGRID_NEST file
+    with open(working_dir+"/options/OUTGRID_NEST","w") as file:
+        file.write("!*******************************************************************************\n")
+        file.write("!                                                                              *\n")
+        file.write("!      Input file for the Lagrangian particle dispersion model FLEXPART        *\n")
+        file.write("!                   Please specify your nested output grid                     *\n")
+        file.write("!                                                                              *\n")
+        file.write("! OUTLON0N   = GEOGRAPHYICAL LONGITUDE OF LOWER LEFT CORNER OF NESTED GRID     *\n")
+        file.write("! OUTLAT0N   = GEOGRAPHYICAL LATITUDE OF LOWER LEFT CORNER OF NESTED GRID      *\n")
+        file.write("! NUMXGRIDN  = NUMBER OF GRID POINTS IN X DIRECTION (= No. of cells + 1)       *\n")
+        file.write("! NUMYGRIDN  = NUMBER OF GRID POINTS IN Y DIRECTION (= No. of cells + 1)       *\n")
+        file.write("! DXOUTN     = GRID DISTANCE IN X DIRECTION                                    *\n")
+        file.write("! DYOUTN     = GRID DISTANCE IN Y DIRECTION                                    *\n")
+        file.write("!*******************************************************************************\n")
+        file.write("&OUTGRIDN\n")
+        file.write(" OUTLON0N="+" "*(18-9-len(nest.lon_min))+nest.lon_min+",\n")
+        file.write(" OUTLAT0N="+" "*(18-9-len(nest.lat_min))+nest.lat_min+",\n")
+        file.write(" NUMXGRIDN="+" "*(18-10-len(str(Nx)))+str(Nx)+",\n")
+        file.write(" NUMYGRIDN="+" "*(18-10-len(str(Ny)))+str(Ny)+",\n")
+        file.write(" DXOUTN="+" "*(18-7-len(nest.resolution))+nest.resolution+",\n")
+        file.write(" DYOUTN="+" "*(18-7-len(nest.resolution))+nest.resolution+",\n")
+        file.write(" /\n")
+
+def write_receptors_file(config: SimulationConfig, working_dir: str) -> None:
     LOGGER.info("Preparing RECEPTORS file for FLEXPART")
-    xml  = ET.parse(config_xml_filepath)
-    xml  = xml.getroot().find("actris/flexpart/receptor")
-    if xml != None:
+    if config.receptors is not None:
         with open(working_dir+"/options/RECEPTORS","w") as file:
-            for node in xml:
+            for receptor in config.receptors:
                 file.write("&RECEPTORS\n")
-                file.write(" RECEPTOR=\""+node.attrib["name"]+"\",\n")
-                file.write(" LON="+node.attrib["longitude"]+",\n")
-                file.write(" LAT="+node.attrib["latitude"]+",\n")
+                file.write(" RECEPTOR=\""+receptor.name+"\",\n")
+                file.write(" LON="+receptor.longitude+",\n")
+                file.write(" LAT="+receptor.latitude+",\n")
                 file.write(" /\n")
     else:
         LOGGER.info("No receptors were requested")
@@ -352,10 +614,7 @@ def write_receptors_file(config_xml_filepath: str, working_dir: str) -> None:
             file.write(f" LAT=0.0,\n")
             file.write(" /\n")
 
-def write_par_mod_file(config_xml_filepath: str, working_dir: str, max_number_parts: int) -> str:
-    LOGGER.info("Preparing par_mod.f90 file for FLEXPART")
-    xml          = ET.parse(config_xml_filepath)
-    xml          = xml.getroot().find("actris/flexpart/par_mod_parameters")
+def get_par_mod_content(config: SimulationConfig, max_number_parts: int) -> str:
     xml_keys = {"pi":3.14159265,
                 "r_earth":6.371e6,
                 "r_air":287.05,
@@ -371,76 +630,76 @@ def write_par_mod_file(config_xml_filepath: str, working_dir: str, max_number_pa
                 "numclass":13,
                 "ni":11,
                 "maxcolumn":3000,
-                "maxrand":1000000,
-                "maxpart":max_number_parts}
-    keys_values = {}
-    for key in xml_keys:
-        if (xml.find(key) is not None) and (xml.find(key).text!=""):
-            value = float(xml.find(key).text) if "." in xml.find(key).text else int(xml.find(key).text)
-            keys_values.update({key.upper(): value}) 
-        else:
-            keys_values.update({key.upper(): xml_keys[key]})
+                "maxrand":1000000}
+    # values of the <par_mod_parameters> node, or else the defaults; maxpart is set by the releases
+    xml_keys = {key: config.par_mod_parameters.get(key, default) for key, default in xml_keys.items()}
+    xml_keys["maxpart"] = max_number_parts
 
+    lines = [
+        f"module par_mod",
+        f"  implicit none",
+        f"  integer,parameter :: dp=selected_real_kind(P=15)",
+        f"  integer,parameter :: sp=selected_real_kind(6)",
+        f"  integer,parameter :: dep_prec=sp",
+        f"  logical, parameter :: lusekerneloutput=.true.",
+        f"  logical, parameter :: lparticlecountoutput=.false.",
+        f"  integer,parameter :: numpath=4",
+        f"  real,parameter :: pi={xml_keys['pi']}, r_earth={xml_keys['r_earth']}, r_air={xml_keys['r_air']}, ga=9.81",
+        f"  real,parameter :: cpa=1004.6, kappa=0.286, pi180=pi/180., vonkarman=0.4",
+        f"  real,parameter :: rgas=8.31447 ",
+        f"  real,parameter :: r_water=461.495",
+        f"  real,parameter :: karman=0.40, href=15., convke=2.0",
+        f"  real,parameter :: hmixmin=100., hmixmax=4500. !, turbmesoscale=0.16",
+        f"  real :: d_trop=50., d_strat=0.1, turbmesoscale=0.16 ! turbulence factors can change for different runs",
+        f"  real,parameter :: rho_water=1000. !ZHG 2015 [kg/m3]",
+        f"  real,parameter :: incloud_ratio=6.2",
+        f"  real,parameter :: xmwml=18.016/28.960",
+        f"  real,parameter :: ozonescale=60., pvcrit=2.0",
+        f"  integer,parameter :: idiffnorm=10800, idiffmax=2*idiffnorm, minstep=1",
+        f"  real,parameter :: switchnorth=75., switchsouth=-75.",
+        f"  integer,parameter :: nxmax={xml_keys['nxmax']},nymax={xml_keys['nymax']},nuvzmax={xml_keys['nuvzmax']},nwzmax={xml_keys['nwzmax']},nzmax={xml_keys['nzmax']}",
+        f"  integer :: nxshift=0 ! shift not fixed for the executable ",
+        f"  integer,parameter :: maxnests=0,nxmaxn={xml_keys['nxmaxn']},nymaxn={xml_keys['nymaxn']}",
+        f"  integer,parameter :: nconvlevmax = nuvzmax-1",
+        f"  integer,parameter :: na = nconvlevmax+1",
+        f"  integer,parameter :: jpack=4*nxmax*nymax, jpunp=4*jpack",
+        f"  integer,parameter :: maxageclass=1,nclassunc=1",
+        f"  integer,parameter :: maxreceptor=20",
+        f"  integer,parameter :: maxpart={xml_keys['maxpart']}",
+        f"  integer,parameter :: maxspec=1",
+        f"  real,parameter :: minmass=0.0001",
+        f"  integer,parameter :: maxwf={xml_keys['maxwf']}, maxtable={xml_keys['maxtable']}, numclass={xml_keys['numclass']}, ni={xml_keys['ni']}",
+        f"  integer,parameter :: numwfmem=2",
+        f"  integer,parameter :: maxxOH=72, maxyOH=46, maxzOH=7",
+        f"  integer,parameter :: maxcolumn={xml_keys['maxcolumn']}",
+        f"  integer,parameter :: maxrand={xml_keys['maxrand']}",
+        f"  integer,parameter :: ncluster=5",
+        f"  integer,parameter :: unitpath=1, unitcommand=1, unitageclasses=1, unitgrid=1",
+        f"  integer,parameter :: unitavailab=1, unitreleases=88, unitpartout=93, unitpartout_average=105",
+        f"  integer,parameter :: unitpartin=93, unitflux=98, unitouttraj=96",
+        f"  integer,parameter :: unitvert=1, unitoro=1, unitpoin=1, unitreceptor=1",
+        f"  integer,parameter :: unitoutgrid=97, unitoutgridppt=99, unitoutinfo=1",
+        f"  integer,parameter :: unitspecies=1, unitoutrecept=91, unitoutreceptppt=92",
+        f"  integer,parameter :: unitlsm=1, unitsurfdata=1, unitland=1, unitwesely=1",
+        f"  integer,parameter :: unitOH=1",
+        f"  integer,parameter :: unitdates=94, unitheader=90,unitheader_txt=100, unitshortpart=95, unitprecip=101",
+        f"  integer,parameter :: unitboundcond=89",
+        f"  integer,parameter :: unittmp=101",
+        f"  integer,parameter :: unitoutfactor=102",
+        f"  integer,parameter ::  icmv=-9999",
+        f"end module par_mod",
+    ]
+    return "\n".join(lines)
+
+def write_par_mod_file(config: SimulationConfig, working_dir: str, max_number_parts: int) -> str:
+    LOGGER.info("Preparing par_mod.f90 file for FLEXPART")
+    par_mod_content = get_par_mod_content(config, max_number_parts)
     with open(f"{working_dir}/flexpart_src/par_mod.f90", "w") as file:
-        file.write(f"module par_mod\n")
-        file.write(f"  implicit none\n")
-        file.write(f"  integer,parameter :: dp=selected_real_kind(P=15)\n")
-        file.write(f"  integer,parameter :: sp=selected_real_kind(6)\n")
-        file.write(f"  integer,parameter :: dep_prec=sp\n")
-        file.write(f"  logical, parameter :: lusekerneloutput=.true.\n")
-        file.write(f"  logical, parameter :: lparticlecountoutput=.false.\n")
-        file.write(f"  integer,parameter :: numpath=4\n")
-        file.write(f"  real,parameter :: pi={xml_keys['pi']}, r_earth={xml_keys['r_earth']}, r_air={xml_keys['r_air']}, ga=9.81\n")
-        file.write(f"  real,parameter :: cpa=1004.6, kappa=0.286, pi180=pi/180., vonkarman=0.4\n")
-        file.write(f"  real,parameter :: rgas=8.31447 \n")
-        file.write(f"  real,parameter :: r_water=461.495\n")
-        file.write(f"  real,parameter :: karman=0.40, href=15., convke=2.0\n")
-        file.write(f"  real,parameter :: hmixmin=100., hmixmax=4500. !, turbmesoscale=0.16\n")
-        file.write(f"  real :: d_trop=50., d_strat=0.1, turbmesoscale=0.16 ! turbulence factors can change for different runs\n")
-        file.write(f"  real,parameter :: rho_water=1000. !ZHG 2015 [kg/m3]\n")
-        file.write(f"  real,parameter :: incloud_ratio=6.2\n")
-        file.write(f"  real,parameter :: xmwml=18.016/28.960\n")
-        file.write(f"  real,parameter :: ozonescale=60., pvcrit=2.0\n")
-        file.write(f"  integer,parameter :: idiffnorm=10800, idiffmax=2*idiffnorm, minstep=1\n")
-        file.write(f"  real,parameter :: switchnorth=75., switchsouth=-75.\n")
-        file.write(f"  integer,parameter :: nxmax={xml_keys['nxmax']},nymax={xml_keys['nymax']},nuvzmax={xml_keys['nuvzmax']},nwzmax={xml_keys['nwzmax']},nzmax={xml_keys['nzmax']}\n")
-        file.write(f"  integer :: nxshift=0 ! shift not fixed for the executable \n")
-        file.write(f"  integer,parameter :: maxnests=0,nxmaxn=0,nymaxn=0\n")
-        file.write(f"  integer,parameter :: nconvlevmax = nuvzmax-1\n")
-        file.write(f"  integer,parameter :: na = nconvlevmax+1\n")
-        file.write(f"  integer,parameter :: jpack=4*nxmax*nymax, jpunp=4*jpack\n")
-        file.write(f"  integer,parameter :: maxageclass=1,nclassunc=1\n")
-        file.write(f"  integer,parameter :: maxreceptor=20\n")
-        file.write(f"  integer,parameter :: maxpart={xml_keys['maxpart']}\n")
-        file.write(f"  integer,parameter :: maxspec=1\n")
-        file.write(f"  real,parameter :: minmass=0.0001\n")
-        file.write(f"  integer,parameter :: maxwf={xml_keys['maxwf']}, maxtable={xml_keys['maxtable']}, numclass={xml_keys['numclass']}, ni={xml_keys['ni']}\n")
-        file.write(f"  integer,parameter :: numwfmem=2\n")
-        file.write(f"  integer,parameter :: maxxOH=72, maxyOH=46, maxzOH=7\n")
-        file.write(f"  integer,parameter :: maxcolumn={xml_keys['maxcolumn']}\n")
-        file.write(f"  integer,parameter :: maxrand={xml_keys['maxrand']}\n")
-        file.write(f"  integer,parameter :: ncluster=5\n")
-        file.write(f"  integer,parameter :: unitpath=1, unitcommand=1, unitageclasses=1, unitgrid=1\n")
-        file.write(f"  integer,parameter :: unitavailab=1, unitreleases=88, unitpartout=93, unitpartout_average=105\n")
-        file.write(f"  integer,parameter :: unitpartin=93, unitflux=98, unitouttraj=96\n")
-        file.write(f"  integer,parameter :: unitvert=1, unitoro=1, unitpoin=1, unitreceptor=1\n")
-        file.write(f"  integer,parameter :: unitoutgrid=97, unitoutgridppt=99, unitoutinfo=1\n")
-        file.write(f"  integer,parameter :: unitspecies=1, unitoutrecept=91, unitoutreceptppt=92\n")
-        file.write(f"  integer,parameter :: unitlsm=1, unitsurfdata=1, unitland=1, unitwesely=1\n")
-        file.write(f"  integer,parameter :: unitOH=1\n")
-        file.write(f"  integer,parameter :: unitdates=94, unitheader=90,unitheader_txt=100, unitshortpart=95, unitprecip=101\n")
-        file.write(f"  integer,parameter :: unitboundcond=89\n")
-        file.write(f"  integer,parameter :: unittmp=101\n")
-        file.write(f"  integer,parameter :: unitoutfactor=102\n")
-        file.write(f"  integer,parameter ::  icmv=-9999\n")
-        file.write(f"end module par_mod")
-
-def write_ageclasses_file(config_xml_filepath: str, working_dir: str):
-    xml             = ET.parse(config_xml_filepath)
-    try:
-        ageclasses_flag = int(xml.getroot().find("actris/flexpart/command/lAgeSpectra").text)
-    except:
-        ageclasses_flag = DEFAULT_PARAMS["lAgeSpectra"]
+        file.write(par_mod_content)
+    return par_mod_content
+
+def write_ageclasses_file(config: SimulationConfig, working_dir: str):
+    ageclasses_flag = int(config.command.get("lAgeSpectra", DEFAULT_PARAMS["lAgeSpectra"]))
     if ageclasses_flag==0:
         LOGGER.info("Taking default ageclass value")
         with open(working_dir+"/options/AGECLASS","w") as file:
@@ -449,8 +708,7 @@ def write_ageclasses_file(config_xml_filepath: str, working_dir: str):
             file.write(f" LAGE={DEFAULT_PARAMS['ageclass']}\n")
             file.write(" /\n")
     elif ageclasses_flag==1:
-        xml  = xml.getroot().find("girafe/flexpart/ageclass")
-        if xml != None:
+        if config.ageclasses is not None:
             with open(f"{working_dir}/options/AGECLASSES", "w") as file:
                 file.write("************************************************\n")
                 file.write("*                                              *\n")
@@ -465,11 +723,7 @@ def write_ageclasses_file(config_xml_filepath: str, working_dir: str):
                 file.write("*time a particle is carried in the simulation. *\n")
                 file.write("*                                              *\n")
                 file.write("************************************************\n")
-                ages = []
-                for node in xml.getroot().findall("actris/flexpart/ageclass/class"):
-                    ages.append(int(node.text))
-                ages.sort()
-                for age in ages:
+                for age in config.ageclasses:
                     file.write("&AGECLASS\n")
                     file.write("NAGECLASS= 1,\n")
                     file.write(f"LAGE= {age},\n")
@@ -494,8 +748,7 @@ def add_time(init_datetime: str, init_format: str, add_string: str, new_format:
     return datetime.datetime.strftime(new_datetime_obj, new_format)
 
 
-def write_releases_file(config_xml_filepath: str, working_dir: str) -> int:
-    xml = ET.parse(config_xml_filepath)
+def write_releases_file(config: SimulationConfig, working_dir: str) -> int:
     # ----------------------------------------------------
     # Prepare RELEASES file
     # ----------------------------------------------------
@@ -512,35 +765,30 @@ def write_releases_file(config_xml_filepath: str, working_dir: str) -> int:
     file.write("***************************************************************************************************************\n")
     file.write("&RELEASES_CTRL\n")
     file.write(" NSPEC      =           1, ! Total number of species\n")
-    file.write(" SPECNUM_REL=          "+xml.getroot().find("actris/flexpart/releases/species").text+", ! Species numbers in directory SPECIES\n")
+    file.write(" SPECNUM_REL=          "+config.species+", ! Species numbers in directory SPECIES\n")
     file.write(" /\n")
     # ----------------------------------------------------
-    release_node        = xml.getroot().find("actris/flexpart/releases")
     total_number_parts  = 0
-    for release in release_node:
-        if release.tag=="release":
-            release_start_date     = release.find("start_date").text
-            release_start_time     = release.find("start_time").text
-            release_duration       = release.find("duration").text
-            end_date   = add_time(f"{release_start_date} {release_start_time}", "%Y%m%d %H%M%S", release_duration, "%Y%m%d")
-            end_time   = add_time(f"{release_start_date} {release_start_time}", "%Y%m%d %H%M%S", release_duration, "%H%M%S")
-            file.write("&RELEASE\n")
-            file.write(f" IDATE1 = {release_start_date},\n")
-            file.write(f" ITIME1 = {release_start_time},\n")
-            file.write(f" IDATE2 = {end_date},\n")
-            file.write(f" ITIME2 = {end_time},\n")
-            file.write(f" LON1 = {release.find('zones/zone/lonmin').text},\n")
-            file.write(f" LON2 = {release.find('zones/zone/lonmax').text},\n")
-            file.write(f" LAT1 = {release.find('zones/zone/latmin').text},\n")
-            file.write(f" LAT2 = {release.find('zones/zone/latmax').text},\n")
-            file.write(f" Z1 = {release.find('altitude_min').text},\n")
-            file.write(f" Z2 = {release.find('altitude_max').text},\n")
-            file.write(" ZKIND = 1,\n")
-            file.write(f" MASS = 1.000000E+00,\n")
-            file.write(f" PARTS = 100000,\n")
-            file.write(f" COMMENT = \"{release.attrib['name']}\",\n")
-            file.write(" /\n")
-            total_number_parts = total_number_parts + 100000
+    for release in config.releases:
+        end_date   = add_time(f"{release.start_date} {release.start_time}", "%Y%m%d %H%M%S", release.duration, "%Y%m%d")
+        end_time   = add_time(f"{release.start_date} {release.start_time}", "%Y%m%d %H%M%S", release.duration, "%H%M%S")
+        file.write("&RELEASE\n")
+        file.write(f" IDATE1 = {release.start_date},\n")
+        file.write(f" ITIME1 = {release.start_time},\n")
+        file.write(f" IDATE2 = {end_date},\n")
+        file.write(f" ITIME2 = {end_time},\n")
+        file.write(f" LON1 = {release.lon_min},\n")
+        file.write(f" LON2 = {release.lon_max},\n")
+        file.write(f" LAT1 = {release.lat_min},\n")
+        file.write(f" LAT2 = {release.lat_max},\n")
+        file.write(f" Z1 = {release.altitude_min},\n")
+        file.write(f" Z2 = {release.altitude_max},\n")
+        file.write(" ZKIND = 1,\n")
+        file.write(f" MASS = 1.000000E+00,\n")
+        file.write(f" PARTS = {release.parts},\n")
+        file.write(f" COMMENT = \"{release.name}\",\n")
+        file.write(" /\n")
+        total_number_parts = total_number_parts + release.parts
     file.close()
     return total_number_parts
 
@@ -565,24 +813,45 @@ def compile_flexpart(working_dir: str) -> None:
         return 1
     return 0
 
-def check_ECMWF_pool(config_xml_filepath: str, working_dir: str) -> int:
-    exit_flag = 0
+def check_ECMWF_pool(config: SimulationConfig, working_dir: str) -> int:
+    """
+    Checks that the ECMWF files of the simulation are in the ECMWF pool, using the persistent index
+    of the pool (common.enfiles.ENFilesIndex), which is refreshed only if the pool has changed
+
+    Returns:
+        int: 0 if all files are available, 1 otherwise
+    """
     LOGGER.info("Checking ECMWF pool for the available files")
-    ecmwf_pool = get_ECMWF_pool_path(config_xml_filepath)
-    with open(working_dir+"/AVAILABLE","r") as file:
-        lines = file.readlines()
-    list_EN_files = [line.split(" ")[7] for line in lines[3:]]
-    for file in list_EN_files:
-        if os.path.exists(ecmwf_pool+"/"+file):
-            LOGGER.info(file+" exists")
-        else:
-            LOGGER.error(file+" does not exist")
-            exit_flag = 1
-    return exit_flag
+    index = ENFilesIndex(config.ecmwf_dir).refresh()
+    missing_files = index.get_missing(config.start_date, config.end_date, config.ecmwf_dtime)
+    for file in missing_files:
+        LOGGER.error(file+" does not exist")
+    if len(missing_files)>0:
+        return 1
+    LOGGER.info(f"All ECMWF files from {config.start_date} to {config.end_date} are available in {config.ecmwf_dir}")
+    return 0
 
-def get_working_dir(config_xml_filepath: str) -> str:
-    xml = ET.parse(config_xml_filepath)
-    return xml.getroot().find("actris/paths/working_dir").text
+def get_ECMWF_staging_cache(config: SimulationConfig) -> ENFilesStagingCache:
+    max_size = int(config.staging_max_size*1e9) if config.staging_max_size is not None else None
+    return ENFilesStagingCache(config.staging_dir, max_size)
+
+def stage_ECMWF_files(config: SimulationConfig, working_dir: str) -> None:
+    """
+    Stages the ECMWF files of the simulation in the node-local staging directory and points the
+    pathnames file to it; the files are kept until release_ECMWF_files is called
+
+    Args:
+        config      (SimulationConfig): simulation configuration
+        working_dir (str)             : simulation working directory
+    """
+    filenames = get_required_ENfilenames(config.start_date, config.end_date, config.ecmwf_dtime)
+    LOGGER.info(f"Staging {len(filenames)} ECMWF files into {config.staging_dir}")
+    staged_dir = get_ECMWF_staging_cache(config).acquire(working_dir, config.ecmwf_dir, filenames)
+    write_pathnames_file(config, working_dir, staged_dir)
+
+def release_ECMWF_files(config: SimulationConfig, working_dir: str) -> None:
+    get_ECMWF_staging_cache(config).release(working_dir)
+    write_pathnames_file(config, working_dir)
 
 def copy_source_files(working_dir: str) -> None:
     local_src_dir = f"{working_dir}/flexpart_src/"
@@ -595,100 +864,623 @@ def copy_source_files(working_dir: str) -> None:
         return 1
     return 0
 
-def prepare_working_dir(working_dir: str) -> None:
+def get_flexpart_build_hash(par_mod_content: str) -> str:
+    """
+    Computes the hash identifying a FLEXPART executable: the content of the rendered
+    par_mod.f90 file, the makefile and the Fortran sources of the FLEXPART source tree.
+
+    Args:
+        par_mod_content (str): content of the par_mod.f90 file of the simulation
+
+    Returns:
+        str: hexadecimal sha256 digest
+    """
+    sha = hashlib.sha256()
+    sha.update(par_mod_content.encode("utf-8"))
+    for filepath in sorted(glob.glob(f"{FLEXPART_ROOT}/src/*")):
+        filename = os.path.basename(filepath)
+        if filename == "par_mod.f90":
+            continue
+        if not filename.endswith(FLEXPART_SRC_SUFFIXES) and filename not in FLEXPART_MAKEFILES:
+            continue
+        sha.update(filename.encode("utf-8"))
+        with open(filepath, "rb") as file:
+            sha.update(file.read())
+    return sha.hexdigest()
+
+def build_flexpart(config: SimulationConfig, working_dir: str, max_number_parts: int) -> int:
+    status = copy_source_files(working_dir)
+    if status!=0:
+        return 1
+    write_par_mod_file(config, working_dir, max_number_parts)
+    return compile_flexpart(working_dir)
+
+def install_flexpart(config: SimulationConfig, working_dir: str, max_number_parts: int) -> int:
+    """
+    Puts a FLEXPART executable compiled for the simulation into the working directory. If a cache
+    directory is set in the configuration file, the executable is taken from the cache when one was
+    already compiled with the same par_mod.f90, makefile and sources; otherwise it is compiled once
+    and stored in the cache. Concurrent jobs are serialized on a lock file per executable.
+
+    Args:
+        config           (SimulationConfig): simulation configuration
+        working_dir      (str)             : simulation working directory
+        max_number_parts (int)             : total number of particles of the simulation
+
+    Returns:
+        int: 0 if successful, 1 if error has occured
+    """
+    cache_dir = config.flexpart_cache_dir
+    if cache_dir=="":
+        return build_flexpart(config, working_dir, max_number_parts)
+    os.makedirs(cache_dir, exist_ok=True)
+    build_hash = get_flexpart_build_hash(get_par_mod_content(config, max_number_parts))
+    cached_exe = f"{cache_dir}/FLEXPART-{build_hash}"
+    with open(f"{cached_exe}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(cached_exe):
+            LOGGER.info(f"Taking FLEXPART executable from the cache {cached_exe}")
+        else:
+            LOGGER.info(f"No FLEXPART executable in the cache for the build {build_hash}")
+            status = build_flexpart(config, working_dir, max_number_parts)
+            if status!=0:
+                return 1
+            shutil.copy(f"{working_dir}/FLEXPART", f"{cached_exe}.tmp")
+            os.replace(f"{cached_exe}.tmp", cached_exe)
+            LOGGER.info(f"FLEXPART executable stored in the cache {cached_exe}")
+            return 0
+    shutil.copy(cached_exe, f"{working_dir}/FLEXPART")
+    return 0
+
+def prepare_working_dir(working_dir: str, shared_options_dir: str="") -> None:
+    """
+    Creates the simulation working directory with its options and output directories. The static
+    FLEXPART inputs (FLEXPART_STATIC_OPTIONS) are copied from the FLEXPART installation, or linked
+    to shared_options_dir if given (see prepare_shared_options_dir); existing ones are kept.
+
+    Args:
+        working_dir        (str): simulation working directory
+        shared_options_dir (str): directory with the static FLEXPART inputs, "" to copy them
+
+    Returns:
+        int: 0 if successful, 1 if error has occured
+    """
     if not os.path.exists(working_dir):
         try:
-            os.mkdir(f"{working_dir}")
-        except error:
+            os.makedirs(f"{working_dir}")
+        except OSError as error:
             LOGGER.error(error)
             return 1
     if not os.path.exists(f"{working_dir}/options"):
         os.mkdir(f"{working_dir}/options")
     if not os.path.exists(f"{working_dir}/output"):
         os.mkdir(f"{working_dir}/output")
-    shutil.copy(f"{FLEXPART_ROOT}/options/IGBP_int1.dat", f"{working_dir}/options/")
-    shutil.copy(f"{FLEXPART_ROOT}/options/surfdata.t", f"{working_dir}/options/")
-    shutil.copy(f"{FLEXPART_ROOT}/options/surfdepo.t", f"{working_dir}/options/")
-    if not os.path.exists(f"{working_dir}/options/SPECIES/"):
-        shutil.copytree(f"{FLEXPART_ROOT}/options/SPECIES", f"{working_dir}/options/SPECIES/")
+    for filename in FLEXPART_STATIC_OPTIONS:
+        target = f"{working_dir}/options/{filename}"
+        if os.path.lexists(target):
+            continue
+        if shared_options_dir!="":
+            os.symlink(os.path.abspath(f"{shared_options_dir}/{filename}"), target)
+        elif os.path.isdir(f"{FLEXPART_ROOT}/options/{filename}"):
+            shutil.copytree(f"{FLEXPART_ROOT}/options/{filename}", target)
+        else:
+            shutil.copy(f"{FLEXPART_ROOT}/options/{filename}", target)
     return 0
 
-def run_bash_command(command_string: str, working_dir: str) -> None:
+def prepare_shared_options_dir(shared_options_dir: str) -> None:
+    """
+    Copies once the static FLEXPART inputs (FLEXPART_STATIC_OPTIONS) into a directory shared by the
+    working directories of a plan
+    """
+    os.makedirs(shared_options_dir, exist_ok=True)
+    for filename in FLEXPART_STATIC_OPTIONS:
+        target = f"{shared_options_dir}/{filename}"
+        if os.path.exists(target):
+            continue
+        if os.path.isdir(f"{FLEXPART_ROOT}/options/{filename}"):
+            shutil.copytree(f"{FLEXPART_ROOT}/options/{filename}", f"{target}.tmp-{os.getpid()}")
+        else:
+            shutil.copy(f"{FLEXPART_ROOT}/options/{filename}", f"{target}.tmp-{os.getpid()}")
+        os.replace(f"{target}.tmp-{os.getpid()}", target)
+
+@dataclass
+class PlannedRun:
+    """
+    A FLEXPART simulation prepared by plan_simulations, i.e. a line of the job manifest
+
+    Attributes:
+        station_id      (str): short ID name of the station
+        simu_date       (str): simulation date, YYYYMMDDHH
+        release         (str): release height, or "multi" for a run with a release per height
+        working_dir     (str): simulation working directory
+        config_filepath (str): JSON configuration file of the simulation, to pass to actris.py --config
+        output          (str): FLEXPART output file, or output directory of split-releases.py for "multi" runs
+    """
+    station_id: str
+    simu_date: str
+    release: str
+    working_dir: str
+    config_filepath: str
+    output: str
+
+MANIFEST_COLUMNS = [f.name for f in dataclasses.fields(PlannedRun)]
+
+def get_simulation_dates(start: str, end: str, step_hours: int) -> list:
+    """
+    Returns the simulation dates YYYYMMDDHH from start to end included, every step_hours
+    """
+    date     = datetime.datetime.strptime(start, "%Y%m%d%H")
+    end_date = datetime.datetime.strptime(end, "%Y%m%d%H")
+    dates    = []
+    while date <= end_date:
+        dates.append(date.strftime("%Y%m%d%H"))
+        date = date + datetime.timedelta(hours=step_hours)
+    return dates
+
+def get_station_simulation_config(template: SimulationConfig, station, simu_date: str, n_days: int,
+                                  working_dir: str, release_names: dict, parts: int=None) -> SimulationConfig:
+    """
+    Returns the configuration of a backward simulation of a station, as written by actris-processing.sh:
+    the simulation runs from simu_date back n_days days and the releases start one hour before simu_date.
+    The output grid of the template is restricted to the regional domain of the station, if any, and the
+    nested output grid of the station, if any, is added.
+
+    Args:
+        template        (SimulationConfig): configuration with the options shared by all simulations
+        station         (stations.Station): station of the simulation
+        simu_date       (str)             : simulation date, YYYYMMDDHH
+        n_days          (int)             : length of the simulation in days
+        working_dir     (str)             : simulation working directory
+        release_names   (dict)            : FLEXPART release comment by release height (int) to simulate
+        parts           (int)             : number of particles per release; default: release_parts of
+                                            the station, or else DEFAULT_RELEASE_PARTS
+
+    Returns:
+        SimulationConfig: configuration of the simulation
+    """
+    end_datetime     = datetime.datetime.strptime(simu_date, "%Y%m%d%H")
+    start_datetime   = end_datetime - datetime.timedelta(days=n_days)
+    release_datetime = end_datetime - datetime.timedelta(hours=1)
+    box              = station.get_release_box()
+    if parts is None:
+        parts = station.release_parts if station.release_parts is not None else DEFAULT_RELEASE_PARTS
+    releases = []
+    for altitude_min, altitude_max in station.get_release_layers():
+        if altitude_min not in release_names:
+            continue
+        releases.append(ReleaseConfig(name=release_names[altitude_min],
+                                      start_date=release_datetime.strftime("%Y%m%d"),
+                                      start_time=release_datetime.strftime("%H%M00"),
+                                      duration="00000000",
+                                      lon_min=str(box["lon_min"]),
+                                      lon_max=str(box["lon_max"]),
+                                      lat_min=str(box["lat_min"]),
+                                      lat_max=str(box["lat_max"]),
+                                      altitude_min=str(altitude_min),
+                                      altitude_max=str(altitude_max),
+                                      parts=parts))
+    outgrid      = template.outgrid
+    outgrid_nest = template.outgrid_nest
+    if station.outgrid is not None:
+        outgrid = dataclasses.replace(outgrid, **{key: str(value) for key, value in station.outgrid.items()})
+    if station.outgrid_nest is not None:
+        outgrid_nest = OutGridNestConfig(**{key: str(value) for key, value in station.outgrid_nest.items()})
+    return dataclasses.replace(template,
+                               outgrid=outgrid,
+                               outgrid_nest=outgrid_nest,
+                               working_dir=working_dir,
+                               start_date=start_datetime.strftime("%Y%m%d"),
+                               start_time=start_datetime.strftime("%H0000"),
+                               end_date=end_datetime.strftime("%Y%m%d"),
+                               end_time=end_datetime.strftime("%H0000"),
+                               releases=releases)
+
+def write_simulation_options(config: SimulationConfig, shared_options_dir: str="") -> int:
+    """
+    Prepares the working directory of a simulation with all FLEXPART option files; the FLEXPART
+    executable is not installed
+
+    Returns:
+        int: total number of particles of the simulation
+    """
+    working_dir = config.working_dir
+    prepare_working_dir(working_dir, shared_options_dir)
+    write_available_file(config, working_dir)
+    write_pathnames_file(config, working_dir)
+    write_command_file(config, working_dir)
+    write_outgrid_file(config, working_dir)
+    write_outgrid_nest_file(config, working_dir)
+    write_receptors_file(config, working_dir)
+    n_parts = write_releases_file(config, working_dir)
+    write_ageclasses_file(config, working_dir)
+    return n_parts
+
+def plan_simulations(template: SimulationConfig, simu_dates: list, stations: list, root_wdir: str,
+                     flexpart_out_dir: str, n_days: int=10, multi_release: bool=False, parts: int=None,
+                     output_profile: str=None) -> list:
     """
-    Executes bash commands and logs its output simultaneously
+    Prepares in a single process the working directories of the simulations of many stations and dates,
+    with the directory layout of actris-processing.sh: <root_wdir>/<station>/wdir-<date>-<height|multi>.
+    The static FLEXPART inputs are copied once into <root_wdir>/shared_options and linked from every
+    working directory. The configuration of each simulation is written as actris-config.json in its
+    working directory, so that a job only has to run actris.py --config on it.
 
     Args:
-        command_string (str): bash command to execute
+        template         (SimulationConfig): configuration with the options shared by all simulations
+                                             (output grid, command, par_mod parameters, paths)
+        simu_dates       (list)            : simulation dates, YYYYMMDDHH
+        stations         (list)            : stations.Station to simulate
+        root_wdir        (str)             : root of the working directories
+        flexpart_out_dir (str)             : directory of the FLEXPART outputs
+        n_days           (int)             : length of the simulations in days
+        multi_release    (bool)            : if True, a single simulation with a release per height
+                                             is prepared per station and date
+        parts            (int)             : number of particles per release, None for the default of
+                                             each station (see get_station_simulation_config)
+        output_profile   (str)             : output profile of the simulations, None for the one of the template
+
+    Returns:
+        list: PlannedRun of the prepared simulations
+    """
+    shared_options_dir = f"{root_wdir}/shared_options"
+    prepare_shared_options_dir(shared_options_dir)
+    if output_profile is not None:
+        template = dataclasses.replace(template, output_profile=output_profile)
+    planned_runs = []
+    for simu_date in simu_dates:
+        simu_start_date = (datetime.datetime.strptime(simu_date, "%Y%m%d%H") - datetime.timedelta(days=n_days)).strftime("%Y%m%d")
+        for station in stations:
+            if multi_release:
+                runs = [("multi", {h: f"{station.short_name}-{simu_date}-{simu_start_date}-{h}" for h in station.release_heights},
+                         flexpart_out_dir)]
+            else:
+                runs = [(str(h), {h: "Release1"}, f"{flexpart_out_dir}/{station.short_name}-{simu_date}-{simu_start_date}-{h}.nc")
+                        for h in station.release_heights]
+            for release, release_names, output in runs:
+                working_dir = f"{root_wdir}/{station.short_name}/wdir-{simu_date}-{release}"
+                config = get_station_simulation_config(template, station, simu_date, n_days, working_dir, release_names, parts)
+                errors = config.get_errors()
+                if len(errors)>0:
+                    for error in errors:
+                        LOGGER.error(f"{station.short_name} {simu_date} {release}: {error}")
+                    continue
+                write_simulation_options(config, shared_options_dir)
+                config_filepath = f"{working_dir}/actris-config.json"
+                config.to_json(config_filepath)
+                planned_runs.append(PlannedRun(station.short_name, simu_date, release, working_dir, config_filepath, output))
+    return planned_runs
+
+def write_manifest(planned_runs: list, manifest_filepath: str) -> None:
+    """
+    Writes the job manifest of a plan: a header line starting with # and one line per simulation with
+    the whitespace-separated fields of PlannedRun (MANIFEST_COLUMNS). Line i (from 1) is the task i of
+    a job array.
+    """
+    with open(f"{manifest_filepath}.tmp", "w") as file:
+        file.write("# "+" ".join(MANIFEST_COLUMNS)+"\n")
+        for run in planned_runs:
+            file.write(" ".join(getattr(run, column) for column in MANIFEST_COLUMNS)+"\n")
+    os.replace(f"{manifest_filepath}.tmp", manifest_filepath)
+
+def parse_flexpart_progress(line: str) -> tuple:
     """
-    process = subprocess.Popen(command_string, cwd=working_dir, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    Parses a time step line of the FLEXPART standard output
+
+    Args:
+        line (str): line of the standard output
+
+    Returns:
+        tuple: (simulated seconds, number of particles), None if the line is not a time step line
+    """
+    for pattern in FLEXPART_PROGRESS_PATTERNS:
+        match = pattern.match(line)
+        if match is not None:
+            # simulated time is negative in backward mode
+            return abs(int(match.group(1))), int(match.group(2))
+    return None
+
+class FlexpartProgress:
+    """
+    Progress of a FLEXPART run, updated from its time step lines and written as JSON lines: for each
+    time step, the simulated time reached, the number of particles, the wall time of the step, the
+    throughput in simulated hours per wall-clock second and the estimated remaining wall time
+    """
+
+    def __init__(self, progress_filepath: str="", total_seconds: int=None):
+        self.progress_filepath = progress_filepath
+        self.total_seconds     = total_seconds
+        self.start_time        = time.monotonic()
+        self.last_step_time    = self.start_time
+        self.simulated_seconds = 0
+        if progress_filepath!="":
+            open(progress_filepath, "w").close()
+
+    def update(self, simulated_seconds: int, particles: int) -> dict:
+        now = time.monotonic()
+        wall_seconds = now - self.start_time
+        event = {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                 "simulated_seconds": simulated_seconds,
+                 "particles": particles,
+                 "step_wall_seconds": round(now - self.last_step_time, 3),
+                 "wall_seconds": round(wall_seconds, 3),
+                 "throughput": round(simulated_seconds/3600/wall_seconds, 3) if wall_seconds>0 else None,
+                 "eta_seconds": None}
+        if self.total_seconds is not None and simulated_seconds>0:
+            event["eta_seconds"] = round(wall_seconds*(self.total_seconds - simulated_seconds)/simulated_seconds)
+        self.last_step_time    = now
+        self.simulated_seconds = simulated_seconds
+        if self.progress_filepath!="":
+            with open(self.progress_filepath, "a") as file:
+                file.write(json.dumps(event)+"\n")
+        return event
+
+    def get_seconds_since_last_step(self) -> float:
+        return time.monotonic() - self.last_step_time
+
+async def _log_stream(stream, log, progress: FlexpartProgress=None) -> None:
     while True:
-        output = process.stdout.readline()
-        if process.poll() is not None:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # line longer than the buffer limit, it has been discarded
+            log("(line too long, discarded)")
+            continue
+        if not line:
             break
-        if output:
-            LOGGER.info(output.strip().decode('utf-8'))
-    return_code = process.poll()
-    return return_code
+        line = line.decode("utf-8", errors="replace").rstrip()
+        step = parse_flexpart_progress(line) if progress is not None else None
+        if step is None:
+            if line!="":
+                log(line)
+            continue
+        event = progress.update(*step)
+        eta = f", ETA {datetime.timedelta(seconds=event['eta_seconds'])}" if event["eta_seconds"] is not None else ""
+        LOGGER.info(f"Simulated {event['simulated_seconds']/3600:.1f} h with {event['particles']} particles, "
+                    f"{event['throughput']} simulated h/s{eta}")
 
+async def _run_command(command: list, working_dir: str, progress: FlexpartProgress, stall_timeout: float) -> int:
+    # the command runs in its own process group, so that a stalled run is killed with its children
+    process = await asyncio.create_subprocess_exec(*command, cwd=working_dir, limit=STREAM_LINE_LIMIT, start_new_session=True,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stalled = False
 
-# ===============================================================================================================
+    async def watch():
+        nonlocal stalled
+        while True:
+            await asyncio.sleep(min(stall_timeout/10, 60))
+            if progress.get_seconds_since_last_step()>stall_timeout:
+                LOGGER.error(f"No progress of {command[0]} for {stall_timeout} s, the run is considered stalled and is killed")
+                stalled = True
+                os.killpg(process.pid, signal.SIGKILL)
+                return
 
+    watcher = asyncio.ensure_future(watch()) if stall_timeout is not None and stall_timeout>0 else None
+    # both streams are drained concurrently, so that the process never blocks on a full pipe
+    await asyncio.gather(_log_stream(process.stdout, LOGGER.info, progress),
+                         _log_stream(process.stderr, LOGGER.warning))
+    return_code = await process.wait()
+    if watcher is not None:
+        watcher.cancel()
+    return 1 if stalled else return_code
 
-if __name__=="__main__":
+def run_command(command: list, working_dir: str, progress_filepath: str="", total_seconds: int=None,
+                stall_timeout: float=FLEXPART_STALL_TIMEOUT) -> int:
+    """
+    Executes a command (FLEXPART) and logs its standard output and error while it runs. Time step lines
+    of FLEXPART are turned into progress events (see FlexpartProgress), and the command is killed if no
+    time step is reported for stall_timeout seconds.
 
-    import argparse
-    
-    parser = argparse.ArgumentParser(description="Python code that prepares all FLEXPART inputs and launches a backward FLEXPART simulation for an ACTRIS station based on the user’s configuration file.", 
-                                    formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--config", type=str, help="Filepath to your configuration xml file.")
+    Args:
+        command           (list) : command to execute
+        working_dir       (str)  : directory where to execute it
+        progress_filepath (str)  : JSON lines file of the progress events, "" if not written
+        total_seconds     (int)  : simulated seconds of the whole run, to estimate the remaining time
+        stall_timeout     (float): seconds without time step after which the run is killed, None to disable
 
-    args = parser.parse_args()
+    Returns:
+        int: return code of the command, 1 if it was killed
+    """
+    progress = FlexpartProgress(progress_filepath, total_seconds)
+    return asyncio.run(_run_command(command, working_dir, progress, stall_timeout))
 
-    config_xmlpath = args.config
-    wdir           = get_working_dir(config_xmlpath)
-    status         = prepare_working_dir(wdir)
+def get_simulation_seconds(config: SimulationConfig) -> int:
+    start = datetime.datetime.strptime(config.start_date+config.start_time, "%Y%m%d%H%M%S")
+    end   = datetime.datetime.strptime(config.end_date+config.end_time, "%Y%m%d%H%M%S")
+    return int((end - start).total_seconds())
 
-    global LOGGER, LOG_FILEPATH
-    LOG_FILEPATH = wdir+"/actris_"+datetime.datetime.now().strftime("%Y%m%d_%H%M%S")+".log"
-    LOGGER = start_log(LOG_FILEPATH)
 
+def run_simulation(config_filepath: str, config: SimulationConfig, previous_config: SimulationConfig=None,
+                   stall_timeout: float=FLEXPART_STALL_TIMEOUT) -> int:
+    """
+    Prepares all FLEXPART inputs of a simulation and runs FLEXPART. If the ECMWF files are staged, they are
+    kept staged after the run: with previous_config, the files of the previous simulation are released once
+    those of this simulation are staged, so that the files common to consecutive simulations stay staged.
+
+    Args:
+        config_filepath (str)             : path to the configuration file
+        config          (SimulationConfig): simulation configuration
+        previous_config (SimulationConfig): configuration of the previous simulation run by this process, if any
+        stall_timeout   (float)           : seconds without FLEXPART time step after which the run is killed
+
+    Returns:
+        int: 0 if successful, 1 if error has occured
+    """
+    wdir   = config.working_dir
+    if os.path.exists(f"{wdir}/{COMPLETED_MARKER_FILENAME}"):
+        os.remove(f"{wdir}/{COMPLETED_MARKER_FILENAME}")
+    status = prepare_working_dir(wdir)
     if status!=0:
         LOGGER.error("Something went wrong...")
-        sys.exit(1)
+        return 1
 
     ##########################################################################
 
-    verif_xml_file(config_xmlpath)
+    verif_xml_file(config_filepath)
+    errors = config.get_errors()
+    for error in errors:
+        LOGGER.error(error)
+    if len(errors)>0:
+        return 1
 
     ##########################################################################
 
-    write_available_file(config_xmlpath,wdir)
-    status = check_ECMWF_pool(config_xmlpath,wdir)
+    write_available_file(config,wdir)
+    status = check_ECMWF_pool(config,wdir)
     if status!=0:
         LOGGER.error("Some of the ECMWF files are not available in your indicated directory, please check your data and configuration file and retry again.")
-        sys.exit(1)
+        return 1
     
-    write_pathnames_file(config_xmlpath,wdir)
-    write_command_file(config_xmlpath,wdir)
-    write_outgrid_file(config_xmlpath,wdir)
-    write_receptors_file(config_xmlpath,wdir)
-    Nparts = write_releases_file(config_xmlpath,wdir)
-    write_ageclasses_file(config_xmlpath,wdir)
-
-    status = copy_source_files(wdir)
-    if status==1:
-        LOGGER.error("Something went wrong...")
-        sys.exit(1)
-
-    write_par_mod_file(config_xmlpath,wdir,Nparts)
+    write_pathnames_file(config,wdir)
+    write_command_file(config,wdir)
+    write_outgrid_file(config,wdir)
+    write_outgrid_nest_file(config,wdir)
+    write_receptors_file(config,wdir)
+    Nparts = write_releases_file(config,wdir)
+    write_ageclasses_file(config,wdir)
 
-    status = compile_flexpart(wdir)
+    status = install_flexpart(config,wdir,Nparts)
     if status!=0:
         LOGGER.error("Something went wrong...")
-        sys.exit(1)
+        return 1
     
+    if config.staging_dir!="":
+        stage_ECMWF_files(config,wdir)
+    if previous_config is not None and previous_config.staging_dir!="":
+        release_ECMWF_files(previous_config, previous_config.working_dir)
+
     LOGGER.info("Launching FLEXPART")
 
-    status = run_bash_command("./FLEXPART", wdir)
+    status = run_command(["./FLEXPART"], wdir, f"{wdir}/progress.jsonl", get_simulation_seconds(config), stall_timeout)
+    if status!=0:
+        LOGGER.error(f"FLEXPART exited with status {status}")
+        return 1
 
     # output_netcdf = glob.glob(f"{wdir}/output/*.nc")[0]
+    return 0
+
+def write_completed_marker(working_dir: str) -> None:
+    """
+    Writes the marker file telling that the simulation of a working directory has succeeded
+    (see COMPLETED_MARKER_FILENAME)
+    """
+    with open(f"{working_dir}/{COMPLETED_MARKER_FILENAME}", "w") as file:
+        file.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")+"\n")
+
+
+# ===============================================================================================================
+
+
+if __name__=="__main__":
+
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Python code that prepares all FLEXPART inputs and launches a backward FLEXPART simulation for an ACTRIS station based on the user’s configuration file.", 
+                                    formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--config", type=str, nargs="+", help="Filepath to your configuration xml file (or JSON file written by SimulationConfig.to_json).\n"
+                                                              "With several files, the simulations are run one after the other.")
+    parser.add_argument("--stall-timeout", type=float, default=FLEXPART_STALL_TIMEOUT,
+                        help=f"Seconds without FLEXPART time step after which the run is killed (default: {FLEXPART_STALL_TIMEOUT}, 0 to disable)")
+    subparsers = parser.add_subparsers(dest="mode")
+    plan_parser = subparsers.add_parser("plan", formatter_class=argparse.RawTextHelpFormatter,
+                                        help="Prepares the working directories of the simulations of many stations and dates\n"
+                                             "and writes a job manifest, without running FLEXPART.")
+    plan_parser.add_argument("--config", type=str, required=True, help="Configuration file (xml or JSON) with the options shared by all simulations;\n"
+                                                                       "simulation dates, releases and working directory are replaced.")
+    plan_parser.add_argument("--start", type=str, required=True, help="First simulation date, YYYYMMDDHH")
+    plan_parser.add_argument("--end", type=str, required=True, help="Last simulation date, YYYYMMDDHH")
+    plan_parser.add_argument("--step", type=int, default=24, help="Hours between two simulation dates (default: 24)")
+    plan_parser.add_argument("--days", type=int, default=10, help="Length of the backward simulations in days (default: 10)")
+    plan_parser.add_argument("--stations", type=str, nargs="+", help="Short ID names of the stations (default: all stations)")
+    plan_parser.add_argument("--stations-conf", type=str, required=True, help="JSON stations configuration file")
+    plan_parser.add_argument("--root-wdir", type=str, required=True, help="Root of the working directories")
+    plan_parser.add_argument("--flexpart-out-dir", type=str, help="Directory of the FLEXPART outputs (default: FLEXPART_OUT_DIR of --paths-conf)")
+    plan_parser.add_argument("--paths-conf", type=str, help="Processing configuration file (actris-processing.conf) whose FLEXPART_OUT_DIR\n"
+                                                            "is the directory of the FLEXPART outputs, as for SOFT-IO and footprints")
+    plan_parser.add_argument("--manifest", type=str, help="Job manifest to write (default: <root-wdir>/manifest-<start>-<end>.txt)")
+    plan_parser.add_argument("--multi-release", action="store_true", help="One simulation with a release per height per station and date")
+    plan_parser.add_argument("--parts", type=int, help="Number of particles per release (default: release_parts of the station\n"
+                                                        f"in the stations configuration file, or {DEFAULT_RELEASE_PARTS})")
+    plan_parser.add_argument("--output-profile", type=str, choices=list(OUTPUT_PROFILES),
+                             help="Output profile of the simulations (default: the one of the configuration file)")
+    plan_parser.add_argument("--simulatable-only", action="store_true", help="Plans only the dates whose ECMWF files are all available")
+
+    args = parser.parse_args()
+
+    global LOGGER, LOG_FILEPATH
+    LOGGER = None
+
+    if args.mode=="plan":
+        os.makedirs(args.root_wdir, exist_ok=True)
+        LOG_FILEPATH = args.root_wdir+"/actris_plan_"+datetime.datetime.now().strftime("%Y%m%d_%H%M%S")+".log"
+        LOGGER = start_log(LOG_FILEPATH)
+        from stations import load_stations
+        registry = load_stations(args.stations_conf)
+        station_ids = args.stations if args.stations is not None else registry.short_names
+        unknown = [station_id for station_id in station_ids if station_id not in registry]
+        if len(unknown)>0:
+            LOGGER.error(f"Stations {' '.join(unknown)} are not in {args.stations_conf}")
+            sys.exit(1)
+        flexpart_out_dir = args.flexpart_out_dir
+        if args.paths_conf is not None:
+            from production import read_config_file
+            paths_out_dir = read_config_file(args.paths_conf).get("FLEXPART_OUT_DIR")
+            if paths_out_dir is None:
+                LOGGER.error(f"FLEXPART_OUT_DIR is not set in {args.paths_conf}")
+                sys.exit(1)
+            if flexpart_out_dir is not None and os.path.normpath(flexpart_out_dir)!=os.path.normpath(paths_out_dir):
+                LOGGER.error(f"--flexpart-out-dir {flexpart_out_dir} differs from FLEXPART_OUT_DIR of {args.paths_conf} ({paths_out_dir})")
+                sys.exit(1)
+            flexpart_out_dir = paths_out_dir
+        if flexpart_out_dir is None:
+            LOGGER.error("The directory of the FLEXPART outputs is mandatory, give it with --paths-conf or --flexpart-out-dir")
+            sys.exit(1)
+        template = SimulationConfig.from_file(args.config)
+        simu_dates = get_simulation_dates(args.start, args.end, args.step)
+        if args.simulatable_only:
+            index = ENFilesIndex(template.ecmwf_dir).refresh()
+            simulatable_dates = index.get_simulatable_dates(simu_dates, args.days, template.ecmwf_dtime)
+            for simu_date in simu_dates:
+                if simu_date not in simulatable_dates:
+                    LOGGER.warning(f"ECMWF files of {simu_date} are not all available in {template.ecmwf_dir}, it is not planned")
+            simu_dates = simulatable_dates
+        LOGGER.info(f"Planning {len(simu_dates)} dates for the stations {' '.join(station_ids)}")
+        planned_runs = plan_simulations(template, simu_dates, [registry[station_id] for station_id in station_ids],
+                                        args.root_wdir, flexpart_out_dir, args.days, args.multi_release, args.parts,
+                                        args.output_profile)
+        manifest_filepath = args.manifest if args.manifest is not None else f"{args.root_wdir}/manifest-{args.start}-{args.end}.txt"
+        write_manifest(planned_runs, manifest_filepath)
+        LOGGER.info(f"{len(planned_runs)} simulations prepared, job manifest written in {manifest_filepath}")
+        sys.exit(0)
+
+    exit_status     = 0
+    previous_config = None
+    for config_filepath in args.config:
+        try:
+            config = SimulationConfig.from_file(config_filepath)
+        except Exception as error:
+            if LOGGER is None:
+                LOGGER = start_log()
+            LOGGER.error("Cannot read "+config_filepath+": "+repr(error))
+            exit_status = 1
+            # the next simulation cannot reuse the files staged for the previous one
+            if previous_config is not None and previous_config.staging_dir!="":
+                release_ECMWF_files(previous_config, previous_config.working_dir)
+            previous_config = None
+            continue
+        if LOGGER is None:
+            LOG_FILEPATH = config.working_dir+"/actris_"+datetime.datetime.now().strftime("%Y%m%d_%H%M%S")+".log"
+            LOGGER = start_log(LOG_FILEPATH)
+        status = run_simulation(config_filepath, config, previous_config, args.stall_timeout)
+        if status!=0:
+            exit_status = 1
+            # the simulation may have stopped before the files of the previous one were released
+            for staged_config in (previous_config, config):
+                if staged_config is not None and staged_config.staging_dir!="":
+                    release_ECMWF_files(staged_config, staged_config.working_dir)
+            previous_config = None
+        else:
+            write_completed_marker(config.working_dir)
+            previous_config = config
+    if previous_config is not None and previous_config.staging_dir!="":
+        release_ECMWF_files(previous_config, previous_config.working_dir)
+    sys.exit(exit_status)
@@ -6,21 +6,102 @@ import fpsim
 import sys
 import glob
 import os
+import shutil
 import logging
 import json
+import concurrent.futures
+import dask
+import xarray_extras
+from common.filelock import file_lock
+from common.provenance import ProvenanceLedger, get_code_version
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - [%(levelname)s] %(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
 logger = logging.getLogger(__name__)
 
-def apply_softio(flexpart_output: str, softio_output_dir: str, station_short_name: str) -> str:
+# Dimensions along which SOFT-IO results are inserted into the database
+SOFTIO_DIMS = ['em_inv', 'station_id', 'height', 'release_time']
+RELEASE_TIME_CHUNK = 256
+# Variables of the SOFT-IO results which are not kept in the database
+RELEASE_VARS = ["release_lon", "release_lat", "release_pressure", "release_npart"]
+# Emission inventories of SOFT-IO applied by default, and their labels along em_inv; other inventories are
+# labelled by their upper-cased name
+DEFAULT_INVENTORIES = ["gfas", "ceds2"]
+INVENTORY_LABELS = {"gfas": "GFAS", "ceds2": "CEDS"}
+# Steps of SOFT-IO in the provenance ledger, and version of the code applying it
+STEP_SOFTIO = "softio"
+STEP_SOFTIO_DATABASE = "softio-database"
+CODE_VERSION = get_code_version(os.path.abspath(__file__))
+SOFTIO_PREFIX = "softio-"
+
+def get_record_key(url: str) -> str:
+    """
+    This function returns the key of a FLEXPART output, or of its SOFT-IO output, in the provenance ledger:
+    the name <station>-<date>-<height> of the FLEXPART output
+    """
+    name = os.path.splitext(os.path.basename(url))[0]
+    return name[len(SOFTIO_PREFIX):] if name.startswith(SOFTIO_PREFIX) else name
+
+def get_inventory_label(emission_inventory: str) -> str:
+    """
+    This function returns the label of an emission inventory along the em_inv dimension of the SOFT-IO results
+    """
+    return INVENTORY_LABELS.get(emission_inventory, emission_inventory.upper())
+
+def get_co_contrib(fp_ds: xr.Dataset, emission_inventory: str, station_short_name: str, alt: float) -> xr.Dataset:
+    """
+    This function computes the CO contribution of an emission inventory to a FLEXPART output, summed over time
+    and indexed by height, station_id and release_time
+
+    Args:
+        fp_ds              (xr.Dataset): FLEXPART output, as opened by fpsim.open_fp_dataset
+        emission_inventory (str)       : name of the emission inventory in SOFT-IO, e.g. gfas or ceds2
+        station_short_name (str)       : short name of the ACTRIS station
+        alt                (float)     : release height of the FLEXPART output
+
+    Returns:
+        xr.Dataset: CO contribution
+    """
+    logger.info(f"Calculating {get_inventory_label(emission_inventory)} inventory")
+    ds = softio.get_co_contrib(emission_inventory=emission_inventory, fpsim_ds=fp_ds, time_granularity='3h')
+    ds = ds.sum('time').squeeze()
+    return ds.assign_coords({"height": alt,
+                             "station_id": station_short_name}).expand_dims(["height",
+                                                                             "station_id",
+                                                                             "release_time"]).set_coords(["height",
+                                                                                                          "station_id",
+                                                                                                          "release_time"])
+
+def get_inventory_name(label: str) -> str:
+    """
+    This function returns the name in SOFT-IO of an emission inventory from its label along the em_inv dimension
+    """
+    names = {label: name for name, label in INVENTORY_LABELS.items()}
+    return names.get(label, label.lower())
+
+def get_stored_inventories(softio_output_file: str) -> list:
+    """
+    This function returns the names of the emission inventories whose contributions are in a SOFT-IO output file
+    """
+    with xr.open_dataset(softio_output_file) as ds:
+        return [get_inventory_name(label) for label in ds.indexes["em_inv"]]
+
+def apply_softio(flexpart_output: str, softio_output_dir: str, station_short_name: str,
+                 inventories: list = DEFAULT_INVENTORIES, ledger: ProvenanceLedger = None) -> str:
     """
-    This function apply SOFT-IO to the given FLEXPART output.
+    This function apply SOFT-IO to the given FLEXPART output, for each of the given emission inventories.
+    The FLEXPART output is read once and kept in memory for all inventories. An existing SOFT-IO output is
+    kept if it has all the inventories and, with a provenance ledger, if it has been computed from the same
+    FLEXPART output by the same version of this script (SOFT-IO outputs not yet in the ledger are recorded
+    as they are). Otherwise it is recomputed for the given inventories and the ones it already has, so that
+    no contribution is dropped.
 
     Args:
-        flexpart_output   (str) : path to the FLEXPART output netCDF file
-        softio_output_dir (str) : path to the directory where to store the output SOFT-IO file
+        flexpart_output   (str)  : path to the FLEXPART output netCDF file
+        softio_output_dir (str)  : path to the directory where to store the output SOFT-IO file
+        inventories       (list) : names of the emission inventories in SOFT-IO (str)
+        ledger            (ProvenanceLedger): provenance ledger, optional
 
     Returns:
         str: string of the filepath to the soft-io output netcdf file
@@ -30,102 +111,267 @@ def apply_softio(flexpart_output: str, softio_output_dir: str, station_short_nam
     date    = filename.split("-")[1]
     softio_output_file = f"{softio_output_dir}/softio-{filename}"
     logger.info(f"Processing station {station} for the date {date}")
-    if not os.path.exists(softio_output_file):
+    key = get_record_key(flexpart_output)
+    stored_inventories = get_stored_inventories(softio_output_file) if os.path.exists(softio_output_file) else []
+    requested_inventories = set(inventories)
+    inventories = list(inventories) + [inv for inv in stored_inventories if inv not in requested_inventories]
+    params = {"inventories": sorted(inventories)}
+    if ledger is not None and ledger.is_done(STEP_SOFTIO, key, flexpart_output, CODE_VERSION, params, softio_output_file):
+        logger.info(f"SOFT-IO output {softio_output_file} is up to date")
+        return softio_output_file
+    if requested_inventories.issubset(stored_inventories) and \
+            (ledger is None or ledger.get_record(STEP_SOFTIO, key) is None):
+        if ledger is not None:
+            ledger.record(STEP_SOFTIO, key, flexpart_output, CODE_VERSION, softio_output_file, params)
+        return softio_output_file
+    else:
         try:
-            fp_ds = fpsim.open_fp_dataset(flexpart_output)
+            with fpsim.open_fp_dataset(flexpart_output) as fp_ds:
+                fp_ds = fp_ds.load()
             alt   = fp_ds.RELZZ1.values[0]
-            ds_res = xr.Dataset()
-
-            logger.info("Calculating GFAS inventory")
-            gfas_ds = softio.get_co_contrib(emission_inventory="gfas", fpsim_ds=fp_ds, time_granularity='3h')
-            gfas_ds = gfas_ds.sum('time').squeeze()
-            gfas_ds = gfas_ds.assign_coords({"height":alt,
-                                            "station_id": station_short_name}).expand_dims(["height",
-                                                                                "station_id",
-                                                                                "release_time"]).set_coords(["height",
-                                                                                                    "station_id",
-                                                                                                    "release_time"])
-
-            logger.info("Calculating CEDS2 inventory")
-            ceds_ds = softio.get_co_contrib(emission_inventory="ceds2", fpsim_ds=fp_ds, time_granularity='3h')
-            ceds_ds = ceds_ds.sum('time').squeeze()
-            ceds_ds = ceds_ds.assign_coords({"height":alt,
-                                            "station_id": station_short_name}).expand_dims(["height",
-                                                                                "station_id",
-                                                                                "release_time"]).set_coords(["height",
-                                                                                                    "station_id",
-                                                                                                    "release_time"])
-
-            ds_res = xr.concat([gfas_ds, ceds_ds], dim=pd.Index(['GFAS', 'CEDS'], name='em_inv'))
-            
+
+            ds_res = xr.concat([get_co_contrib(fp_ds, inv, station_short_name, alt) for inv in inventories],
+                               dim=pd.Index([get_inventory_label(inv) for inv in inventories], name='em_inv'))
+
             ds_res.to_netcdf(softio_output_file)
+            if ledger is not None:
+                ledger.record(STEP_SOFTIO, key, flexpart_output, CODE_VERSION, softio_output_file, params)
             return softio_output_file
         except Exception as e:
             logger.error(e)
             return ""
-    else:
-        return softio_output_file
 
-def add_to_database(softio_file: str, softio_database: str) -> int:
+def get_softio_encoding(ds: xr.Dataset) -> dict:
     """
-    This function append/insert a SOFT-IO netCDF result to a bigger netCDF ("database") file,
-    where multiple different SOFT-IO results are merged.
+    This function returns the zarr encoding of the SOFT-IO database: chunked by release time, whole along other dimensions
+
+    Args:
+        ds (xr.Dataset): SOFT-IO dataset
+
+    Returns:
+        dict: encoding by variable
+    """
+    encoding = {}
+    for v in list(ds.coords) + list(ds.data_vars):
+        _chunks = dict(ds[v].sizes)
+        if 'release_time' in _chunks:
+            _chunks['release_time'] = RELEASE_TIME_CHUNK
+        encoding[v] = {'chunks': tuple(_chunks.values())}
+    return encoding
+
+def add_to_database(softio_file: str, softio_database: str, ledger: ProvenanceLedger = None) -> int:
+    """
+    This function inserts a SOFT-IO netCDF result into the zarr SOFT-IO database (see add_all_to_database)
 
     Args:
         softio_file     (str) : path to the SOFT-IO output netCDF file
-        softio_database (str) : path to the database file
+        softio_database (str) : path to the zarr database
+        ledger          (ProvenanceLedger): provenance ledger, optional
 
     Returns:
         int: 0 if successful, 1 if error has occured
     """
-    if os.path.exists(softio_database):
-        try:
-            ds_in = xr.open_dataset(softio_file).drop_vars(["release_lon","release_lat","release_pressure","release_npart"])
-            ds_out = xr.open_dataset(softio_database)
-            ds = xr.merge([ds_in, ds_out])
-            ds_in.close()
-            ds_out.close()
-            ds.to_netcdf(softio_database)
-            return 0
-        except Exception as e:
-            logger.error(e)
-            return 1
-    else:
-        try:
-            ds_in = xr.open_dataset(softio_file).drop_vars(["release_lon","release_lat","release_pressure","release_npart"])
-            ds_in.to_netcdf(softio_database)
+    return add_all_to_database([softio_file], softio_database, ledger)
+
+def add_all_to_database(softio_files: list, softio_database: str, ledger: ProvenanceLedger = None) -> int:
+    """
+    This function inserts SOFT-IO netCDF results into the zarr SOFT-IO database, where multiple different
+    SOFT-IO results are merged, in a single write holding the database lock so that concurrent jobs do not
+    write into it at the same time. The database is extended in place along em_inv, station_id, height and
+    release_time, writing only the chunks which contain the new results; it is rewritten as a whole only if
+    the new results do not fit at the end of these dimensions. With a provenance ledger, the results already
+    inserted into the database are skipped.
+
+    Args:
+        softio_files    (list) : paths to the SOFT-IO output netCDF files (str)
+        softio_database (str)  : path to the zarr database
+        ledger          (ProvenanceLedger): provenance ledger, optional
+
+    Returns:
+        int: 0 if successful, 1 if error has occured
+    """
+    if not softio_database.endswith(".zarr"):
+        logger.error(f"The SOFT-IO database must be a zarr store; migrate the netCDF database {softio_database} with --migrate")
+        return 1
+    if ledger is not None:
+        done = [f for f in softio_files
+                if ledger.is_done(STEP_SOFTIO_DATABASE, get_record_key(f), f, CODE_VERSION, output_url=softio_database)]
+        if len(done) > 0:
+            logger.info(f"Skipping {len(done)} SOFT-IO outputs already in the database")
+            softio_files = [f for f in softio_files if f not in done]
+        if len(softio_files) == 0:
             return 0
-        except Exception as e:
-            logger.error(e)
-            return 1
+    try:
+        dss = []
+        for softio_file in softio_files:
+            with xr.open_dataset(softio_file) as ds_in:
+                dss.append(ds_in.drop_vars(RELEASE_VARS, errors="ignore").load())
+        ds_in = xr.merge(dss, join="outer") if len(dss) > 1 else dss[0]
+        with file_lock(f"{softio_database}.lock"):
+            status = xarray_extras.update_zarr_store(ds_in, softio_database, SOFTIO_DIMS,
+                                                     encoding=get_softio_encoding(ds_in))
+        logger.info(f"SOFT-IO database {softio_database} {status}")
+        if ledger is not None:
+            for softio_file in softio_files:
+                ledger.record(STEP_SOFTIO_DATABASE, get_record_key(softio_file), softio_file, CODE_VERSION, softio_database)
+        return 0
+    except Exception as e:
+        logger.error(e)
+        return 1
+
+def migrate_database(netcdf_database: str, softio_database: str) -> int:
+    """
+    This function migrates a netCDF SOFT-IO database, as written by former versions of add_to_database,
+    into a zarr SOFT-IO database. It is read and written release time chunk by release time chunk.
+
+    Args:
+        netcdf_database (str) : path to the netCDF database
+        softio_database (str) : path to the zarr database, which must not exist
+
+    Returns:
+        int: 0 if successful, 1 if error has occured
+    """
+    if os.path.exists(softio_database):
+        logger.error(f"{softio_database} already exists")
+        return 1
+    tmp_softio_database = f"{softio_database}.tmp-{os.getpid()}"
+    try:
+        with xr.open_dataset(netcdf_database, chunks={"release_time": RELEASE_TIME_CHUNK}) as ds:
+            ds = ds.drop_vars(RELEASE_VARS, errors="ignore").sortby(SOFTIO_DIMS)
+            for v in ds.variables:
+                ds[v].encoding = {}
+            ds.to_zarr(store=tmp_softio_database, mode="w", encoding=get_softio_encoding(ds))
+        os.rename(tmp_softio_database, softio_database)
+        logger.info(f"{netcdf_database} migrated into {softio_database}")
+        return 0
+    except Exception as e:
+        logger.error(e)
+        if os.path.exists(tmp_softio_database):
+            shutil.rmtree(tmp_softio_database)
+        return 1
+
+def read_manifest(manifest: str, station_short_name: str = None) -> list:
+    """
+    This function reads a manifest of FLEXPART outputs: one path per line, optionally followed
+    by the short name of the station (separated by whitespaces). Empty lines and lines starting
+    with '#' are ignored.
+
+    Args:
+        manifest           (str): path to the manifest file
+        station_short_name (str): station used for lines without station
+
+    Returns:
+        list: (path to the FLEXPART output, station short name) tuples
+    """
+    flexpart_outputs = []
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            flexpart_outputs.append((fields[0], fields[1] if len(fields) > 1 else station_short_name))
+    return flexpart_outputs
+
+def _init_worker() -> None:
+    # each worker process applies SOFT-IO with a single thread, the parallelism comes from the pool
+    dask.config.set(scheduler='synchronous')
+
+def apply_softio_batch(flexpart_outputs: list, softio_output_dir: str, softio_database: str = None,
+                       inventories: list = DEFAULT_INVENTORIES, workers: int = 1,
+                       ledger: ProvenanceLedger = None) -> int:
+    """
+    This function applies SOFT-IO to many FLEXPART outputs in one process: the outputs are processed in parallel
+    across a pool of workers, and the SOFT-IO results are then inserted all together into the database in a single
+    write. FLEXPART outputs which fail are logged and skipped.
+
+    Args:
+        flexpart_outputs  (list) : (path to the FLEXPART output, station short name) tuples
+        softio_output_dir (str)  : path to the directory where to store the output SOFT-IO files
+        softio_database   (str)  : path to the zarr database, None to not insert the results
+        inventories       (list) : names of the emission inventories in SOFT-IO (str)
+        workers           (int)  : number of worker processes
+        ledger            (ProvenanceLedger): provenance ledger, optional
+
+    Returns:
+        int: number of FLEXPART outputs which failed
+    """
+    softio_files = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(apply_softio, flexpart_output, softio_output_dir, station_short_name, inventories, ledger)
+                   for flexpart_output, station_short_name in flexpart_outputs]
+        for future in concurrent.futures.as_completed(futures):
+            if future.result() != "":
+                softio_files.append(future.result())
+    nb_failed = len(flexpart_outputs) - len(softio_files)
+    logger.info(f"SOFT-IO applied to {len(softio_files)} FLEXPART outputs, {nb_failed} failed")
+    if softio_database is not None and len(softio_files) > 0:
+        logger.info("Adding to the database")
+        if add_all_to_database(softio_files, softio_database, ledger) != 0:
+            return len(flexpart_outputs)
+    return nb_failed
 
 if __name__=="__main__":
     """
     Main function
 
     Args:
-        -f / --file   : path to the FLEXPART output netCDF file
+        -f / --file   : paths to the FLEXPART output netCDF files
+        -m / --manifest : path to a manifest with one FLEXPART output per line, optionally followed
+                          by the short name of the station
         -n / --name   : short name of the ACTRIS station (same as in the JSON configuration file)
         -d / --dir    : path to the directory where to store the output SOFT-IO file
-        -o / --output : path to the SOFT-IO merged database file where to add new data
+        -o / --output : path to the SOFT-IO merged zarr database where to add new data
+        -i / --inventories : names of the emission inventories in SOFT-IO (default: gfas ceds2)
+        -j / --jobs   : number of worker processes applying SOFT-IO
+        --ledger      : path to the provenance ledger; SOFT-IO outputs up to date are neither computed nor inserted again
+        --migrate     : path to a netCDF SOFT-IO database to migrate into the zarr database given by -o, instead of applying SOFT-IO
     """
 
     import argparse
     
     parser = argparse.ArgumentParser(description="Applying SOFT-IO to the FLEXPART output for the ACTRIS stations",
                                      formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("-f", "--file", type=str, help="Path to the FLEXPART output netCDF file")
+    parser.add_argument("-f", "--file", type=str, nargs="+", default=[], help="Paths to the FLEXPART output netCDF files")
+    parser.add_argument("-m", "--manifest", type=str, help="Path to a manifest with one FLEXPART output per line,\noptionally followed by the short name of the station")
     parser.add_argument("-n", "--name", type=str, help="Short name of the ACTRIS station in question")
     parser.add_argument("-d", "--dir", type=str, help="Path to the directory where to store the output SOFT-IO file")
-    parser.add_argument("-o", "--output", type=str, help="Path to the SOFT-IO merged database file where to add new data")
+    parser.add_argument("-o", "--output", type=str, help="Path to the SOFT-IO merged zarr database where to add new data")
+    parser.add_argument("-i", "--inventories", type=str, nargs="+", default=DEFAULT_INVENTORIES,
+                        help=f"Names of the emission inventories in SOFT-IO (default: {' '.join(DEFAULT_INVENTORIES)})")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes applying SOFT-IO (default: 1)")
+    parser.add_argument("--ledger", type=str, help="Path to the provenance ledger (JSON lines); SOFT-IO outputs up to date\n"
+                                                   "are neither computed nor inserted again into the database")
+    parser.add_argument("--migrate", type=str, help="Path to a netCDF SOFT-IO database to migrate into the zarr database\n"
+                                                    "given by -o, instead of applying SOFT-IO")
     args = parser.parse_args()
 
+    if args.migrate is not None:
+        if args.output is None:
+            logger.error("The zarr database (-o) is mandatory for the migration")
+            sys.exit(1)
+        sys.exit(migrate_database(args.migrate, args.output))
+
+    flexpart_outputs = [(f, args.name) for f in args.file]
+    if args.manifest is not None:
+        flexpart_outputs += read_manifest(args.manifest, args.name)
+    if any(station is None for _, station in flexpart_outputs):
+        logger.error("The short name of the station is mandatory, give it with -n or in the manifest")
+        sys.exit(1)
+    missing = [f for f, _ in flexpart_outputs if not os.path.exists(f)]
+    if len(flexpart_outputs) == 0 or len(missing) > 0:
+        logger.error(f"Input FLEXPART file does not exist: {' '.join(missing)}")
+        sys.exit(1)
+
+    ledger = ProvenanceLedger(args.ledger) if args.ledger is not None else None
     logger.info("Calling SOFT-io")
-    if os.path.exists(args.file):
-        softio_file = apply_softio(args.file, args.dir, args.name)
+    if len(flexpart_outputs) == 1:
+        flexpart_output, station_short_name = flexpart_outputs[0]
+        softio_file = apply_softio(flexpart_output, args.dir, station_short_name, args.inventories, ledger)
         if args.output is not None:
             logger.info("Adding to the database")
-            status_code = add_to_database(softio_file, args.output)
+            status_code = add_to_database(softio_file, args.output, ledger)
+            sys.exit(status_code)
     else:
-        logger.error("Input FLEXPART file does not exist")
-        sys.exit(1)
\ No newline at end of file
+        logger.info(f"Processing {len(flexpart_outputs)} FLEXPART outputs with {args.jobs} workers")
+        if apply_softio_batch(flexpart_outputs, args.dir, args.output, args.inventories, args.jobs, ledger) > 0:
+            sys.exit(1)
@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+import pandas as pd
+
+from .utils import check_ENfilename, get_timestamp_for_ENfilename
+from .filelock import file_lock
+from .tempdir import get_tempdir
+
+
+INDEX_VERSION = 1
+DEFAULT_DTIME_HOURS = 3
+
+
+def get_default_index_url(pool_dir):
+    """
+    Returns the default location of the index of an ENFILES pool: a file in common.tempdir.get_tempdir()
+    named after the pool directory (the pool itself is usually a read-only network mount)
+    :param pool_dir: str; path to the directory with ENFILES
+    :return: str
+    """
+    pool_hash = hashlib.sha256(os.path.abspath(pool_dir).encode()).hexdigest()[:16]
+    return str(get_tempdir() / f'enfiles_index_{pool_hash}.json')
+
+
+def get_required_timestamps(start_date, end_date, dtime_hours=DEFAULT_DTIME_HOURS):
+    """
+    Returns the timestamps of the ENFILES required by a FLEXPART simulation, as listed in its AVAILABLE file:
+    from start_date 00:00 to end_date 23:59, every dtime_hours
+    :param start_date: str YYYYMMDD or a timestamp; first day of the simulation
+    :param end_date: str YYYYMMDD or a timestamp; last day of the simulation
+    :param dtime_hours: int; time step of the ENFILES in hours
+    :return: pandas DatetimeIndex
+    """
+    start = pd.Timestamp(start_date).normalize()
+    end = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    return pd.date_range(start, end, freq=f'{dtime_hours}h', inclusive='left')
+
+
+def get_ENfilename_for_timestamp(timestamp, prefix='EN'):
+    return prefix + pd.Timestamp(timestamp).strftime('%y%m%d%H')
+
+
+def get_required_ENfilenames(start_date, end_date, dtime_hours=DEFAULT_DTIME_HOURS):
+    """
+    Returns the names of the ENFILES required by a FLEXPART simulation (see get_required_timestamps)
+    :return: list of str
+    """
+    return [get_ENfilename_for_timestamp(t) for t in get_required_timestamps(start_date, end_date, dtime_hours)]
+
+
+class ENFilesIndex:
+    """
+    A persistent index of a pool of ECMWF ENFILES (e.g. /o3p/ECMWF/ENFILES): for each file, its timestamp
+    (decoded by common.utils.get_timestamp_for_ENfilename), size and modification time. The index is stored
+    as JSON and refreshed incrementally: the pool is scanned (os.scandir) only if its directory was modified
+    since the last refresh, and only new files are stat'ed. Queries by interval then need no access to the pool.
+    """
+
+    def __init__(self, pool_dir, index_url=None):
+        """
+        :param pool_dir: str; path to the directory with ENFILES
+        :param index_url: str; path to the JSON index; default get_default_index_url(pool_dir)
+        """
+        self.pool_dir = str(pool_dir)
+        self.index_url = str(index_url) if index_url is not None else get_default_index_url(pool_dir)
+        self._pool_mtime = None
+        self._files = {}
+        self._timestamps = None
+
+    def _load(self):
+        try:
+            with open(self.index_url) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') != INDEX_VERSION or index.get('pool_dir') != os.path.abspath(self.pool_dir):
+            return
+        self._pool_mtime = index['pool_mtime']
+        self._files = index['files']
+        self._timestamps = None
+
+    def _store(self):
+        index = {
+            'version': INDEX_VERSION,
+            'pool_dir': os.path.abspath(self.pool_dir),
+            'pool_mtime': self._pool_mtime,
+            'files': self._files,
+        }
+        tmp_url = f'{self.index_url}.tmp-{os.getpid()}'
+        with open(tmp_url, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_url, self.index_url)
+
+    def refresh(self, full=False):
+        """
+        Bring the index up to date with the pool. Concurrent refreshes of the same index are serialized
+        on a lock file.
+        :param full: bool; if True, stat all files of the pool again (e.g. after files were rewritten in place)
+        :return: self
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_url)), exist_ok=True)
+        with file_lock(f'{self.index_url}.lock'):
+            self._load()
+            pool_mtime = os.stat(self.pool_dir).st_mtime
+            if not full and pool_mtime == self._pool_mtime:
+                return self
+            files = {}
+            with os.scandir(self.pool_dir) as it:
+                for entry in it:
+                    if not check_ENfilename(entry.name):
+                        continue
+                    if not full and entry.name in self._files:
+                        files[entry.name] = self._files[entry.name]
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files[entry.name] = {
+                        'timestamp': get_timestamp_for_ENfilename(entry.name).isoformat(),
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                    }
+            self._files = files
+            self._pool_mtime = pool_mtime
+            self._timestamps = None
+            self._store()
+        return self
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, filename):
+        return filename in self._files
+
+    def get_file_info(self, filename):
+        """
+        :param filename: str; ENFILE name, e.g. EN24050100
+        :return: dict with keys timestamp (pandas Timestamp), size (int, bytes) and mtime (float)
+        """
+        info = self._files[filename]
+        return {'timestamp': pd.Timestamp(info['timestamp']), 'size': info['size'], 'mtime': info['mtime']}
+
+    def get_timestamps(self):
+        """
+        :return: pandas Series of the ENFILE names indexed by their timestamps, sorted
+        """
+        if self._timestamps is None:
+            self._timestamps = pd.Series(
+                list(self._files),
+                index=pd.DatetimeIndex([info['timestamp'] for info in self._files.values()]),
+                dtype=object
+            ).sort_index()
+        return self._timestamps
+
+    def query(self, start, end):
+        """
+        Get the ENFILES of a time interval
+        :param start: a timestamp; start of the interval, included
+        :param end: a timestamp; end of the interval, included
+        :return: list of ENFILE names, sorted by timestamp
+        """
+        timestamps = self.get_timestamps()
+        return list(timestamps.loc[pd.Timestamp(start):pd.Timestamp(end)])
+
+    def get_missing(self, start_date, end_date, dtime_hours=DEFAULT_DTIME_HOURS):
+        """
+        Get the ENFILES required by a FLEXPART simulation (see get_required_timestamps) which are not in the pool
+        :return: list of ENFILE names
+        """
+        return [filename for filename in get_required_ENfilenames(start_date, end_date, dtime_hours)
+                if filename not in self._files]
+
+    def is_complete(self, start_date, end_date, dtime_hours=DEFAULT_DTIME_HOURS):
+        return len(self.get_missing(start_date, end_date, dtime_hours)) == 0
+
+    def get_simulatable_dates(self, simu_dates, n_days, dtime_hours=DEFAULT_DTIME_HOURS):
+        """
+        Select the simulation dates of backward simulations of n_days days whose ENFILES are all in the pool
+        :param simu_dates: iterable of str YYYYMMDDHH; simulation dates
+        :param n_days: int; length of the simulations in days
+        :param dtime_hours: int; time step of the ENFILES in hours
+        :return: list of str YYYYMMDDHH
+        """
+        available = set(self._files)
+        simulatable = []
+        for simu_date in simu_dates:
+            end = pd.Timestamp(simu_date[:8])
+            required = get_required_timestamps(end - pd.Timedelta(days=n_days), end, dtime_hours)
+            if all(get_ENfilename_for_timestamp(t) in available for t in required):
+                simulatable.append(simu_date)
+        return simulatable
+
+    def get_latest_simulatable_date(self, n_days, hours=(0, 12), dtime_hours=DEFAULT_DTIME_HOURS):
+        """
+        Get the latest simulation date whose ENFILES are all in the pool, i.e. which can be simulated now
+        :param n_days: int; length of the simulations in days
+        :param hours: tuple of int; simulation hours of the production
+        :param dtime_hours: int; time step of the ENFILES in hours
+        :return: str YYYYMMDDHH, or None if there is no such date
+        """
+        timestamps = self.get_timestamps()
+        if len(timestamps) == 0:
+            return None
+        day = timestamps.index[-1].normalize()
+        while day - pd.Timedelta(days=n_days) >= timestamps.index[0].normalize():
+            simu_dates = [day.strftime('%Y%m%d') + f'{hour:02d}' for hour in sorted(hours, reverse=True)]
+            simulatable = self.get_simulatable_dates(simu_dates, n_days, dtime_hours)
+            if len(simulatable) > 0:
+                return simulatable[0]
+            day -= pd.Timedelta(days=1)
+        return None
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ENFilesStagingCache:
+    """
+    A cache of ENFILES in a node-local directory, shared by the FLEXPART simulations running on the node, so
+    that the ENFILES of a pool on network storage are read once per node. Files are copied from the pool (or
+    hard-linked, if the cache is on the same filesystem) when a simulation acquires them. Each file records
+    the simulations (holders) which use it; files used by no simulation are evicted, least recently used first,
+    when the total size of the cache exceeds max_size. The state of the cache is stored as JSON in the cache
+    directory and updated under a lock, since several processes share it.
+
+    For consecutive simulation dates, the files of the next simulation are acquired before those of the previous
+    one are released: the files common to both windows stay staged, only the new files are fetched and, if the
+    cache is too large, the files falling out of the window are evicted first.
+    """
+
+    STATE_FILENAME = '.staging_state.json'
+    LOCK_FILENAME = '.staging.lock'
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param cache_dir: str; node-local directory of the cache
+        :param max_size: int; maximum total size of the cache in bytes, None for no limit
+        """
+        self.cache_dir = str(cache_dir)
+        self.max_size = max_size
+
+    @property
+    def _state_url(self):
+        return os.path.join(self.cache_dir, self.STATE_FILENAME)
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with file_lock(os.path.join(self.cache_dir, self.LOCK_FILENAME)):
+            try:
+                with open(self._state_url) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {'files': {}}
+            # holders which died without releasing their files (e.g. killed jobs)
+            for info in state['files'].values():
+                info['holders'] = {holder: pid for holder, pid in info['holders'].items() if _is_process_alive(pid)}
+            yield state
+            tmp_url = f'{self._state_url}.tmp-{os.getpid()}'
+            with open(tmp_url, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_url, self._state_url)
+
+    def _stage_file(self, pool_dir, filename):
+        url = os.path.join(self.cache_dir, filename)
+        # a file is fetched by a single process, the others wait for it
+        with file_lock(os.path.join(self.cache_dir, f'.{filename}.lock')):
+            if os.path.exists(url):
+                return
+            src_url = os.path.join(pool_dir, filename)
+            tmp_url = f'{url}.tmp-{os.getpid()}'
+            if os.stat(src_url).st_dev == os.stat(self.cache_dir).st_dev:
+                os.link(src_url, tmp_url)
+            else:
+                shutil.copyfile(src_url, tmp_url)
+            os.replace(tmp_url, url)
+
+    def _evict(self, state, window_start=None):
+        if self.max_size is None:
+            return
+        files = state['files']
+        total_size = sum(info['size'] for info in files.values())
+        # files before the time window of the simulation being staged fell out of the window of a sequence of
+        # consecutive simulations and are evicted first, oldest first; then the least recently used ones
+        candidates = sorted(
+            (window_start is None or get_timestamp_for_ENfilename(filename) >= window_start,
+             info['last_used'], filename)
+            for filename, info in files.items() if len(info['holders']) == 0
+        )
+        for _, _, filename in candidates:
+            if total_size <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.cache_dir, filename))
+            total_size -= files.pop(filename)['size']
+
+    def acquire(self, holder, pool_dir, filenames):
+        """
+        Stage ENFILES of a pool for a simulation; they are not evicted until released
+        :param holder: str; ID of the simulation, e.g. its working directory
+        :param pool_dir: str; path to the directory with ENFILES
+        :param filenames: list of str; ENFILE names
+        :return: str; directory with the staged ENFILES (the cache directory)
+        """
+        pid = os.getpid()
+        with self._locked_state() as state:
+            for filename in filenames:
+                info = state['files'].setdefault(filename, {'size': 0, 'last_used': 0., 'holders': {}})
+                info['holders'][holder] = pid
+        for filename in filenames:
+            self._stage_file(pool_dir, filename)
+        with self._locked_state() as state:
+            now = time.time()
+            for filename in filenames:
+                info = state['files'][filename]
+                info['size'] = os.stat(os.path.join(self.cache_dir, filename)).st_size
+                info['last_used'] = now
+            self._evict(state, min(get_timestamp_for_ENfilename(filename) for filename in filenames))
+        return self.cache_dir
+
+    def release(self, holder):
+        """
+        Release the ENFILES staged for a simulation, and evict files if the cache is too large
+        :param holder: str; ID of the simulation given to acquire
+        """
+        with self._locked_state() as state:
+            for info in state['files'].values():
+                info['holders'].pop(holder, None)
+            self._evict(state)
+
+    @contextlib.contextmanager
+    def staged(self, holder, pool_dir, filenames):
+        """
+        Context manager version of acquire/release
+        """
+        try:
+            yield self.acquire(holder, pool_dir, filenames)
+        finally:
+            self.release(holder)
@@ -0,0 +1,18 @@
+import contextlib
+import fcntl
+
+
+@contextlib.contextmanager
+def file_lock(url, shared=False):
+    """
+    Hold an advisory lock (flock) on a file for the duration of a with-block; the file is created if necessary.
+    Blocks until the lock is acquired.
+    :param url: path to a lock file
+    :param shared: bool; if True, take a shared lock (several holders allowed), otherwise an exclusive one
+    """
+    with open(url, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
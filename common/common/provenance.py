@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import datetime
+
+from .filelock import file_lock
+
+
+HASH_BLOCK_SIZE = 2 ** 24
+
+
+def get_file_sha256(url):
+    """
+    Compute the sha256 hash code of the content of a file; a directory (e.g. a zarr store) is hashed through
+    the relative paths and contents of its files
+    :param url: path to a file or a directory
+    :return: str
+    """
+    h = hashlib.sha256()
+    if os.path.isdir(url):
+        urls = sorted(os.path.join(root, f) for root, _, files in os.walk(url) for f in files)
+    else:
+        urls = [url]
+    for file_url in urls:
+        if file_url != url:
+            h.update(os.path.relpath(file_url, url).encode())
+        with open(file_url, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def get_code_version(*urls):
+    """
+    Get a version of the code producing an output: a short hash code of the source files which produce it,
+    so that outputs are recomputed once the code changes
+    :param urls: paths to source files
+    :return: str
+    """
+    h = hashlib.sha256()
+    for url in urls:
+        with open(url, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+class ProvenanceLedger:
+    """
+    A ledger of the outputs of processing steps, in a JSON lines file: one record per line, appended under a file
+    lock so that concurrent jobs can share it. A record tells that a step (e.g. 'softio') produced an output from
+    an input file with a given version of the code and given parameters, for a key (e.g. station, date and height).
+    The last record of a step and a key is the one in force.
+    """
+    def __init__(self, url):
+        """
+        :param url: path to the JSON lines file; created if necessary
+        """
+        self.url = url
+        self._records = None
+        self._records_mtime = None
+
+    def _lock(self):
+        return file_lock(f'{self.url}.lock')
+
+    def _read(self):
+        # last record by step and key, read again if the ledger has changed since
+        if not os.path.exists(self.url):
+            return {}
+        mtime = os.stat(self.url).st_mtime_ns
+        if self._records is None or self._records_mtime != mtime:
+            records = {}
+            with open(self.url) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line truncated by an interrupted write
+                        continue
+                    records[(record['step'], record['key'])] = record
+            self._records, self._records_mtime = records, mtime
+        return self._records
+
+    def get_record(self, step, key):
+        """
+        Get the record in force of a step and a key
+        :param step: str; name of the processing step
+        :param key: str; key of the record, e.g. <station>-<date>-<height>
+        :return: dict, or None if there is no record
+        """
+        return self._read().get((step, key))
+
+    def is_done(self, step, key, input_url, code_version, params=None, output_url=None):
+        """
+        Check if a step has already produced its output for a key from the same input, with the same version of the
+        code and the same parameters, and if this output still exists. The input is compared by its size and
+        modification time first; if only its modification time has changed, it is compared by its sha256 hash code.
+        :param step: str; name of the processing step
+        :param key: str; key of the record, e.g. <station>-<date>-<height>
+        :param input_url: str; path to the input file
+        :param code_version: str; version of the code (see get_code_version)
+        :param params: dict, optional; parameters of the step (JSON serializable)
+        :param output_url: str, optional; path to the output, default the one of the record
+        :return: bool
+        """
+        record = self.get_record(step, key)
+        if record is None or record['code_version'] != code_version or record.get('params') != params:
+            return False
+        output_url = os.path.abspath(output_url) if output_url is not None else record['output']
+        if record['output'] != output_url or not os.path.exists(output_url) or not os.path.exists(input_url):
+            return False
+        stat = os.stat(input_url)
+        if stat.st_size != record['input_size']:
+            return False
+        if stat.st_mtime_ns == record['input_mtime_ns']:
+            return True
+        if get_file_sha256(input_url) != record['input_sha256']:
+            return False
+        # the input has only been touched: record its modification time, so that it is not hashed again
+        self._append([dict(record, input_mtime_ns=stat.st_mtime_ns)])
+        return True
+
+    def record(self, step, key, input_url, code_version, output_url, params=None, input_sha256=None):
+        """
+        Record that a step has produced its output for a key
+        :param step: str; name of the processing step
+        :param key: str; key of the record, e.g. <station>-<date>-<height>
+        :param input_url: str; path to the input file
+        :param code_version: str; version of the code (see get_code_version)
+        :param output_url: str; path to the output
+        :param params: dict, optional; parameters of the step (JSON serializable)
+        :param input_sha256: str, optional; sha256 hash code of the input file, computed if not given
+        :return: dict; the record
+        """
+        stat = os.stat(input_url)
+        record = {
+            'step': step,
+            'key': key,
+            'input': os.path.abspath(input_url),
+            'input_size': stat.st_size,
+            'input_mtime_ns': stat.st_mtime_ns,
+            'input_sha256': input_sha256 if input_sha256 is not None else get_file_sha256(input_url),
+            'code_version': code_version,
+            'params': params,
+            'output': os.path.abspath(output_url),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        }
+        self._append([record])
+        return record
+
+    def relocate(self, step, output_url, new_output_url):
+        """
+        Record that the outputs of a step have moved, e.g. from a staged fragment into a database: the records in force
+        of the step whose output is output_url are recorded again with new_output_url
+        :param step: str; name of the processing step
+        :param output_url: str; path to the former output
+        :param new_output_url: str; path to the new output
+        :return: int; number of relocated records
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        output_url, new_output_url = os.path.abspath(output_url), os.path.abspath(new_output_url)
+        records = [dict(record, output=new_output_url, time=now) for (record_step, _), record in self._read().items()
+                   if record_step == step and record['output'] == output_url]
+        self._append(records)
+        return len(records)
+
+    def _append(self, records):
+        if len(records) == 0:
+            return
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        os.makedirs(os.path.dirname(os.path.abspath(self.url)), exist_ok=True)
+        with self._lock():
+            with open(self.url, 'a+') as f:
+                # complete a line truncated by an interrupted write, which is then skipped when read
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != '\n':
+                        lines = '\n' + lines
+                f.write(lines)
@@ -0,0 +1,71 @@
+import os
+import sys
+import logging
+
+import fpout
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - [%(levelname)s] %(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def compact_flexpart_output(flexpart_output: str, profile) -> list:
+    """
+    This function compacts a FLEXPART output and its nested output, if any, in place, as set by the output
+    profile of its simulation
+
+    Args:
+        flexpart_output (str)                 : path to the FLEXPART output netCDF file
+        profile         (actris.OutputProfile): output profile of the simulation
+
+    Returns:
+        list: paths to the compacted files, empty if the profile keeps the output as written by FLEXPART
+    """
+    if not profile.compact:
+        return []
+    compacted = []
+    for url in (flexpart_output, fpout.get_nest_url(flexpart_output)):
+        if not os.path.exists(url):
+            continue
+        size = os.path.getsize(url)
+        fpout.compact(url, sum_height=profile.sum_height)
+        logger.info(f"{url} compacted from {size/1e6:.1f} MB to {os.path.getsize(url)/1e6:.1f} MB")
+        compacted.append(url)
+    return compacted
+
+if __name__ == '__main__':
+    """
+    Main function
+
+    Args:
+        -f / --file    : path to the native FLEXPART output netCDF file, compacted in place
+        -c / --config  : configuration file (xml or JSON) of the simulation, which sets the output profile
+        -p / --profile : output profile, instead of the one of the configuration file
+    """
+
+    import argparse
+
+    sys.path.insert(0, SRC_DIR)
+    from actris import OUTPUT_PROFILES, SimulationConfig
+
+    parser = argparse.ArgumentParser(description="Compacting a FLEXPART output as set by the output profile of its simulation",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--file", type=str, required=True, help="Path to the FLEXPART output netCDF file, compacted in place")
+    parser.add_argument("-c", "--config", type=str, help="Configuration file (xml or JSON) of the simulation")
+    parser.add_argument("-p", "--profile", type=str, choices=list(OUTPUT_PROFILES), help="Output profile, instead of the one of the configuration file")
+    args = parser.parse_args()
+
+    if args.profile is None and args.config is None:
+        logger.error("The configuration file or the output profile is mandatory")
+        sys.exit(1)
+    if not os.path.exists(args.file):
+        logger.error("Input FLEXPART file does not exist")
+        sys.exit(1)
+    profile_name = args.profile if args.profile is not None else SimulationConfig.from_file(args.config).output_profile
+    if profile_name not in OUTPUT_PROFILES:
+        logger.error(f"Output profile {profile_name} is unknown, use one of {', '.join(OUTPUT_PROFILES)}")
+        sys.exit(1)
+    if len(compact_flexpart_output(args.file, OUTPUT_PROFILES[profile_name])) == 0:
+        logger.info(f"Output profile {profile_name}: {args.file} is kept as written by FLEXPART")
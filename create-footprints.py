@@ -4,10 +4,17 @@ import pandas as pd
 import logging
 import os
 import sys
+import glob
+import shutil
+import concurrent.futures
+import dask
 
 # sys.path.append('/usr/local/footprints/')
 
 import fpout
+import xarray_extras
+from common.filelock import file_lock
+from common.provenance import ProvenanceLedger, get_code_version, get_file_sha256
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - [%(levelname)s] %(message)s',
@@ -16,24 +23,83 @@ logger = logging.getLogger(__name__)
 
 IDX_CHUNK = 160
 IDX_CHUNK_FOR_COORDS = IDX_CHUNK * 40
+FOOTPRINTS_DIMS = ['time', 'station_id', 'height']
+# grid of the footprints database: the one of the global output of the simulations, into which the regional and
+# nested outputs are embedded
+FOOTPRINTS_GRID = fpout.get_global_grid(resolution=1.)
+# step of the footprints in the provenance ledger, and version of the code computing them
+STEP_FOOTPRINTS = 'footprints'
+CODE_VERSION = get_code_version(os.path.abspath(__file__))
 
-def get_footprint_data(flexpart_output: str, station_short_name: str) -> xr.Dataset :
+def get_record_key(flexpart_output: str) -> str:
     """
-    This function computes footprint image from the FLEXPART output
+    This function returns the key of a FLEXPART output in the provenance ledger: its name <station>-<date>-<height>
+    """
+    return os.path.splitext(os.path.basename(flexpart_output))[0]
+
+def is_done(ledger: ProvenanceLedger, flexpart_output: str, output_file_with_footprints: str) -> bool:
+    """
+    This function checks in the provenance ledger if the footprint of a FLEXPART output has already been written into
+    the footprints database, from the same FLEXPART output and with the same version of this script
+    """
+    return ledger.is_done(STEP_FOOTPRINTS, get_record_key(flexpart_output), flexpart_output, CODE_VERSION,
+                          output_url=output_file_with_footprints)
+
+def get_res_time(flexpart_output: str, streaming: bool = False) -> xr.DataArray:
+    """
+    This function computes the residence time of a FLEXPART output, summed over time and height and averaged over releases
 
     Args:
-        flexpart_output (str): path to the FLEXPART output netCDF file
+        flexpart_output (str) : path to the FLEXPART output netCDF file (or to its nested output)
+        streaming       (bool): if True, residence time is summed time step by time step by
+                                fpout.sum_over_time_and_height, with memory bounded by one time step,
+                                instead of being reduced by dask
+
+    Returns:
+        xr.DataArray: residence time on the longitude-latitude grid of the FLEXPART output
+    """
+    if streaming:
+        return fpout.sum_over_time_and_height(flexpart_output)
+    with xarray_extras.open_dataset_with_disk_chunks(flexpart_output, max_chunk_size=1e8, engine='h5netcdf') as _ds:
+        res_time = _ds['spec001_mr'].sum('height').squeeze(['nageclass']).mean('pointspec').sum('time')
+        res_time = res_time.reset_coords(drop=True).compute()
+    return res_time.geo.normalize_longitude(keep_attrs=True)
+
+def get_footprint_data(flexpart_output: str, station_short_name: str, streaming: bool = False) -> xr.Dataset :
+    """
+    This function computes footprint image from the FLEXPART output. Regional outputs are embedded into the
+    global footprints grid (FOOTPRINTS_GRID), zero outside of their domain, and the nested output of the FLEXPART
+    output, if any, replaces the output over its domain.
+
+    Args:
+        flexpart_output (str) : path to the FLEXPART output netCDF file
+        streaming       (bool): if True, residence time is summed time step by time step by
+                                fpout.sum_over_time_and_height, with memory bounded by one time step,
+                                instead of being reduced by dask
 
     Returns:
         xr.Dataset: computed footprint in the xarray.Dataset format
     """
-    with fpout.open_dataset(flexpart_output, max_chunk_size=1e8) as _ds:
-        da = _ds['spec001_mr']
+    with fpout.open_dataset(flexpart_output, max_chunk_size=1e8, res_time_in_sec=False) as _ds:
         t = _ds['release_time'][0].dt.round("h").values.astype('M8[ns]')
         station_code = station_short_name
-        res_time = da.sum('height').squeeze(['nageclass']).mean('pointspec')
-        res_time_norm = res_time
-        res_time_per_km2 = res_time_norm.sum('time') / res_time_norm['area'] * 1e6
+        nest_output = fpout.get_nest_url(flexpart_output)
+        if fpout.is_same_grid(_ds['area'], FOOTPRINTS_GRID) and not os.path.exists(nest_output):
+            if streaming:
+                res_time = fpout.sum_over_time_and_height(flexpart_output)
+                res_time_per_km2 = res_time / _ds['area'] * 1e6
+            else:
+                da = _ds['spec001_mr']
+                res_time = da.sum('height').squeeze(['nageclass']).mean('pointspec')
+                res_time_norm = res_time
+                res_time_per_km2 = res_time_norm.sum('time') / res_time_norm['area'] * 1e6
+        else:
+            res_time = fpout.embed_into_grid(get_res_time(flexpart_output, streaming), FOOTPRINTS_GRID)
+            if os.path.exists(nest_output):
+                nest_res_time = get_res_time(nest_output, streaming)
+                res_time = xr.where(fpout.get_domain_mask(nest_res_time, FOOTPRINTS_GRID),
+                                    fpout.embed_into_grid(nest_res_time, FOOTPRINTS_GRID), res_time)
+            res_time_per_km2 = res_time / fpout.get_pixel_area_for_grid(FOOTPRINTS_GRID) * 1e6
         res_time_per_km2 = res_time_per_km2.reset_coords(drop=True).astype('f2')
         res_time_per_km2 = res_time_per_km2.compute()
         alt = _ds.RELZZ1.values[0]
@@ -44,49 +110,300 @@ def get_footprint_data(flexpart_output: str, station_short_name: str) -> xr.Data
         output = output.expand_dims(['time', 'station_id', 'height']).set_coords(['time', 'station_id', 'height'])
     return output
 
-def create_footprints(flexpart_output: str, output_file_with_footprints: str, station_short_name: str) -> None:
+def get_footprints_encoding(ds: xr.Dataset) -> dict:
+    """
+    This function returns the zarr encoding of the footprints database: chunked by time, whole along other dimensions
+
+    Args:
+        ds (xr.Dataset): footprints dataset
+
+    Returns:
+        dict: encoding by variable
+    """
+    encoding = {}
+    for v in list(ds.coords) + list(ds.data_vars):
+        _chunks = dict(ds[v].sizes)
+        if 'time' in _chunks:
+            _chunks['time'] = IDX_CHUNK if v == 'res_time_per_km2' else IDX_CHUNK_FOR_COORDS
+        encoding[v] = {'chunks': tuple(_chunks.values())}
+    return encoding
+
+def write_to_database(ds: xr.Dataset, output_file_with_footprints: str) -> None:
+    """
+    This function writes footprints into the footprints database, holding the database lock
+    so that concurrent jobs do not write into it at the same time. The database is extended in
+    place along time, station_id and height, writing only the chunks which contain the new
+    footprints; it is rewritten as a whole only if the new footprints do not fit at the end of
+    these dimensions.
+
+    Args:
+        ds                          (xr.Dataset): footprints to write
+        output_file_with_footprints (str)       : path to the zarr merged database with footprints
+    """
+    with file_lock(f"{output_file_with_footprints}.lock"):
+        status = xarray_extras.update_zarr_store(ds, output_file_with_footprints, FOOTPRINTS_DIMS,
+                                                 encoding=get_footprints_encoding(ds))
+    logger.info(f"Footprints database {output_file_with_footprints} {status}")
+
+def create_footprints(flexpart_output: str, output_file_with_footprints: str, station_short_name: str,
+                      streaming: bool = False, ledger: ProvenanceLedger = None) -> None:
     """
     This function merges the new footprint with the bigger footprints database of
     other simulations
 
     Args:
-        flexpart_output             (str): path to the FLEXPART output netCDF file
-        output_file_with_footprints (str): path to the zarr merged database with footprints
+        flexpart_output             (str) : path to the FLEXPART output netCDF file
+        output_file_with_footprints (str) : path to the zarr merged database with footprints
+        streaming                   (bool): if True, use the streaming reduction of the FLEXPART output
+        ledger                      (ProvenanceLedger): provenance ledger where to record the footprint, optional
     """
     logger.info(f"Creating footprint from file {flexpart_output}")
-    ds = get_footprint_data(flexpart_output, station_short_name)
-    if os.path.exists(output_file_with_footprints):
-        with xr.open_zarr(output_file_with_footprints) as zarr_ds:
-            output = xr.merge([zarr_ds, ds], compat="override")
-    else:
-        output = ds
-    encoding = {}
-    for v in list(output.coords) + list(output.data_vars):
-        v_dims = list(output[v].dims)
-        _chunks = dict(zip(v_dims, (-1,) * len(v_dims)))
-        _chunks['time'] = IDX_CHUNK if v == 'res_time_per_km2' else IDX_CHUNK_FOR_COORDS
-        encoding[v] = {'chunks': tuple(_chunks.values())}
-    with output.to_zarr(store=output_file_with_footprints, mode='w', encoding=encoding) as _store:
-        pass
+    ds = get_footprint_data(flexpart_output, station_short_name, streaming)
+    write_to_database(ds, output_file_with_footprints)
+    if ledger is not None:
+        ledger.record(STEP_FOOTPRINTS, get_record_key(flexpart_output), flexpart_output, CODE_VERSION,
+                      output_file_with_footprints)
+
+def stage_footprints(flexpart_output: str, staging_dir: str, station_short_name: str,
+                     streaming: bool = False, ledger: ProvenanceLedger = None) -> str:
+    """
+    This function writes the new footprint as a standalone zarr fragment into the staging
+    directory, to be merged later into the database by consolidate_footprints. The fragment
+    is named after its station, time and height, so that a re-staged footprint replaces the
+    pending one.
+
+    Args:
+        flexpart_output (str) : path to the FLEXPART output netCDF file
+        staging_dir     (str) : path to the directory with pending footprints fragments
+        streaming       (bool): if True, use the streaming reduction of the FLEXPART output
+        ledger          (ProvenanceLedger): provenance ledger where to record the fragment, optional;
+                                the record is moved to the database by consolidate_footprints
+
+    Returns:
+        str: path to the zarr fragment
+    """
+    logger.info(f"Creating footprint from file {flexpart_output}")
+    ds = get_footprint_data(flexpart_output, station_short_name, streaming)
+    t = pd.Timestamp(ds['time'].values[0]).strftime('%Y%m%d%H')
+    fragment = f"{staging_dir}/{ds['station_id'].values[0]}-{t}-{ds['height'].values[0]:g}.zarr"
+    tmp_fragment = f"{fragment}.tmp-{os.getpid()}"
+    os.makedirs(staging_dir, exist_ok=True)
+    ds.to_zarr(store=tmp_fragment, mode='w', encoding=get_footprints_encoding(ds))
+    if os.path.exists(fragment):
+        shutil.rmtree(fragment)
+    os.rename(tmp_fragment, fragment)
+    logger.info(f"Footprint staged in {fragment}")
+    if ledger is not None:
+        ledger.record(STEP_FOOTPRINTS, get_record_key(flexpart_output), flexpart_output, CODE_VERSION, fragment)
+    return fragment
+
+def consolidate_footprints(staging_dir: str, output_file_with_footprints: str, ledger: ProvenanceLedger = None) -> int:
+    """
+    This function merges all pending footprints fragments of the staging directory into the
+    footprints database in one pass and removes them once they are written.
+
+    Args:
+        staging_dir                 (str): path to the directory with pending footprints fragments
+        output_file_with_footprints (str): path to the zarr merged database with footprints
+        ledger                      (ProvenanceLedger): provenance ledger where the fragments are recorded, optional
+
+    Returns:
+        int: number of consolidated fragments
+    """
+    with file_lock(f"{output_file_with_footprints}.lock"):
+        fragments = sorted(glob.glob(f"{staging_dir}/*.zarr"))
+        if len(fragments) == 0:
+            logger.info(f"No pending footprints in {staging_dir}")
+            return 0
+        logger.info(f"Consolidating {len(fragments)} footprints from {staging_dir}")
+        dss = [xr.open_zarr(fragment) for fragment in fragments]
+        try:
+            ds = xr.merge(dss, join='outer').load()
+        finally:
+            for _ds in dss:
+                _ds.close()
+        status = xarray_extras.update_zarr_store(ds, output_file_with_footprints, FOOTPRINTS_DIMS,
+                                                 encoding=get_footprints_encoding(ds))
+        for fragment in fragments:
+            if ledger is not None:
+                ledger.relocate(STEP_FOOTPRINTS, fragment, output_file_with_footprints)
+            shutil.rmtree(fragment)
+    logger.info(f"Footprints database {output_file_with_footprints} {status}")
+    return len(fragments)
+
+def read_manifest(manifest: str, station_short_name: str = None) -> list:
+    """
+    This function reads a manifest of FLEXPART outputs: one path per line, optionally followed
+    by the short name of the station (separated by whitespaces). Empty lines and lines starting
+    with '#' are ignored.
+
+    Args:
+        manifest           (str): path to the manifest file
+        station_short_name (str): station used for lines without station
+
+    Returns:
+        list: (path to the FLEXPART output, station short name) tuples
+    """
+    flexpart_outputs = []
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            flexpart_outputs.append((fields[0], fields[1] if len(fields) > 1 else station_short_name))
+    return flexpart_outputs
+
+def expand_flexpart_outputs(patterns: list, station_short_name: str) -> list:
+    """
+    This function expands paths and glob patterns of FLEXPART outputs
+
+    Args:
+        patterns           (list): paths or glob patterns of the FLEXPART output netCDF files
+        station_short_name (str) : short name of the ACTRIS station
+
+    Returns:
+        list: (path to the FLEXPART output, station short name) tuples
+    """
+    flexpart_outputs = []
+    for pattern in patterns:
+        # nested outputs are read along with their FLEXPART output
+        files = sorted(f for f in glob.glob(pattern) if not fpout.is_nest_url(f)) if glob.has_magic(pattern) else [pattern]
+        if len(files) == 0:
+            logger.warning(f"No FLEXPART output matches {pattern}")
+        flexpart_outputs.extend((f, station_short_name) for f in files)
+    return flexpart_outputs
+
+def _init_worker() -> None:
+    # each worker process computes its footprints with a single thread, the parallelism comes from the pool
+    dask.config.set(scheduler='synchronous')
+
+def get_footprint_data_with_hash(flexpart_output: str, station_short_name: str, streaming: bool = False) -> tuple:
+    """
+    This function computes footprint image from the FLEXPART output (see get_footprint_data), together with the
+    sha256 hash code of the FLEXPART output, to be recorded in the provenance ledger
+
+    Returns:
+        tuple: computed footprint (xr.Dataset) and hash code (str)
+    """
+    return get_footprint_data(flexpart_output, station_short_name, streaming), get_file_sha256(flexpart_output)
+
+def create_footprints_batch(flexpart_outputs: list, output_file_with_footprints: str = None,
+                            staging_dir: str = None, workers: int = 1, streaming: bool = False,
+                            ledger: ProvenanceLedger = None) -> int:
+    """
+    This function computes footprints of many FLEXPART outputs in one process, in parallel
+    across a pool of workers. Footprints are either merged all together into the footprints
+    database in a single write, or staged as fragments if a staging directory is given.
+    FLEXPART outputs which fail are logged and skipped.
+
+    Args:
+        flexpart_outputs            (list): (path to the FLEXPART output, station short name) tuples
+        output_file_with_footprints (str) : path to the zarr merged database with footprints
+        staging_dir                 (str) : path to the directory with pending footprints fragments
+        workers                     (int) : number of worker processes
+        streaming                   (bool): if True, use the streaming reduction of the FLEXPART outputs
+        ledger                      (ProvenanceLedger): provenance ledger where to record the footprints, optional
+
+    Returns:
+        int: number of FLEXPART outputs which failed
+    """
+    footprints = []
+    hashes = {}
+    nb_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {}
+        for flexpart_output, station_short_name in flexpart_outputs:
+            if staging_dir is not None:
+                future = executor.submit(stage_footprints, flexpart_output, staging_dir, station_short_name, streaming,
+                                         ledger)
+            elif ledger is not None:
+                logger.info(f"Creating footprint from file {flexpart_output}")
+                future = executor.submit(get_footprint_data_with_hash, flexpart_output, station_short_name, streaming)
+            else:
+                logger.info(f"Creating footprint from file {flexpart_output}")
+                future = executor.submit(get_footprint_data, flexpart_output, station_short_name, streaming)
+            futures[future] = flexpart_output
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Footprint from file {futures[future]} failed: {e}")
+                nb_failed += 1
+                continue
+            if staging_dir is None and ledger is not None:
+                result, hashes[futures[future]] = result
+            if staging_dir is None:
+                footprints.append(result)
+    logger.info(f"{len(flexpart_outputs) - nb_failed} footprints computed, {nb_failed} failed")
+    if len(footprints) > 0:
+        write_to_database(xr.merge(footprints, join='outer'), output_file_with_footprints)
+        for flexpart_output, input_sha256 in hashes.items():
+            ledger.record(STEP_FOOTPRINTS, get_record_key(flexpart_output), flexpart_output, CODE_VERSION,
+                          output_file_with_footprints, input_sha256=input_sha256)
+    return nb_failed
 
 if __name__ == '__main__':
     """
     Main function
 
     Args:
-        -f / --file   : path to the FLEXPART output netCDF file
-        -n / --name   : short name of the ACTRIS station (same as in the JSON configuration file)
-        -o / --output : path to the zarr merged database with footprints
+        -f / --file        : paths or glob patterns of the FLEXPART output netCDF files
+        -m / --manifest    : path to a manifest with one FLEXPART output per line, optionally followed
+                             by the short name of the station
+        -n / --name        : short name of the ACTRIS station (same as in the JSON configuration file)
+        -o / --output      : path to the zarr merged database with footprints
+        -s / --staging     : path to the staging directory; if set, footprints are written there as
+                             fragments instead of being merged into the database
+        -c / --consolidate : merge all fragments pending in the staging directory into the database
+        -j / --jobs        : number of worker processes computing footprints
+        --streaming        : reduce FLEXPART outputs time step by time step, with bounded memory
+        --ledger           : path to the provenance ledger; FLEXPART outputs whose footprints are already in
+                             the database, from the same FLEXPART outputs, are skipped
     """
 
     import argparse
     
     parser = argparse.ArgumentParser(description="Computing footprint integrated image from the FLEXPART output",
                                      formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("-f", "--file", type=str, help="Path to the FLEXPART output netCDF file")
+    parser.add_argument("-f", "--file", type=str, nargs='+', default=[], help="Paths or glob patterns of the FLEXPART output netCDF files")
+    parser.add_argument("-m", "--manifest", type=str, help="Path to a manifest with one FLEXPART output per line,\noptionally followed by the short name of the station")
     parser.add_argument("-n", "--name", type=str, help="Short name of the ACTRIS station in question")
     parser.add_argument("-o", "--output", type=str, help="Path to the zarr merged database with footprints")
+    parser.add_argument("-s", "--staging", type=str, help="Path to the staging directory with pending footprints fragments")
+    parser.add_argument("-c", "--consolidate", action="store_true", help="Merge pending footprints fragments into the database")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes computing footprints (default: 1)")
+    parser.add_argument("--streaming", action="store_true", help="Reduce FLEXPART outputs time step by time step, with bounded memory")
+    parser.add_argument("--ledger", type=str, help="Path to the provenance ledger (JSON lines); FLEXPART outputs whose footprints\n"
+                                                   "are already in the database are skipped")
     args = parser.parse_args()
 
-    logger.info(f"Processing {args.file}")
-    create_footprints(args.file, args.output, args.name)
+    if args.consolidate and args.staging is None:
+        logger.error("The staging directory is mandatory to consolidate footprints")
+        sys.exit(1)
+    flexpart_outputs = expand_flexpart_outputs(args.file, args.name)
+    if args.manifest is not None:
+        flexpart_outputs += read_manifest(args.manifest, args.name)
+    if any(station is None for _, station in flexpart_outputs):
+        logger.error("The short name of the station is mandatory, give it with -n or in the manifest")
+        sys.exit(1)
+    ledger = ProvenanceLedger(args.ledger) if args.ledger is not None else None
+    if ledger is not None:
+        done = [f for f, _ in flexpart_outputs if is_done(ledger, f, args.output)]
+        if len(done) > 0:
+            logger.info(f"Skipping {len(done)} FLEXPART outputs whose footprints are already in the database")
+            flexpart_outputs = [(f, station) for f, station in flexpart_outputs if f not in done]
+    status = 0
+    if len(flexpart_outputs) == 1:
+        flexpart_output, station_short_name = flexpart_outputs[0]
+        logger.info(f"Processing {flexpart_output}")
+        if args.staging is not None:
+            stage_footprints(flexpart_output, args.staging, station_short_name, args.streaming, ledger)
+        else:
+            create_footprints(flexpart_output, args.output, station_short_name, args.streaming, ledger)
+    elif len(flexpart_outputs) > 1:
+        logger.info(f"Processing {len(flexpart_outputs)} FLEXPART outputs with {args.jobs} workers")
+        if create_footprints_batch(flexpart_outputs, args.output, args.staging, args.jobs, args.streaming, ledger) > 0:
+            status = 1
+    if args.consolidate:
+        consolidate_footprints(args.staging, args.output, ledger)
+    sys.exit(status)
@@ -4,8 +4,33 @@ from .grid_time import (
     BOTTOM_HEIGHT,
     DELTA_HEIGHT,
     get_pixel_area,
+    get_pixel_area_for_grid,
+    get_orography_for_grid,
+    get_air_density_for_grid,
     open_dataset,
     open_fp_dataset,
     aggregate_in_time,
     rolling_in_time,
 )
+from .releases import (
+    get_release_names,
+    split_by_release,
+)
+from .cache import (
+    set_cache_dir,
+    get_cache_dir,
+)
+from .streaming import (
+    sum_over_time_and_height,
+)
+from .compaction import (
+    compact,
+)
+from .regional import (
+    get_nest_url,
+    is_nest_url,
+    get_global_grid,
+    is_same_grid,
+    embed_into_grid,
+    get_domain_mask,
+)
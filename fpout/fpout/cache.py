@@ -0,0 +1,108 @@
+import os
+import hashlib
+import warnings
+import xarray as xr
+
+import xarray_extras    # noqa
+from common.utils import hash_of_xarray_obj_dim_coords, FixedSizeCacheDict
+from common.tempdir import get_tempdir
+
+
+CACHE_DIR_ENV = 'FPOUT_CACHE_DIR'
+CACHE_SUBDIR = 'fpout_cache'
+IN_MEMORY_CACHE_SIZE = 16
+
+_cache_dir = None
+_in_memory_cache = FixedSizeCacheDict(IN_MEMORY_CACHE_SIZE)
+
+
+def set_cache_dir(path):
+    """
+    Set the directory of the on-disk cache of fields derived from fpout resources (e.g. pixel area regridded
+    to a FLEXPART output grid). If not set, the directory is taken from the environment variable FPOUT_CACHE_DIR,
+    or else it is a sub-directory of common.tempdir.get_tempdir().
+    :param path: str or pathlib.Path; None disables the on-disk cache
+    """
+    global _cache_dir
+    _cache_dir = str(path) if path is not None else ''
+
+
+def get_cache_dir():
+    """
+    Get the directory of the on-disk cache
+    :return: str, or None if the on-disk cache is disabled
+    """
+    global _cache_dir
+    if _cache_dir is None:
+        _cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if _cache_dir is None:
+        try:
+            _cache_dir = str(get_tempdir() / CACHE_SUBDIR)
+        except OSError as e:
+            warnings.warn(f'on-disk cache of fpout is disabled: {e}')
+            _cache_dir = ''
+    return _cache_dir if _cache_dir != '' else None
+
+
+def hash_of_grid(ds, *args):
+    """
+    Returns a hash code of the longitude and latitude coordinates of a dataset, together with extra arguments
+    (e.g. other coordinates or parameters on which a cached field depends)
+    :param ds: an xarray Dataset or DataArray
+    :param args: objects with a stable str representation
+    :return: str
+    """
+    lon_label, lat_label = ds.geo.get_lon_label(), ds.geo.get_lat_label()
+    hash_by_dim = hash_of_xarray_obj_dim_coords(ds)
+    h = hashlib.sha256()
+    for item in (lon_label, hash_by_dim[lon_label], lat_label, hash_by_dim[lat_label]) + args:
+        h.update(str(item).encode())
+    return h.hexdigest()
+
+
+def _load(url):
+    try:
+        return xr.load_dataarray(url)
+    except (OSError, ValueError) as e:
+        warnings.warn(f'cannot read cached field {url}: {e}')
+        return None
+
+
+def _store(da, url):
+    tmp_url = f'{url}.tmp-{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        da.to_netcdf(tmp_url)
+        os.replace(tmp_url, url)
+    except OSError as e:
+        warnings.warn(f'cannot cache field in {url}: {e}')
+        if os.path.exists(tmp_url):
+            os.remove(tmp_url)
+
+
+def get_or_compute(name, key, compute):
+    """
+    Get a field from the in-process cache, or else from the on-disk cache, or else compute it and store it
+    in both caches. The in-process cache keeps the IN_MEMORY_CACHE_SIZE recently used fields.
+    :param name: str; name of the field, used as a prefix of the cache file name
+    :param key: str; hash code of the parameters the field depends on (see hash_of_grid)
+    :param compute: a callable with no arguments returning an xarray DataArray
+    :return: xarray DataArray, loaded into memory
+    """
+    cache_key = f'{name}_{key}'
+    try:
+        da = _in_memory_cache[cache_key]
+    except KeyError:
+        da = None
+    if da is None:
+        cache_dir = get_cache_dir()
+        url = os.path.join(cache_dir, f'{cache_key}.nc') if cache_dir is not None else None
+        if url is not None and os.path.exists(url):
+            da = _load(url)
+        if da is None:
+            da = compute().load()
+            if url is not None:
+                _store(da, url)
+    # re-insert the field so that it becomes the most recently used one
+    _in_memory_cache[cache_key] = da
+    return da
@@ -0,0 +1,62 @@
+import os
+import xarray as xr
+
+
+TIME_DIM = 'time'
+HEIGHT_DIM = 'height'
+COMPLEVEL = 4
+# encoding of the source variables kept in the compacted file; other encodings (chunks, compression) are replaced
+KEPT_ENCODING = ('dtype', '_FillValue', 'units', 'calendar', 'char_dim_name', 'scale_factor', 'add_offset')
+
+
+def _sum_over_height(ds):
+    # sum the variables with a height dimension over height into a single level, whose height is the top one
+    height_vars = [v for v in ds.data_vars if HEIGHT_DIM in ds[v].dims]
+    compact_ds = ds.isel({HEIGHT_DIM: [-1]})
+    for v in height_vars:
+        summed = ds[v].sum(HEIGHT_DIM, keep_attrs=True)
+        summed = summed.expand_dims({HEIGHT_DIM: compact_ds[HEIGHT_DIM].values}, axis=ds[v].dims.index(HEIGHT_DIM))
+        compact_ds[v] = summed.assign_coords({HEIGHT_DIM: compact_ds[HEIGHT_DIM]}).astype(ds[v].dtype)
+    compact_ds.attrs['compaction'] = f'{", ".join(height_vars)} summed over the output levels into a single level ' \
+                                     f'from the ground to the top height'
+    return compact_ds
+
+
+def compact(url, output_url=None, sum_height=False, complevel=COMPLEVEL):
+    """
+    Rewrite a FLEXPART output into a compressed netCDF file, chunked by time step with whole longitude-latitude
+    grids, which is how the outputs are read (see fpout.sum_over_time_and_height). Without sum_height, the file keeps
+    the structure of the FLEXPART output, so that it is read by fpout.open_dataset as the original one. With sum_height,
+    the column is collapsed into a single level: the sum over height of the fields is unchanged (as read by
+    create-footprints.py), but the residence time in s, which needs the air density of each level, cannot be computed
+    from it, so that fpout.open_dataset refuses it unless res_time_in_sec=False. Fields are read one time step at a
+    time, so that memory use does not depend on the simulation length.
+    :param url: path to Flexpart output dataset; must be in netcdf format and conform the Flexpart v10 output
+    :param output_url: str; path to the compacted file; default: url, rewritten in place
+    :param sum_height: bool; if True, the variables with a height dimension (e.g. spec001_mr) are summed over the
+    output levels and kept with a single level, whose height is the top one, and the attribute 'compaction' is set;
+    default False
+    :param complevel: int; zlib compression level; default 4
+    :return: str; path to the compacted file
+    """
+    if output_url is None:
+        output_url = url
+    tmp_output_url = f'{output_url}.tmp-{os.getpid()}'
+    with xr.open_dataset(url, chunks={TIME_DIM: 1}) as ds:
+        if sum_height:
+            ds = _sum_over_height(ds)
+        encoding = {}
+        for v in ds.variables:
+            encoding[v] = {key: value for key, value in ds[v].encoding.items() if key in KEPT_ENCODING}
+            if v in ds.data_vars and ds[v].dtype.kind in 'fiu':
+                encoding[v].update({'zlib': True, 'complevel': complevel, 'shuffle': True})
+                if TIME_DIM in ds[v].dims:
+                    encoding[v]['chunksizes'] = tuple(1 if dim == TIME_DIM else ds.sizes[dim] for dim in ds[v].dims)
+        try:
+            ds.to_netcdf(tmp_output_url, encoding=encoding)
+        except BaseException:
+            if os.path.exists(tmp_output_url):
+                os.remove(tmp_output_url)
+            raise
+    os.replace(tmp_output_url, output_url)
+    return output_url
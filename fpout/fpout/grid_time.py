@@ -1,3 +1,5 @@
+import os
+import hashlib
 import warnings
 import pkg_resources
 import numpy as np
@@ -5,7 +7,8 @@ import pandas as pd
 import xarray as xr
 
 from common import longitude
-import xarray_extras    # noqa
+import xarray_extras
+from . import cache
 
 
 PIXEL_AREA_005DEG_URL = pkg_resources.resource_filename('fpout', 'resources/pixel_areas_005deg.nc')
@@ -85,7 +88,6 @@ def _assign_extra_height_coords(ds):
 
 
 def get_pixel_area():
-    # TODO: manage it by caching
     global _pixel_area
     if _pixel_area is None:
         # prepare Pixel_area data
@@ -94,8 +96,25 @@ def get_pixel_area():
     return _pixel_area
 
 
+def get_pixel_area_for_grid(ds):
+    """
+    Get the pixel area regridded to the longitude-latitude grid of a dataset. The 0.05deg pixel areas are summed
+    over the grid cells with sparse regridding weights (see xarray_extras.RegridWeights); the grid cells must be made
+    of whole 0.05deg cells, otherwise ValueError is raised. Regridded pixel areas are
+    cached on disk and in memory (see fpout.cache), keyed by the grid coordinates, so that the 0.05deg pixel area is
+    read and summed only once per grid.
+    :param ds: an xarray Dataset or DataArray with longitude and latitude coordinates
+    :return: xarray DataArray
+    """
+    def regrid_pixel_area():
+        pixel_area = get_pixel_area()
+        weights = xarray_extras.RegridWeights.from_grids(pixel_area, ds, method='sum', check_alignment=True)
+        return weights.regrid(pixel_area)
+    key = cache.hash_of_grid(ds, os.path.basename(PIXEL_AREA_005DEG_URL))
+    return cache.get_or_compute(PIXEL_AREA_005DEG_VAR, key, regrid_pixel_area)
+
+
 def _get_orography(resol):
-    # TODO: manage it by caching
     # prepare orography for a given resolution
     global _orography_by_resol
     if resol not in _orography_by_resol:
@@ -105,9 +124,48 @@ def _get_orography(resol):
     return _orography_by_resol[resol]
 
 
-def _rt_transform_by_air_density(rt, oro):
-    mean_height = 0.5 * (rt[TOP_HEIGHT] + rt[BOTTOM_HEIGHT])
-    density = vertical_profile_of_air_density.interp(coords={'height': mean_height + oro}).astype(np.float32)
+def get_orography_for_grid(ds):
+    """
+    Get the generic orography regridded to the longitude-latitude grid of a dataset. The orography is taken at
+    the coarsest available resolution not coarser than the grid's one. Regridded orographies are cached on disk
+    and in memory (see fpout.cache), keyed by the grid coordinates.
+    :param ds: an xarray Dataset or DataArray with longitude and latitude coordinates
+    :return: xarray DataArray
+    """
+    ds_lon = ds[ds.geo.get_lon_label()]
+    target_resol = float(abs(ds_lon[1] - ds_lon[0]))
+    for resol_str, resol in OROGRAPHY_AVAIL_RESOL.items():
+        if resol <= target_resol:
+            break
+
+    def regrid_orography():
+        oro = _get_orography(resol_str).astype('f8')
+        return oro.geo_regrid.regrid_lon_lat(target_resol_ds=ds, method='linear',
+                                             longitude_circular=True, keep_attrs=True)
+    key = cache.hash_of_grid(ds, os.path.basename(OROGRAPHY_BY_RESOL_ULR[resol_str]))
+    return cache.get_or_compute(OROGRAPHY, key, regrid_orography)
+
+
+def get_air_density_for_grid(ds, oro):
+    """
+    Get the mean air density at the centers of the grid cells of a dataset, interpolated from the vertical
+    profile of air density at the cells' heights above sea level. Air densities are cached on disk and in memory
+    (see fpout.cache), keyed by the grid coordinates, the height levels and the orography.
+    :param ds: an xarray Dataset with longitude, latitude and height coordinates, and top and bottom heights
+    of grid cells (see _assign_extra_height_coords)
+    :param oro: xarray DataArray; orography on the longitude-latitude grid of ds
+    :return: xarray DataArray of float32, with dimensions height, latitude and longitude
+    """
+    def interp_air_density():
+        mean_height = 0.5 * (ds[TOP_HEIGHT] + ds[BOTTOM_HEIGHT])
+        density = vertical_profile_of_air_density.interp(coords={'height': mean_height + oro}).astype(np.float32)
+        return density.reset_coords(drop=True)
+    oro_hash = hashlib.sha256(np.ascontiguousarray(oro.values)).hexdigest()
+    key = cache.hash_of_grid(ds, list(ds[TOP_HEIGHT].values), list(ds[BOTTOM_HEIGHT].values), oro_hash)
+    return cache.get_or_compute(vertical_profile_of_air_density.name, key, interp_air_density)
+
+
+def _rt_transform_by_air_density(rt, density):
     rt = rt * density
     rt.attrs['units'] = 's'
     return rt
@@ -151,14 +209,7 @@ def open_dataset(
 
     # set orography
     if generic_orography:
-        ds_lon = ds[ds.geo.get_lon_label()]
-        target_resol = float(abs(ds_lon[1] - ds_lon[0]))
-        for resol_str, resol in OROGRAPHY_AVAIL_RESOL.items():
-            if resol <= target_resol:
-                break
-        oro = _get_orography(resol_str).astype('f8')
-        oro = oro.geo_regrid.regrid_lon_lat(target_resol_ds=ds, method='linear',
-                                            longitude_circular=True, keep_attrs=True)
+        oro = get_orography_for_grid(ds)
     else:
         oro = ds['ORO'].astype('f8')
     ds = ds.assign_coords({OROGRAPHY: oro})
@@ -168,8 +219,13 @@ def open_dataset(
         ind_source = int(ds.attrs['ind_source'])
         ind_receptor = int(ds.attrs['ind_receptor'])
         if ind_source == 1 and ind_receptor == 2:
+            if 'compaction' in ds.attrs:
+                # the air density varies over the levels, which are summed into one in the file (see fpout.compact)
+                raise ValueError(f'{url} is summed over height ({ds.attrs["compaction"]}); its residence time in s '
+                                 f'cannot be computed, open it with res_time_in_sec=False')
             # must change residence time units from 's m3 kg-1' to 's' by multiplying by air density at output grid cell
-            ds[RES_TIME] = _rt_transform_by_air_density(ds['spec001_mr'], ds[OROGRAPHY])
+            density = get_air_density_for_grid(ds, ds[OROGRAPHY])
+            ds[RES_TIME] = _rt_transform_by_air_density(ds['spec001_mr'], density)
         elif ind_source == 2 and ind_receptor == 2:
             ds[RES_TIME] = ds['spec001_mr']
 
@@ -210,8 +266,7 @@ def _open_dataset(
     if assign_releases_position_coords:
         ds = _assign_releases_position_coords(ds, index_releases_by_time=index_releases_by_time)
     if pixel_area:
-        pixel_area_ds = get_pixel_area().geo_regrid.regrid_lon_lat(target_resol_ds=ds, method='sum',
-                                                                   longitude_circular=True, keep_attrs=True)
+        pixel_area_ds = get_pixel_area_for_grid(ds)
         ds = ds.assign_coords(area=pixel_area_ds)
         ds['area'].attrs.update({
             'standard_name': 'cell_area',
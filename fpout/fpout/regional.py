@@ -0,0 +1,132 @@
+import os
+import numpy as np
+import xarray as xr
+
+import xarray_extras    # noqa
+
+
+NATIVE_PREFIX = 'grid_time_'
+NATIVE_NEST_PREFIX = 'grid_time_nest_'
+NEST_SUFFIX = '_nest'
+
+# lower left corner of the global output grid of the ACTRIS simulations (OUTGRID from -179 to 181 in longitude
+# and from -90 to 90 in latitude)
+GLOBAL_GRID_LON0 = -179.
+GLOBAL_GRID_LAT0 = -90.
+
+
+def get_nest_url(url):
+    """
+    Get the path to the nested output of a FLEXPART output. FLEXPART writes the nested output grid_time_nest_<date>.nc
+    next to grid_time_<date>.nc; once renamed, the nested output of <name>.nc is <name>_nest.nc.
+    :param url: path to Flexpart output dataset
+    :return: str; the nested output may not exist
+    """
+    dirname, basename = os.path.split(url)
+    if basename.startswith(NATIVE_PREFIX) and not basename.startswith(NATIVE_NEST_PREFIX):
+        return os.path.join(dirname, NATIVE_NEST_PREFIX + basename[len(NATIVE_PREFIX):])
+    root, ext = os.path.splitext(url)
+    return f'{root}{NEST_SUFFIX}{ext}'
+
+
+def is_nest_url(url):
+    """
+    Check if a path is the one of a nested FLEXPART output (see get_nest_url)
+    :param url: path to Flexpart output dataset
+    :return: bool
+    """
+    basename = os.path.basename(url)
+    return basename.startswith(NATIVE_NEST_PREFIX) or os.path.splitext(basename)[0].endswith(NEST_SUFFIX)
+
+
+def get_global_grid(resolution=1., lon0=GLOBAL_GRID_LON0, lat0=GLOBAL_GRID_LAT0):
+    """
+    Get the global longitude-latitude grid of a FLEXPART output with an OUTGRID of the given resolution whose lower
+    left corner is lon0, lat0; coordinates are the centers of the grid cells, with longitudes normalized as by
+    fpout.open_dataset
+    :param resolution: float; resolution in degrees; default 1.
+    :param lon0: float; longitude of the lower left corner of the grid; default -179.
+    :param lat0: float; latitude of the lower left corner of the grid; default -90.
+    :return: xarray Dataset with longitude and latitude coordinates
+    """
+    nx = int(round(360. / resolution))
+    ny = int(round(180. / resolution))
+    grid = xr.Dataset(coords={
+        'latitude': ('latitude', lat0 + resolution * (np.arange(ny) + .5), {'long_name': 'latitude in degree north',
+                                                                    'units': 'degrees_north'}),
+        'longitude': ('longitude', lon0 + resolution * (np.arange(nx) + .5), {'long_name': 'longitude in degree east',
+                                                                      'units': 'degrees_east'}),
+    })
+    return grid.geo.normalize_longitude(keep_attrs=True)
+
+
+def is_same_grid(da, grid):
+    """
+    Check if a data array is defined on a longitude-latitude grid
+    :param da: xarray DataArray with longitude and latitude coordinates
+    :param grid: xarray Dataset or DataArray with longitude and latitude coordinates
+    :return: bool
+    """
+    for label, grid_label in zip(da.geo.get_lon_lat_label(), grid.geo.get_lon_lat_label()):
+        coord, grid_coord = np.asarray(da[label]), np.asarray(grid[grid_label])
+        if coord.shape != grid_coord.shape or not np.allclose(coord, grid_coord):
+            return False
+    return True
+
+
+def _get_grid_indices(coord, grid_coord, label):
+    # index in grid_coord of the cell of each coordinate of coord; coordinates are the centers of grid cells
+    # and the grid cells of coord must subdivide those of grid_coord
+    grid_resol = (grid_coord[-1] - grid_coord[0]) / (len(grid_coord) - 1)
+    resol = (coord[-1] - coord[0]) / (len(coord) - 1) if len(coord) > 1 else grid_resol
+    ratio = grid_resol / resol
+    if round(ratio) < 1 or abs(ratio - round(ratio)) > 1e-3:
+        raise ValueError(f'resolution of {label} ({resol}) must divide the resolution of the grid ({grid_resol})')
+    # offsets of the lower edges of the cells of coord from the lower edge of the grid, in cells of coord
+    offsets = ((coord - resol / 2) - (grid_coord[0] - grid_resol / 2)) / resol
+    if np.any(np.abs(offsets - np.round(offsets)) > 1e-3):
+        raise ValueError(f'{label} coordinates from {coord[0]} to {coord[-1]} are not aligned with the grid')
+    indices = np.round(offsets).astype(int) // int(round(ratio))
+    if indices.min() < 0 or indices.max() >= len(grid_coord):
+        raise ValueError(f'{label} coordinates from {coord[0]} to {coord[-1]} are out of the grid')
+    return indices
+
+
+def embed_into_grid(da, grid, fill_value=0.):
+    """
+    Embed a longitude-latitude field of a regional or nested FLEXPART output (e.g. a residence time) into a larger grid,
+    e.g. the global grid of the footprints. The field is summed over the cells of the grid it subdivides, so that it
+    may have the resolution of the grid or a finer one (a nested output); the cells of the grid outside of its domain
+    are set to fill_value. Other dimensions than longitude and latitude are not allowed.
+    :param da: xarray DataArray with longitude and latitude dimensions, normalized as by fpout.open_dataset
+    :param grid: xarray Dataset or DataArray with the longitude and latitude coordinates of the target grid
+    :param fill_value: value of the cells out of the domain of da; default 0.
+    :return: xarray DataArray of float64 with dimensions latitude and longitude of the grid
+    """
+    lon_label, lat_label = da.geo.get_lon_lat_label()
+    grid_lon_label, grid_lat_label = grid.geo.get_lon_lat_label()
+    if set(da.dims) != {lon_label, lat_label}:
+        raise ValueError(f'da must have only longitude and latitude dimensions; got {da.dims}')
+    da = da.sortby([lat_label, lon_label]).transpose(lat_label, lon_label)
+    grid_lon, grid_lat = grid[grid_lon_label], grid[grid_lat_label]
+    lon_idx = _get_grid_indices(np.asarray(da[lon_label]), np.asarray(grid_lon), lon_label)
+    lat_idx = _get_grid_indices(np.asarray(da[lat_label]), np.asarray(grid_lat), lat_label)
+
+    acc = np.zeros((len(grid_lat), len(grid_lon)), dtype=np.float64)
+    covered = np.zeros(acc.shape, dtype=bool)
+    np.add.at(acc, (lat_idx[:, np.newaxis], lon_idx[np.newaxis, :]), np.ma.filled(np.asarray(da.values, dtype=np.float64), 0.))
+    covered[np.ix_(lat_idx, lon_idx)] = True
+    acc[~covered] = fill_value
+    return xr.DataArray(acc, dims=(grid_lat_label, grid_lon_label),
+                        coords={grid_lat_label: grid_lat, grid_lon_label: grid_lon},
+                        attrs=da.attrs, name=da.name)
+
+
+def get_domain_mask(da, grid):
+    """
+    Get the cells of a grid covered by the domain of a longitude-latitude field (see embed_into_grid)
+    :param da: xarray DataArray with longitude and latitude dimensions
+    :param grid: xarray Dataset or DataArray with the longitude and latitude coordinates of the target grid
+    :return: xarray DataArray of bool with dimensions latitude and longitude of the grid
+    """
+    return embed_into_grid(xr.ones_like(da, dtype=np.float64), grid) > 0
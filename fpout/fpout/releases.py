@@ -0,0 +1,59 @@
+import os
+import xarray as xr
+
+
+RELEASE_COMMENT = 'RELCOM'
+# FLEXPART v10 netCDF output indexes the release variables (RELCOM, RELZZ1, ...) by 'numpoint' and the gridded
+# fields by 'pointspec'; with IOUTPUTFOREACHRELEASE=1 both dimensions enumerate the same releases
+RELEASE_DIMS = ('numpoint', 'pointspec')
+
+
+def _decode_release_name(name):
+    if isinstance(name, bytes):
+        name = name.decode('ascii', errors='ignore')
+    return str(name).strip()
+
+
+def get_release_names(url):
+    """
+    Get names of releases (the COMMENT field of the RELEASES file) of a FLEXPART output
+    :param url: path to Flexpart output dataset in netcdf format
+    :return: list of str
+    """
+    with xr.open_dataset(url) as ds:
+        return [_decode_release_name(name) for name in ds[RELEASE_COMMENT].values]
+
+
+def split_by_release(url, output_dir, suffix=''):
+    """
+    Split a FLEXPART output of a multi-release simulation (run with IOUTPUTFOREACHRELEASE=1) into files with
+    a single release each, as produced by a single-release simulation. Each output file is named after
+    the release name.
+    :param url: path to Flexpart output dataset in netcdf format
+    :param output_dir: directory where to write the output files
+    :param suffix: str; appended to the release name in the name of the output files, e.g. '_nest' for nested outputs
+    :return: list of paths to the output files, in the order of releases
+    """
+    names = get_release_names(url)
+    if len(set(names)) != len(names):
+        raise ValueError(f'release names must be unique to split {url}; got {names}')
+    if any(name == '' for name in names):
+        raise ValueError(f'release names must not be empty to split {url}; got {names}')
+
+    output_urls = []
+    with xr.open_dataset(url, decode_cf=False) as ds:
+        release_dims = [dim for dim in RELEASE_DIMS if dim in ds.dims]
+        if not release_dims:
+            raise ValueError(f'none of the dimensions {RELEASE_DIMS} found in {url}')
+        for dim in release_dims:
+            if ds.sizes[dim] != len(names):
+                raise ValueError(f'dimension {dim} of size {ds.sizes[dim]} does not match '
+                                 f'the number of releases {len(names)} in {url}')
+        for i, name in enumerate(names):
+            release_ds = ds.isel({dim: [i] for dim in release_dims})
+            output_url = os.path.join(output_dir, f'{name}{suffix}.nc')
+            tmp_output_url = f'{output_url}.tmp'
+            release_ds.to_netcdf(tmp_output_url)
+            os.replace(tmp_output_url, output_url)
+            output_urls.append(output_url)
+    return output_urls
@@ -0,0 +1,57 @@
+import numpy as np
+import xarray as xr
+import netCDF4
+
+import xarray_extras    # noqa
+
+
+SPEC_VAR = 'spec001_mr'
+TIME_DIM = 'time'
+RELEASE_DIM = 'pointspec'
+LON_DIM = 'longitude'
+LAT_DIM = 'latitude'
+
+
+def _get_attrs(nc_var):
+    return {attr: nc_var.getncattr(attr) for attr in nc_var.ncattrs() if attr not in ('_FillValue', 'missing_value')}
+
+
+def sum_over_time_and_height(url, var=SPEC_VAR, normalize_longitude=True):
+    """
+    Sum a gridded variable of a FLEXPART output over time, height levels and age classes, and average it
+    over releases, without loading the whole variable: the netCDF variable is read time step by time step
+    and accumulated into a single float64 buffer of the size of the longitude-latitude grid, so that memory
+    use is bounded by one time slab whatever the length of the simulation. Missing values count as 0.
+    :param url: path to Flexpart output dataset; must be in netcdf format and conform the Flexpart v10 output
+    :param var: str; name of the variable to reduce; default 'spec001_mr'
+    :param normalize_longitude: bool; if True, normalize longitude as in fpout.open_dataset
+    :return: xarray DataArray of float64 with dimensions latitude and longitude
+    """
+    with netCDF4.Dataset(url) as nc:
+        nc_var = nc[var]
+        dims = nc_var.dimensions
+        for dim in (TIME_DIM, LAT_DIM, LON_DIM):
+            if dim not in dims:
+                raise ValueError(f'dimension {dim} not found in variable {var} of {url}; got {dims}')
+        time_axis = dims.index(TIME_DIM)
+        slab_dims = [dim for dim in dims if dim != TIME_DIM]
+        sum_axes = tuple(i for i, dim in enumerate(slab_dims) if dim not in (LAT_DIM, LON_DIM))
+        output_dims = [dim for dim in slab_dims if dim in (LAT_DIM, LON_DIM)]
+        nreleases = nc.dimensions[RELEASE_DIM].size if RELEASE_DIM in slab_dims else 1
+
+        acc = np.zeros(tuple(nc.dimensions[dim].size for dim in output_dims), dtype=np.float64)
+        slab_idx = [slice(None)] * len(dims)
+        for i in range(nc.dimensions[TIME_DIM].size):
+            slab_idx[time_axis] = i
+            slab = np.ma.filled(nc_var[tuple(slab_idx)], 0.)
+            acc += slab.sum(axis=sum_axes, dtype=np.float64)
+        acc /= nreleases
+
+        coords = {dim: (dim, np.ma.getdata(nc[dim][:]), _get_attrs(nc[dim])) for dim in output_dims}
+        attrs = _get_attrs(nc_var)
+
+    da = xr.DataArray(acc, dims=output_dims, coords=coords, attrs=attrs, name=var)
+    da = da.transpose(LAT_DIM, LON_DIM)
+    if normalize_longitude:
+        da = da.geo.normalize_longitude(keep_attrs=True)
+    return da
@@ -0,0 +1,193 @@
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import subprocess
+import numpy as np
+
+import fpout
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - [%(levelname)s] %(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PARTS_LADDER = [12500, 25000, 50000, 100000, 200000]
+DEFAULT_TOLERANCE = 0.05
+
+def get_benchmark_config(template: dict, parts: int, working_dir: str) -> dict:
+    """
+    This function returns the configuration of the benchmark simulation with a given number of particles:
+    the template simulation with all its releases set to this number of particles, in its own working directory
+
+    Args:
+        template    (dict): simulation configuration, as written by SimulationConfig.to_dict
+        parts       (int) : number of particles per release
+        working_dir (str) : working directory of the benchmark simulation
+
+    Returns:
+        dict: simulation configuration, as read by SimulationConfig.from_dict
+    """
+    config = dict(template)
+    config["working_dir"] = working_dir
+    config["releases"] = [dict(release, parts=parts) for release in template["releases"]]
+    return config
+
+def get_flexpart_output(working_dir: str) -> str:
+    """
+    This function returns the FLEXPART output netCDF file of a working directory, None if there is none
+    """
+    outputs = sorted(glob.glob(f"{working_dir}/output/grid_time_[0-9]*.nc"))
+    return outputs[0] if len(outputs)>0 else None
+
+def get_wall_seconds(working_dir: str) -> float:
+    """
+    This function returns the wall time of the FLEXPART run of a working directory, read from the last event
+    of its progress file written by actris.py, None if the file has no event
+    """
+    progress_filepath = f"{working_dir}/progress.jsonl"
+    if not os.path.exists(progress_filepath):
+        return None
+    wall_seconds = None
+    with open(progress_filepath) as file:
+        for line in file:
+            if line.strip()!="":
+                wall_seconds = json.loads(line)["wall_seconds"]
+    return wall_seconds
+
+def run_benchmark_simulation(config: dict, actris_python: str) -> float:
+    """
+    This function runs a benchmark simulation with actris.py
+
+    Args:
+        config        (dict): simulation configuration, as read by SimulationConfig.from_dict
+        actris_python (str) : python interpreter running actris.py
+
+    Returns:
+        float: wall time of the FLEXPART run in seconds (total time of actris.py if FLEXPART reported no time step)
+    """
+    working_dir = config["working_dir"]
+    os.makedirs(working_dir, exist_ok=True)
+    config_filepath = f"{working_dir}/actris-config.json"
+    with open(config_filepath, "w") as file:
+        json.dump(config, file)
+    start_time = time.monotonic()
+    result = subprocess.run([actris_python, f"{SRC_DIR}/actris.py", "--config", config_filepath])
+    total_seconds = time.monotonic() - start_time
+    if result.returncode!=0:
+        raise RuntimeError(f"simulation of {working_dir} failed with status {result.returncode}")
+    wall_seconds = get_wall_seconds(working_dir)
+    return wall_seconds if wall_seconds is not None else total_seconds
+
+def get_footprint(flexpart_output: str) -> np.ndarray:
+    """
+    This function computes the footprint (residence time per km2, summed over time and height and averaged
+    over releases) of a FLEXPART output, as create-footprints.py does
+
+    Args:
+        flexpart_output (str): path to the FLEXPART output netCDF file
+
+    Returns:
+        np.ndarray: footprint in float64, latitude by longitude
+    """
+    with fpout.open_dataset(flexpart_output, max_chunk_size=1e8, res_time_in_sec=False) as _ds:
+        res_time = fpout.sum_over_time_and_height(flexpart_output)
+        res_time_per_km2 = res_time / _ds['area'] * 1e6
+        return res_time_per_km2.transpose('latitude', 'longitude').values
+
+def get_relative_l1_error(footprint: np.ndarray, reference: np.ndarray) -> float:
+    """
+    This function returns the L1 distance between a footprint and the reference footprint, relative to the L1 norm of the reference
+    """
+    return float(np.abs(footprint - reference).sum() / np.abs(reference).sum())
+
+def run_benchmark(template: dict, parts_ladder: list, work_dir: str, tolerance: float, actris_python: str,
+                  reuse: bool=False) -> dict:
+    """
+    This function runs the template simulation for each number of particles of the ladder and compares its footprint to the
+    one of the highest number of particles, taken as the converged footprint
+
+    Args:
+        template      (dict) : simulation configuration, as written by SimulationConfig.to_dict
+        parts_ladder  (list) : numbers of particles per release (int) to benchmark
+        work_dir      (str)  : directory of the working directories of the benchmark simulations
+        tolerance     (float): maximum relative L1 error of an acceptable footprint
+        actris_python (str)  : python interpreter running actris.py
+        reuse         (bool) : if True, simulations already run in work_dir are not run again
+
+    Returns:
+        dict: report with, for each number of particles, the wall time and the relative L1 error, and the recommended
+              number of particles: the lowest one whose error is within the tolerance
+    """
+    footprints = {}
+    wall_seconds = {}
+    for parts in sorted(parts_ladder):
+        working_dir = os.path.abspath(f"{work_dir}/parts-{parts}")
+        if reuse and get_flexpart_output(working_dir) is not None:
+            logger.info(f"Reusing the simulation with {parts} particles per release")
+            wall_seconds[parts] = get_wall_seconds(working_dir)
+        else:
+            logger.info(f"Running the simulation with {parts} particles per release")
+            wall_seconds[parts] = run_benchmark_simulation(get_benchmark_config(template, parts, working_dir), actris_python)
+        flexpart_output = get_flexpart_output(working_dir)
+        if flexpart_output is None:
+            raise RuntimeError(f"no FLEXPART output in {working_dir}/output")
+        footprints[parts] = get_footprint(flexpart_output)
+
+    reference_parts = max(footprints)
+    results = []
+    for parts in sorted(footprints):
+        error = get_relative_l1_error(footprints[parts], footprints[reference_parts])
+        results.append({"parts": parts, "wall_seconds": wall_seconds[parts], "relative_l1_error": error})
+        logger.info(f"{parts} particles per release: {wall_seconds[parts]} s, relative L1 error {error:.4f}")
+    recommended = min(result["parts"] for result in results if result["relative_l1_error"]<=tolerance)
+    return {"reference_parts": reference_parts, "tolerance": tolerance, "recommended_parts": recommended, "results": results}
+
+if __name__ == '__main__':
+    """
+    Main function
+
+    Args:
+        -c / --config : configuration file (xml or JSON) of the simulation to benchmark
+        -p / --parts  : numbers of particles per release to benchmark
+        -w / --wdir   : directory of the working directories of the benchmark simulations
+        -t / --tolerance : maximum relative L1 error of the footprint against the one of the highest number of particles
+        -o / --output : path to the JSON report
+        --reuse       : does not run again the simulations already run in the working directories
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarking the convergence of the footprint of a FLEXPART simulation with the number of particles per release",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-c", "--config", type=str, required=True, help="Configuration file (xml or JSON) of the simulation to benchmark")
+    parser.add_argument("-p", "--parts", type=int, nargs="+", default=DEFAULT_PARTS_LADDER,
+                        help=f"Numbers of particles per release to benchmark (default: {' '.join(str(p) for p in DEFAULT_PARTS_LADDER)})")
+    parser.add_argument("-w", "--wdir", type=str, required=True, help="Directory of the working directories of the benchmark simulations")
+    parser.add_argument("-t", "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Maximum relative L1 error of the footprint against the one of the highest\n"
+                             f"number of particles (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument("-o", "--output", type=str, help="Path to the JSON report (default: <wdir>/particles-benchmark.json)")
+    parser.add_argument("--actris-python", type=str, default=sys.executable,
+                        help="Python interpreter running actris.py (default: this interpreter)")
+    parser.add_argument("--reuse", action="store_true", help="Does not run again the simulations already run in the working directories")
+    args = parser.parse_args()
+
+    if len(args.parts)<2:
+        logger.error("At least two numbers of particles are needed")
+        sys.exit(1)
+    sys.path.insert(0, SRC_DIR)
+    from actris import SimulationConfig
+    template = SimulationConfig.from_file(args.config).to_dict()
+    try:
+        report = run_benchmark(template, args.parts, args.wdir, args.tolerance, args.actris_python, args.reuse)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    output = args.output if args.output is not None else f"{args.wdir}/particles-benchmark.json"
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Recommended number of particles per release: {report['recommended_parts']} (report written in {output})")
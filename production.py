@@ -0,0 +1,765 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import logging
+import datetime
+import subprocess
+import threading
+import concurrent.futures
+from dataclasses import dataclass, field
+
+import stations
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - [%(levelname)s] %(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+SLURM_BIN_DIR = "/usr/local/slurm/bin"
+SLURM_POLL_INTERVAL = 60
+
+# Configuration that allows to use "module load" command on NUWA, as in actris-processing.sh
+MODULES_SETUP = (". /etc/profile.d/modules.sh && "
+                 "export MODULEPATH=/home/sila/modules/compilers:/home/sila/modules/libraries/generic && "
+                 "export MODULECONFIGFILE=/home/sila/modules/config/modulerc")
+SINGULARITY_MODULE = "singularity/3.10.2"
+
+# Marker file written by actris.py in the working directory of a simulation once it has succeeded
+# (see actris.COMPLETED_MARKER_FILENAME)
+COMPLETED_MARKER_FILENAME = "SIMULATION_COMPLETED"
+
+STEP_FLEXPART   = "flexpart"
+STEP_SOFTIO     = "softio"
+STEP_FOOTPRINTS = "footprints"
+
+COMPLETED = "COMPLETED"
+FAILED    = "FAILED"
+CANCELLED = "CANCELLED"
+
+# Dependency types, named as in Slurm: afterok runs a task only if its upstream task succeeded,
+# afterany runs it once its upstream task is over whatever its state
+AFTER_OK  = "afterok"
+AFTER_ANY = "afterany"
+
+MANDATORY_CONFIG_VARS = ["SERVER_USER", "LOGS_DIR", "PATHS_CONF_FILEPATH", "LOG_CATALOGUE_FILEPATH",
+                         "FLEXPART_HOUR", "DELAY_N_DAYS"]
+
+
+@dataclass
+class Task:
+    """
+    A processing step of actris-processing.sh for a station and a simulation date
+
+    Attributes:
+        step         (str) : processing step (flexpart, softio or footprints)
+        station_id   (str) : short name of the station
+        simu_date    (str) : simulation date/hour in the format YYYYMMDDHH
+        command      (list): command line of the step
+        log_filepath (str) : path to the log file of the step
+        dependencies (list): (Task, AFTER_OK or AFTER_ANY) tuples of the upstream tasks
+    """
+    step: str
+    station_id: str
+    simu_date: str
+    command: list
+    log_filepath: str
+    dependencies: list = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        return f"{self.step}-{self.station_id}-{self.simu_date}"
+
+
+def read_config_file(config_filepath: str) -> dict:
+    """
+    This function reads a shell configuration file (lines VAR="value") such as actris-production.conf
+    or actris-processing.conf
+
+    Args:
+        config_filepath (str): path to the configuration file
+
+    Returns:
+        dict: values by variable name
+    """
+    config = {}
+    with open(config_filepath) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#") or "=" not in line:
+                continue
+            var_name, var_value = line.split("=", 1)
+            config[var_name.strip()] = var_value.strip().strip('"').strip("'")
+    return config
+
+
+def build_tasks(station_ids: list, simu_date: str, config: dict, paths_config: dict) -> list:
+    """
+    This function builds the processing DAG of a simulation date: for each station, SOFT-io and
+    footprints run once FLEXPART succeeded. SOFT-io tasks of different stations and dates run
+    concurrently: their outputs are per station and date, and the SOFT-io database is written under a lock.
+
+    Args:
+        station_ids          (list): short names of the stations
+        simu_date            (str) : simulation date/hour in the format YYYYMMDDHH
+        config               (dict): production configuration
+        paths_config         (dict): processing configuration (actris-processing.conf)
+
+    Returns:
+        list: tasks, upstream tasks first
+    """
+    processing_script = os.path.join(paths_config["SRC_DIR"], "actris-processing.sh")
+    tasks = []
+    for station in station_ids:
+        log_filepath = os.path.join(config["LOGS_DIR"], station, f"{station}-{simu_date}.out")
+        command = [processing_script, "-n", station, "-d", simu_date, "-c", config["PATHS_CONF_FILEPATH"]]
+        flexpart_task = Task(STEP_FLEXPART, station, simu_date, command + ["--flexpart"], log_filepath)
+        softio_task = Task(STEP_SOFTIO, station, simu_date, command + ["--softio"], log_filepath,
+                           [(flexpart_task, AFTER_OK)])
+        footprints_task = Task(STEP_FOOTPRINTS, station, simu_date, command + ["--footprints"], log_filepath,
+                               [(flexpart_task, AFTER_OK)])
+        tasks += [flexpart_task, softio_task, footprints_task]
+    return tasks
+
+
+class SlurmBackend:
+    """
+    Backend submitting each task as a Slurm job as soon as it is planned, with its dependencies as Slurm
+    job dependencies, so that a task starts as soon as its upstream tasks are over. Jobs whose dependencies
+    can never be satisfied are cancelled by Slurm.
+    """
+
+    TERMINAL_STATES = ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL",
+                       "PREEMPTED", "BOOT_FAIL", "DEADLINE"]
+
+    def __init__(self, slurm_bin_dir: str = SLURM_BIN_DIR, poll_interval: int = SLURM_POLL_INTERVAL):
+        self.slurm_bin_dir = slurm_bin_dir
+        self.poll_interval = poll_interval
+        self._job_ids = {}
+
+    def submit(self, task: Task) -> None:
+        command = [os.path.join(self.slurm_bin_dir, "sbatch"), "--parsable",
+                   f"--job-name={task.name}",
+                   f"--output={task.log_filepath}",
+                   f"--error={task.log_filepath}",
+                   "--kill-on-invalid-dep=yes"]
+        if task.step != STEP_FLEXPART:
+            command.append("--open-mode=append")
+        if len(task.dependencies) > 0:
+            dependency = ",".join(f"{dependency_type}:{self._job_ids[upstream_task.name]}"
+                                  for upstream_task, dependency_type in task.dependencies)
+            command.append(f"--dependency={dependency}")
+        command.append(f"--wrap={' '.join(task.command)}")
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        self._job_ids[task.name] = output.strip().split(";")[0]
+        logger.info(f"Job {task.name} submitted with ID {self._job_ids[task.name]}, log output is in {task.log_filepath}")
+
+    def _get_states(self, job_ids: list) -> dict:
+        command = [os.path.join(self.slurm_bin_dir, "sacct"), "-j", ",".join(job_ids),
+                   "-X", "-n", "-P", "--format", "JobID,State"]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        states = {}
+        for line in output.splitlines():
+            if "|" in line:
+                job_id, state = line.split("|")[:2]
+                # e.g. "CANCELLED by 1234"
+                states[job_id] = state.split(" ")[0]
+        return states
+
+    def wait(self, tasks: list) -> dict:
+        pending = {self._job_ids[task.name]: task for task in tasks}
+        states = {}
+        while len(pending) > 0:
+            for job_id, state in self._get_states(list(pending)).items():
+                if job_id in pending and state in self.TERMINAL_STATES:
+                    task = pending.pop(job_id)
+                    states[task.name] = state if state in (COMPLETED, CANCELLED) else FAILED
+                    logger.info(f"Job {task.name} ({job_id}) is over: {state}")
+            if len(pending) > 0:
+                time.sleep(self.poll_interval)
+        return states
+
+
+class LocalBackend:
+    """
+    Backend running tasks as local processes, at most max_workers at a time. A task is started as soon as
+    its upstream tasks are over; it is cancelled if an AFTER_OK dependency did not complete.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _run(task: Task) -> str:
+        os.makedirs(os.path.dirname(task.log_filepath), exist_ok=True)
+        logger.info(f"Running {task.name}, log output is in {task.log_filepath}")
+        with open(task.log_filepath, "w" if task.step == STEP_FLEXPART else "a") as log_file:
+            returncode = subprocess.run(task.command, stdout=log_file, stderr=subprocess.STDOUT).returncode
+        state = COMPLETED if returncode == 0 else FAILED
+        logger.info(f"Task {task.name} is over: {state}")
+        return state
+
+    def _start(self, task: Task, future: concurrent.futures.Future) -> None:
+        for upstream_task, dependency_type in task.dependencies:
+            if dependency_type == AFTER_OK and self._futures[upstream_task.name].result() != COMPLETED:
+                logger.warning(f"Task {task.name} is cancelled, {upstream_task.name} did not complete")
+                future.set_result(CANCELLED)
+                return
+        run_future = self._executor.submit(self._run, task)
+        run_future.add_done_callback(lambda f: future.set_result(f.result() if f.exception() is None else FAILED))
+
+    def submit(self, task: Task) -> None:
+        future = concurrent.futures.Future()
+        upstream_futures = [self._futures[upstream_task.name] for upstream_task, _ in task.dependencies]
+        self._futures[task.name] = future
+        remaining = [len(upstream_futures)]
+
+        def on_upstream_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._start(task, future)
+
+        if len(upstream_futures) == 0:
+            self._start(task, future)
+        for upstream_future in upstream_futures:
+            upstream_future.add_done_callback(on_upstream_done)
+
+    def wait(self, tasks: list) -> dict:
+        return {task.name: self._futures[task.name].result() for task in tasks}
+
+
+@dataclass
+class ManifestEntry:
+    """
+    A FLEXPART simulation of a job manifest written by actris.py plan; line i (from 1) of the manifest
+    is the task i of the job array
+
+    Attributes:
+        station_id      (str): short name of the station
+        simu_date       (str): simulation date/hour in the format YYYYMMDDHH
+        release         (str): release height, or "multi" for a simulation with a release per height
+        working_dir     (str): simulation working directory
+        config_filepath (str): JSON configuration file of the simulation
+        output          (str): FLEXPART output file, or output directory of split-releases.py for "multi"
+    """
+    station_id: str
+    simu_date: str
+    release: str
+    working_dir: str
+    config_filepath: str
+    output: str
+
+
+def read_manifest(manifest_filepath: str) -> list:
+    """
+    This function reads a job manifest written by actris.py plan
+
+    Args:
+        manifest_filepath (str): path to the job manifest
+
+    Returns:
+        list: ManifestEntry of the simulations, in the order of the array indices
+    """
+    entries = []
+    with open(manifest_filepath) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#"):
+                continue
+            entries.append(ManifestEntry(*fields))
+    return entries
+
+
+def run_singularity(paths_config: dict, binds: list, env_name: str, args: list, log_file) -> int:
+    """
+    This function runs a Python script of SRC_DIR in an environment of the Singularity container, as
+    actris-processing.sh does
+
+    Args:
+        paths_config (dict): processing configuration (actris-processing.conf)
+        binds        (list): directories to bind in the container
+        env_name     (str) : name of the Python environment of the container, e.g. actris_env
+        args         (list): script name (relative to SRC_DIR) and its arguments
+        log_file           : file object receiving the output
+
+    Returns:
+        int: return code
+    """
+    binds = ",".join(bind for bind in binds if bind != "")
+    script = (f"{MODULES_SETUP} && module load {SINGULARITY_MODULE} && "
+              f"singularity exec --bind {binds} {paths_config['SINGULARITY_FILEPATH']} "
+              f"/usr/local/py_envs/{env_name}/bin/python {os.path.join(paths_config['SRC_DIR'], args[0])} "
+              + " ".join(args[1:]))
+    return subprocess.run(["bash", "-c", script], stdout=log_file, stderr=subprocess.STDOUT).returncode
+
+
+def needs_compaction(config_filepath: str) -> bool:
+    """
+    This function tells if the output of a simulation is to be compacted by compact-output.py, i.e. if the output
+    profile of its configuration is not "full" (see actris.OUTPUT_PROFILES); the JSON configurations written by
+    actris.py plan are read here, the other ones are left to compact-output.py
+    """
+    if not config_filepath.endswith(".json"):
+        return True
+    with open(config_filepath) as f:
+        return json.load(f).get("output_profile", "full") != "full"
+
+
+def get_nest_filepath(native_output: str) -> str:
+    """
+    This function returns the path to the nested output of a native FLEXPART output (see fpout.get_nest_url)
+    """
+    dirname, basename = os.path.split(native_output)
+    return os.path.join(dirname, "grid_time_nest_" + basename[len("grid_time_"):])
+
+
+def run_manifest_entries(entries: list, paths_config: dict, log_filepath: str) -> int:
+    """
+    This function runs FLEXPART simulations of a job manifest one after the other, in a single actris.py
+    process, and moves their outputs as actris-processing.sh does: compacted as set by the output profile of
+    the simulation, to the output file, or split by release into the output directory for "multi" simulations. Consecutive simulations share most of their ECMWF
+    files, which thus stay staged on the node from one simulation to the next (see ENFILES_STAGING_DIR).
+
+    Args:
+        entries      (list): ManifestEntry of the simulations to run
+        paths_config (dict): processing configuration (actris-processing.conf)
+        log_filepath (str) : path to the log file of the simulations
+
+    Returns:
+        int: 0 if all simulations succeeded, 1 otherwise
+    """
+    os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+    # markers of a previous attempt must not be taken for the ones of this run
+    for entry in entries:
+        if os.path.exists(os.path.join(entry.working_dir, COMPLETED_MARKER_FILENAME)):
+            os.remove(os.path.join(entry.working_dir, COMPLETED_MARKER_FILENAME))
+    status = 0
+    with open(log_filepath, "w") as log_file:
+        returncode = run_singularity(paths_config,
+                                     [paths_config["DATA_DIR"], paths_config["ROOT_WDIR"],
+                                      paths_config.get("FLEXPART_CACHE_DIR", ""), paths_config.get("ENFILES_STAGING_DIR", "")],
+                                     "actris_env", ["actris.py", "--config"] + [entry.config_filepath for entry in entries],
+                                     log_file)
+        if returncode != 0:
+            logger.warning(f"actris.py exited with status {returncode}, only the simulations it marked as completed are kept")
+        for entry in entries:
+            # FLEXPART writes its output at startup: a crashed or killed run leaves one, but no marker
+            if not os.path.exists(os.path.join(entry.working_dir, COMPLETED_MARKER_FILENAME)):
+                logger.error(f"FLEXPART simulation {entry.working_dir} has not completed, check {log_filepath}")
+                status = 1
+                continue
+            # grid_time_nest_*.nc, the nested output if any, is moved along with the main output
+            native_outputs = glob.glob(os.path.join(entry.working_dir, "output", "grid_time_[0-9]*.nc"))
+            if len(native_outputs) != 1:
+                logger.error(f"Something went wrong with FLEXPART simulation {entry.working_dir}, check {log_filepath}")
+                status = 1
+                continue
+            if needs_compaction(entry.config_filepath):
+                returncode = run_singularity(paths_config, [paths_config["ROOT_WDIR"]], "footprints_env",
+                                             ["compact-output.py", "-f", native_outputs[0], "-c", entry.config_filepath], log_file)
+                if returncode != 0:
+                    logger.error(f"Something went wrong while compacting the FLEXPART output, check {log_filepath}")
+                    status = 1
+                    continue
+            if entry.release == "multi":
+                returncode = run_singularity(paths_config, [paths_config["ROOT_WDIR"], entry.output], "footprints_env",
+                                             ["split-releases.py", "-f", native_outputs[0], "-o", entry.output], log_file)
+                if returncode != 0:
+                    logger.error(f"Something went wrong while splitting the FLEXPART output by release, check {log_filepath}")
+                    status = 1
+                    continue
+                os.remove(native_outputs[0])
+                if os.path.exists(get_nest_filepath(native_outputs[0])):
+                    os.remove(get_nest_filepath(native_outputs[0]))
+            else:
+                os.makedirs(os.path.dirname(entry.output), exist_ok=True)
+                shutil.move(native_outputs[0], entry.output)
+                if os.path.exists(get_nest_filepath(native_outputs[0])):
+                    shutil.move(get_nest_filepath(native_outputs[0]), f"{os.path.splitext(entry.output)[0]}_nest.nc")
+    return status
+
+
+def get_output_dir(entry: ManifestEntry) -> str:
+    """
+    This function returns the directory of the FLEXPART outputs of a manifest entry: the output of a "multi"
+    simulation is the directory where it is split by release, the others are output files
+    """
+    return entry.output if entry.release == "multi" else os.path.dirname(entry.output)
+
+
+def get_chains(entries: list, chain_length: int) -> list:
+    """
+    This function groups consecutive simulations of a job manifest into chains of chain_length simulations,
+    each chain being a task of the job array. Since actris.py plan writes the simulations ordered by date,
+    the simulations of a chain are of the same or of neighbouring dates, and run on the same node.
+
+    Args:
+        entries      (list): ManifestEntry of the job manifest
+        chain_length (int) : number of simulations per chain
+
+    Returns:
+        list: chains (lists of ManifestEntry); chain i (from 1) is the array task i
+    """
+    return [entries[i:i + chain_length] for i in range(0, len(entries), chain_length)]
+
+
+def get_chain_log_filepath(config: dict, chain: list, index: int) -> str:
+    if len(chain) == 1:
+        entry = chain[0]
+        return os.path.join(config["LOGS_DIR"], entry.station_id, f"{entry.station_id}-{entry.simu_date}-{entry.release}.out")
+    return os.path.join(config["LOGS_DIR"], "chains", f"chain-{chain[0].simu_date}-{chain[-1].simu_date}-{index}.out")
+
+
+class SlurmArrayBackend:
+    """
+    Backend submitting array tasks as a single Slurm job array, at most throttle tasks running at a time
+    (%N suffix of the --array option). The index of each task is passed as last argument of its command.
+    """
+
+    def __init__(self, slurm_bin_dir: str = SLURM_BIN_DIR, poll_interval: int = SLURM_POLL_INTERVAL):
+        self.slurm_bin_dir = slurm_bin_dir
+        self.poll_interval = poll_interval
+
+    def submit(self, name: str, command: list, indices: list, log_filepath: str, throttle: int = None) -> str:
+        array = ",".join(str(index) for index in indices)
+        if throttle is not None:
+            array = f"{array}%{throttle}"
+        os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+        # %A and %a are replaced by Slurm with the job ID and the array index
+        log_filepath = log_filepath.replace("{index}", "%a").replace("{job_id}", "%A")
+        sbatch_command = [os.path.join(self.slurm_bin_dir, "sbatch"), "--parsable",
+                          f"--job-name={name}",
+                          f"--array={array}",
+                          f"--output={log_filepath}",
+                          f"--error={log_filepath}",
+                          # SLURM_ARRAY_TASK_ID is expanded by the batch script, not here
+                          f"--wrap={' '.join(command)} ${{SLURM_ARRAY_TASK_ID}}"]
+        output = subprocess.run(sbatch_command, check=True, capture_output=True, text=True).stdout
+        job_id = output.strip().split(";")[0]
+        logger.info(f"Job array {name} of {len(indices)} tasks submitted with ID {job_id}")
+        return job_id
+
+    def _get_states(self, job_id: str) -> dict:
+        command = [os.path.join(self.slurm_bin_dir, "sacct"), "-j", job_id,
+                   "-X", "-n", "-P", "--format", "JobID,State"]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        states = {}
+        for line in output.splitlines():
+            if "|" not in line:
+                continue
+            task_id, state = line.split("|")[:2]
+            index = task_id.split("_")[-1]
+            # pending tasks are reported together, e.g. 1234_[5-10%4]
+            if index.isdigit():
+                states[int(index)] = state.split(" ")[0]
+        return states
+
+    def wait(self, job_id: str, indices: list) -> dict:
+        pending = set(indices)
+        states = {}
+        while len(pending) > 0:
+            for index, state in self._get_states(job_id).items():
+                if index in pending and state in SlurmBackend.TERMINAL_STATES:
+                    pending.remove(index)
+                    states[index] = state if state in (COMPLETED, CANCELLED) else FAILED
+            if len(pending) > 0:
+                logger.info(f"Job array {job_id}: {len(pending)} tasks are still pending or running...")
+                time.sleep(self.poll_interval)
+        return states
+
+
+class LocalArrayBackend:
+    """
+    Backend running array tasks as local processes, with the same interface as SlurmArrayBackend: at most
+    max_workers tasks (or throttle if lower) run at the same time
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self.max_workers = max_workers
+        self._runs = {}
+        self._nb_submitted = 0
+
+    @staticmethod
+    def _run(command: list, index: int, log_filepath: str) -> str:
+        with open(log_filepath, "w") as log_file:
+            returncode = subprocess.run(command + [str(index)], stdout=log_file, stderr=subprocess.STDOUT).returncode
+        return COMPLETED if returncode == 0 else FAILED
+
+    def submit(self, name: str, command: list, indices: list, log_filepath: str, throttle: int = None) -> str:
+        self._nb_submitted += 1
+        job_id = f"{name}-{self._nb_submitted}"
+        max_workers = self.max_workers if throttle is None else min(self.max_workers, throttle)
+        os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        futures = {index: executor.submit(self._run, command, index,
+                                          log_filepath.replace("{index}", str(index)).replace("{job_id}", job_id))
+                   for index in indices}
+        executor.shutdown(wait=False)
+        self._runs[job_id] = futures
+        logger.info(f"Job array {name} of {len(indices)} tasks started locally as {job_id}")
+        return job_id
+
+    def wait(self, job_id: str, indices: list) -> dict:
+        futures = self._runs.pop(job_id)
+        return {index: futures[index].result() for index in indices}
+
+
+def run_array(backend, name: str, command: list, nb_tasks: int, log_filepath: str, throttle: int = None,
+              max_retries: int = 1) -> dict:
+    """
+    This function runs the tasks 1 to nb_tasks of a job array and resubmits the failed ones, as a new job
+    array of the failed indices only, at most max_retries times
+
+    Args:
+        backend            : SlurmArrayBackend or LocalArrayBackend
+        name         (str) : name of the job array
+        command      (list): command line of the tasks, the task index is appended to it
+        nb_tasks     (int) : number of tasks
+        log_filepath (str) : path to the log file of the tasks, where {job_id} and {index} are replaced
+        throttle     (int) : maximum number of tasks running at a time, None for no limit
+        max_retries  (int) : maximum number of resubmissions of the failed tasks
+
+    Returns:
+        dict: final state of the tasks by index
+    """
+    indices = list(range(1, nb_tasks + 1))
+    states = {}
+    for attempt in range(max_retries + 1):
+        job_id = backend.submit(name, command, indices, log_filepath, throttle)
+        states.update(backend.wait(job_id, indices))
+        # cancelled tasks were cancelled on purpose, they are not resubmitted
+        indices = [index for index in indices if states[index] == FAILED]
+        if len(indices) == 0:
+            break
+        if attempt < max_retries:
+            logger.warning(f"{len(indices)} tasks of the job array {name} failed, resubmitting them: {indices}")
+    return states
+
+
+def run_production_from_manifest(config: dict, config_filepath: str, manifest_filepath: str, array_backend,
+                                 backend, throttle: int = None, max_retries: int = 1, chain_length: int = 1) -> int:
+    """
+    This function runs all FLEXPART simulations of a job manifest written by actris.py plan as a single job
+    array, then SOFT-io and footprints for each station and date whose simulations all succeeded, and records
+    the states in the log catalogue
+
+    Args:
+        config            (dict): production configuration
+        config_filepath   (str) : path to the production configuration file, given to the array tasks
+        manifest_filepath (str) : path to the job manifest
+        array_backend           : SlurmArrayBackend or LocalArrayBackend running the FLEXPART simulations
+        backend                 : SlurmBackend or LocalBackend running the SOFT-io and footprints steps
+        throttle          (int) : maximum number of FLEXPART simulations running at a time
+        max_retries       (int) : maximum number of resubmissions of the failed simulations
+        chain_length      (int) : number of consecutive simulations run one after the other by an array task
+
+    Returns:
+        int: 0 if all tasks completed, 1 otherwise
+    """
+    paths_config = read_config_file(config["PATHS_CONF_FILEPATH"])
+    entries = read_manifest(manifest_filepath)
+    if len(entries) == 0:
+        logger.warning(f"No simulation in the job manifest {manifest_filepath}")
+        return 0
+    # SOFT-IO and footprints (actris-processing.sh) look for the FLEXPART outputs in FLEXPART_OUT_DIR
+    flexpart_out_dir = os.path.normpath(paths_config["FLEXPART_OUT_DIR"])
+    output_dirs = sorted(set(get_output_dir(entry) for entry in entries
+                             if os.path.normpath(get_output_dir(entry)) != flexpart_out_dir))
+    if len(output_dirs) > 0:
+        logger.error(f"FLEXPART outputs of the job manifest {manifest_filepath} are planned in {' '.join(output_dirs)}, "
+                     f"but FLEXPART_OUT_DIR of {config['PATHS_CONF_FILEPATH']} is {flexpart_out_dir}; "
+                     f"plan them again with actris.py plan --paths-conf {config['PATHS_CONF_FILEPATH']}")
+        return 1
+    chains = get_chains(entries, chain_length)
+    command = [sys.executable, os.path.abspath(__file__), "-c", os.path.abspath(config_filepath),
+               "-m", os.path.abspath(manifest_filepath), "--chain", str(chain_length), "--task-index"]
+    array_log_filepath = os.path.join(config["LOGS_DIR"], "arrays", "flexpart-{job_id}_{index}.out")
+    chain_states = run_array(array_backend, "flexpart-array", command, len(chains), array_log_filepath,
+                             throttle, max_retries)
+
+    # FLEXPART state of each station and date: completed if all of its simulations completed
+    flexpart_tasks = {}
+    flexpart_states = {}
+    for index, chain in enumerate(chains, start=1):
+        for entry in chain:
+            key = (entry.station_id, entry.simu_date)
+            if key not in flexpart_tasks or chain_states[index] != COMPLETED:
+                flexpart_tasks[key] = Task(STEP_FLEXPART, entry.station_id, entry.simu_date, [],
+                                           get_chain_log_filepath(config, chain, index))
+            if flexpart_states.get(key, COMPLETED) == COMPLETED:
+                flexpart_states[key] = chain_states[index]
+
+    processing_script = os.path.join(paths_config["SRC_DIR"], "actris-processing.sh")
+    tasks = []
+    for (station_id, simu_date), flexpart_task in flexpart_tasks.items():
+        write_to_catalogue(config["LOG_CATALOGUE_FILEPATH"], flexpart_task, flexpart_states[(station_id, simu_date)])
+        log_filepath = os.path.join(config["LOGS_DIR"], station_id, f"{station_id}-{simu_date}.out")
+        command = [processing_script, "-n", station_id, "-d", simu_date, "-c", config["PATHS_CONF_FILEPATH"]]
+        if flexpart_states[(station_id, simu_date)] != COMPLETED:
+            logger.warning(f"FLEXPART simulation {station_id} {simu_date} has failed, no SOFT-IO nor footprints processing were launched")
+            for step in (STEP_SOFTIO, STEP_FOOTPRINTS):
+                write_to_catalogue(config["LOG_CATALOGUE_FILEPATH"], Task(step, station_id, simu_date, [], log_filepath), CANCELLED)
+            continue
+        softio_task = Task(STEP_SOFTIO, station_id, simu_date, command + ["--softio"], log_filepath)
+        footprints_task = Task(STEP_FOOTPRINTS, station_id, simu_date, command + ["--footprints"], log_filepath)
+        tasks += [softio_task, footprints_task]
+    for task in tasks:
+        os.makedirs(os.path.dirname(task.log_filepath), exist_ok=True)
+        backend.submit(task)
+    states = backend.wait(tasks)
+    for task in tasks:
+        write_to_catalogue(config["LOG_CATALOGUE_FILEPATH"], task, states[task.name])
+
+    nb_not_completed = sum(state != COMPLETED for state in list(flexpart_states.values()) + list(states.values()))
+    if nb_not_completed > 0:
+        logger.warning(f"{nb_not_completed} tasks did not complete, check {config['LOG_CATALOGUE_FILEPATH']}")
+        return 1
+    return 0
+
+
+def write_to_catalogue(log_catalogue_filepath: str, task: Task, state: str) -> None:
+    """
+    This function appends the final state of a task to the log catalogue, in the same format as
+    actris-production.sh
+
+    Args:
+        log_catalogue_filepath (str) : path to the common log catalogue
+        task                   (Task): processed task
+        state                  (str) : final state of the task
+    """
+    processing_date = time.strftime('%d/%m/%Y %H:%M:%S %Z')
+    status = 0 if state == COMPLETED else 1
+    with open(log_catalogue_filepath, "a") as f:
+        f.write(f"{{'processing_date':'{processing_date}', 'station_id':'{task.station_id}', "
+                f"'simulation_date':'{task.simu_date}', 'log_filepath':'{task.log_filepath}', "
+                f"'processing_step':'{task.step}', 'status':{status}}}\n")
+
+
+def run_production(config: dict, simu_dates: list, backend) -> int:
+    """
+    This function plans the processing of all stations for all simulation dates, submits all tasks
+    to the backend, waits for them and records their states in the log catalogue
+
+    Args:
+        config     (dict): production configuration
+        simu_dates (list): simulation dates/hours in the format YYYYMMDDHH
+        backend          : SlurmBackend or LocalBackend
+
+    Returns:
+        int: 0 if all tasks completed, 1 otherwise
+    """
+    paths_config = read_config_file(config["PATHS_CONF_FILEPATH"])
+    station_ids = stations.load_stations(paths_config["STATIONS_CONF"]).short_names
+    tasks = []
+    for simu_date in simu_dates:
+        tasks += build_tasks(station_ids, simu_date, config, paths_config)
+    for task in tasks:
+        os.makedirs(os.path.dirname(task.log_filepath), exist_ok=True)
+        backend.submit(task)
+    logger.info(f"{len(tasks)} tasks have been submitted for {len(station_ids)} stations and {len(simu_dates)} dates")
+
+    states = backend.wait(tasks)
+    for task in tasks:
+        write_to_catalogue(config["LOG_CATALOGUE_FILEPATH"], task, states[task.name])
+    nb_not_completed = sum(state != COMPLETED for state in states.values())
+    if nb_not_completed > 0:
+        logger.warning(f"{nb_not_completed} tasks did not complete, check {config['LOG_CATALOGUE_FILEPATH']}")
+        return 1
+    return 0
+
+
+def get_default_simu_date(config: dict) -> str:
+    """
+    This function returns the simulation date of the regular production: DELAY_N_DAYS days before today,
+    at FLEXPART_HOUR
+
+    Args:
+        config (dict): production configuration
+
+    Returns:
+        str: simulation date/hour in the format YYYYMMDDHH
+    """
+    simu_day = datetime.date.today() - datetime.timedelta(days=int(config["DELAY_N_DAYS"]))
+    return f"{simu_day.strftime('%Y%m%d')}{config['FLEXPART_HOUR']}"
+
+
+if __name__ == '__main__':
+    """
+    Main function
+
+    Args:
+        -c / --conf    : path to the production configuration file (actris-production.conf)
+        -d / --dates   : path to the list of simulation dates/hours to process (YYYYMMDDHH, one per line)
+        -b / --backend : 'slurm' to submit tasks as Slurm jobs, 'local' to run them as local processes
+        -j / --jobs    : number of tasks running at the same time with the local backend
+        -m / --manifest: path to a job manifest written by actris.py plan; its FLEXPART simulations are run
+                         as a single job array, followed by SOFT-io and footprints
+        --throttle     : maximum number of FLEXPART simulations of the job array running at the same time
+        --retries      : maximum number of resubmissions of the failed FLEXPART simulations
+        --chain        : number of consecutive simulations of the job manifest run one after the other by an
+                         array task, so that they share the ECMWF files staged on the node
+        --task-index   : runs the simulations of the given chain of the job manifest (used by the array tasks)
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Production of FLEXPART, SOFT-io and footprints for all ACTRIS stations",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-c", "--conf", type=str, required=True, help="Path to the production configuration file")
+    parser.add_argument("-d", "--dates", type=str, help="Path to the list of simulation dates/hours to process")
+    parser.add_argument("-b", "--backend", type=str, choices=["slurm", "local"], default="slurm",
+                        help="Backend running the tasks (default: slurm)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of tasks running at the same time with the local backend")
+    parser.add_argument("-m", "--manifest", type=str, help="Path to a job manifest written by actris.py plan")
+    parser.add_argument("--throttle", type=int, help="Maximum number of FLEXPART simulations of the job array running at the same time")
+    parser.add_argument("--retries", type=int, default=1, help="Maximum number of resubmissions of the failed FLEXPART simulations (default: 1)")
+    parser.add_argument("--chain", type=int, default=1, help="Number of consecutive simulations of the job manifest run by an array task (default: 1)")
+    parser.add_argument("--task-index", type=int, help="Runs the simulations of the given chain of the job manifest")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.conf):
+        logger.error(f"Configuration file {args.conf} does not exist. Verify your argument and try again.")
+        sys.exit(1)
+    config = read_config_file(args.conf)
+    missing_vars = [var for var in MANDATORY_CONFIG_VARS if config.get(var, "") == ""]
+    if len(missing_vars) > 0:
+        logger.error(f"{', '.join(missing_vars)} arguments are mandatory, please verify your configuration file and try again.")
+        sys.exit(1)
+    if not os.path.isfile(config["PATHS_CONF_FILEPATH"]):
+        logger.error(f"Paths configuration file {config['PATHS_CONF_FILEPATH']} does not exist, please verify and try again.")
+        sys.exit(1)
+
+    if args.task_index is not None:
+        if args.manifest is None:
+            logger.error("--task-index requires a job manifest (-m)")
+            sys.exit(1)
+        chain = get_chains(read_manifest(args.manifest), args.chain)[args.task_index - 1]
+        for entry in chain:
+            logger.info(f"Running FLEXPART simulation {entry.station_id} {entry.simu_date} {entry.release} in {entry.working_dir}")
+        sys.exit(run_manifest_entries(chain, read_config_file(config["PATHS_CONF_FILEPATH"]),
+                                      get_chain_log_filepath(config, chain, args.task_index)))
+
+    if args.manifest is not None:
+        if args.backend == "slurm":
+            array_backend, backend = SlurmArrayBackend(), SlurmBackend()
+        else:
+            array_backend, backend = LocalArrayBackend(args.jobs), LocalBackend(args.jobs)
+        sys.exit(run_production_from_manifest(config, args.conf, args.manifest, array_backend, backend,
+                                              args.throttle, args.retries, args.chain))
+
+    if args.dates is not None:
+        logger.warning("List of simulation dates/hours was provided by the user, FLEXPART_HOUR and DELAY_N_DAYS from the configuration file will not be used.")
+        with open(args.dates) as f:
+            simu_dates = [line.strip() for line in f if line.strip() != ""]
+    else:
+        simu_dates = [get_default_simu_date(config)]
+    logger.info(f"Launching simulations for {', '.join(simu_dates)}")
+
+    backend = SlurmBackend() if args.backend == "slurm" else LocalBackend(args.jobs)
+    sys.exit(run_production(config, simu_dates, backend))
@@ -0,0 +1,40 @@
+import logging
+import os
+import sys
+
+import fpout
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - [%(levelname)s] %(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    """
+    Main function
+
+    Args:
+        -f / --file   : path to the FLEXPART output netCDF file of a multi-release simulation; its nested output,
+                        if any, is split as well
+        -o / --output : path to the directory where to store one FLEXPART output file per release
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Splitting a multi-release FLEXPART output into one file per release, named after the release",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--file", type=str, help="Path to the FLEXPART output netCDF file")
+    parser.add_argument("-o", "--output", type=str, help="Path to the directory where to store the per-release files")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        logger.error("Input FLEXPART file does not exist")
+        sys.exit(1)
+    logger.info(f"Splitting {args.file} by release")
+    for output_file in fpout.split_by_release(args.file, args.output):
+        logger.info(f"Release written to {output_file}")
+    nest_file = fpout.get_nest_url(args.file)
+    if os.path.exists(nest_file):
+        logger.info(f"Splitting the nested output {nest_file} by release")
+        for output_file in fpout.split_by_release(nest_file, args.output, suffix=fpout.regional.NEST_SUFFIX):
+            logger.info(f"Nested release written to {output_file}")
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import shlex
+import logging
+from decimal import Decimal
+from dataclasses import dataclass
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - [%(levelname)s] %(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+# Half width in degrees of the release box around the station
+RELEASE_BOX_HALF_WIDTH = Decimal("0.25")
+# Thickness in meters of the release layer above each release height
+RELEASE_LAYER_THICKNESS = 50
+
+# Keys of the regional and nested output grids of a station
+OUTGRID_KEYS = ("lon_min", "lon_max", "lat_min", "lat_max")
+
+_registries = {}
+
+
+def _get_grid(d: dict, key: str, grid_keys: tuple) -> dict:
+    if d.get(key) is None:
+        return None
+    missing = [grid_key for grid_key in grid_keys if grid_key not in d[key]]
+    if len(missing) > 0:
+        raise ValueError(f"{key} of station {d['short_name']} misses {' '.join(missing)}")
+    return {grid_key: Decimal(str(d[key][grid_key])) for grid_key in grid_keys}
+
+
+@dataclass(frozen=True)
+class Station:
+    """
+    An ACTRIS station of the JSON stations configuration file
+
+    Attributes:
+        short_name      (str)    : short ID name of the station, e.g. PUY
+        standard_name   (str)    : name of the station without spaces, used as name of the release zone
+        long_name       (str)    : full name of the station
+        longitude       (Decimal): longitude of the station, as written in the configuration file
+        latitude        (Decimal): latitude of the station, as written in the configuration file
+        altitude        (int)    : altitude of the station
+        release_heights (tuple)  : release heights (int) of the FLEXPART simulations
+        release_parts   (int)    : number of particles per release of the FLEXPART simulations, None for
+                                   the default of the processing chain
+        outgrid         (dict)   : regional output grid of the FLEXPART simulations, lon_min, lon_max, lat_min
+                                   and lat_max (Decimal), None for the global output grid
+        outgrid_nest    (dict)   : nested output grid of the FLEXPART simulations, lon_min, lon_max, lat_min,
+                                   lat_max and resolution (Decimal), None for no nested output
+    """
+    short_name: str
+    standard_name: str
+    long_name: str
+    longitude: Decimal
+    latitude: Decimal
+    altitude: int
+    release_heights: tuple
+    release_parts: int = None
+    outgrid: dict = None
+    outgrid_nest: dict = None
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Station":
+        return cls(short_name=d["short_name"],
+                   standard_name=d["standard_name"],
+                   long_name=d["long_name"],
+                   longitude=Decimal(str(d["longitude"])),
+                   latitude=Decimal(str(d["latitude"])),
+                   altitude=int(d["altitude"]),
+                   release_heights=tuple(int(h) for h in str(d["release_heights"]).split()),
+                   release_parts=int(d["release_parts"]) if d.get("release_parts") is not None else None,
+                   outgrid=_get_grid(d, "outgrid", OUTGRID_KEYS),
+                   outgrid_nest=_get_grid(d, "outgrid_nest", OUTGRID_KEYS + ("resolution",)))
+
+    def get_release_box(self) -> dict:
+        """
+        Returns the release box of the station: +/- RELEASE_BOX_HALF_WIDTH degrees around it
+
+        Returns:
+            dict: lat_min, lat_max, lon_min and lon_max (Decimal)
+        """
+        return {"lat_min": self.latitude - RELEASE_BOX_HALF_WIDTH,
+                "lat_max": self.latitude + RELEASE_BOX_HALF_WIDTH,
+                "lon_min": self.longitude - RELEASE_BOX_HALF_WIDTH,
+                "lon_max": self.longitude + RELEASE_BOX_HALF_WIDTH}
+
+    def get_release_layers(self) -> list:
+        """
+        Returns the release layers of the station: from each release height to RELEASE_LAYER_THICKNESS above
+
+        Returns:
+            list: (altitude_min, altitude_max) tuples
+        """
+        return [(h, h + RELEASE_LAYER_THICKNESS) for h in self.release_heights]
+
+    def to_shell(self) -> str:
+        """
+        Returns shell variable assignments describing the station, as used by actris-processing.sh
+
+        Returns:
+            str: one assignment per line
+        """
+        release_box = self.get_release_box()
+        shell_vars = {"_station_id": self.short_name,
+                      "_station_name": self.standard_name,
+                      "_station_lat": self.latitude,
+                      "_station_lon": self.longitude,
+                      "_station_coords": f"{self.latitude} {self.longitude}",
+                      "_station_alts": " ".join(str(h) for h in self.release_heights),
+                      "_station_parts": self.release_parts if self.release_parts is not None else "",
+                      "_release_lat_min": release_box["lat_min"],
+                      "_release_lat_max": release_box["lat_max"],
+                      "_release_lon_min": release_box["lon_min"],
+                      "_release_lon_max": release_box["lon_max"]}
+        for key in OUTGRID_KEYS:
+            shell_vars[f"_outgrid_{key}"] = self.outgrid[key] if self.outgrid is not None else ""
+        for key in OUTGRID_KEYS + ("resolution",):
+            shell_vars[f"_outgrid_nest_{key}"] = self.outgrid_nest[key] if self.outgrid_nest is not None else ""
+        return "\n".join(f"{name}={shlex.quote(str(value))}" for name, value in shell_vars.items())
+
+
+class StationRegistry:
+    """
+    Stations of a JSON stations configuration file, indexed by short name
+    """
+
+    def __init__(self, stations: list):
+        self._stations = {}
+        for station in stations:
+            if station.short_name in self._stations:
+                raise ValueError(f"station {station.short_name} is defined twice")
+            self._stations[station.short_name] = station
+
+    @classmethod
+    def from_file(cls, stations_conf: str) -> "StationRegistry":
+        with open(stations_conf) as f:
+            # floats are kept as written, so that release boxes are computed without rounding errors
+            return cls([Station.from_dict(d) for d in json.load(f, parse_float=Decimal)])
+
+    def __getitem__(self, short_name: str) -> Station:
+        return self._stations[short_name]
+
+    def __contains__(self, short_name: str) -> bool:
+        return short_name in self._stations
+
+    def __iter__(self):
+        return iter(self._stations.values())
+
+    def __len__(self) -> int:
+        return len(self._stations)
+
+    @property
+    def short_names(self) -> list:
+        return list(self._stations)
+
+
+def load_stations(stations_conf: str) -> StationRegistry:
+    """
+    This function loads the stations of a JSON stations configuration file; the file is parsed once
+    per process, unless it has been modified since
+
+    Args:
+        stations_conf (str): path to the JSON stations configuration file
+
+    Returns:
+        StationRegistry: stations indexed by short name
+    """
+    key = os.path.abspath(stations_conf)
+    mtime = os.path.getmtime(key)
+    if key not in _registries or _registries[key][0] != mtime:
+        _registries[key] = (mtime, StationRegistry.from_file(key))
+    return _registries[key][1]
+
+
+if __name__ == '__main__':
+    """
+    Main function
+
+    Args:
+        -c / --conf : path to the JSON stations configuration file
+        action      : 'ids' prints short names of the stations, one per line
+                      'check' exits with status 1 if the station does not exist
+                      'shell' prints shell variables describing the station (see Station.to_shell)
+        station     : short name of the station (for 'check' and 'shell')
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Registry of the ACTRIS stations",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-c", "--conf", type=str, required=True, help="Path to the JSON stations configuration file")
+    parser.add_argument("action", type=str, choices=["ids", "check", "shell"],
+                        help="ids   : print short names of the stations\n"
+                             "check : exit with status 1 if the station does not exist\n"
+                             "shell : print shell variables describing the station")
+    parser.add_argument("station", type=str, nargs="?", help="Short name of the station")
+    args = parser.parse_args()
+
+    registry = load_stations(args.conf)
+    if args.action == "ids":
+        print("\n".join(registry.short_names))
+        sys.exit(0)
+    if args.station is None:
+        logger.error(f"The short name of the station is mandatory for the action {args.action}")
+        sys.exit(1)
+    if args.station not in registry:
+        sys.exit(1)
+    if args.action == "shell":
+        print(registry[args.station].to_shell())
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+# the scripts of the repository and its local packages are imported without being installed
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, 'common'), os.path.join(ROOT_DIR, 'xarray_extras'),
+             os.path.join(ROOT_DIR, 'fpout')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
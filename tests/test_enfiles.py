@@ -0,0 +1,58 @@
+import json
+import subprocess
+import sys
+
+from common.enfiles import ENFilesStagingCache
+
+
+FILE_SIZE = 100
+
+
+def make_pool(tmp_path, filenames):
+    pool_dir = tmp_path / 'pool'
+    pool_dir.mkdir()
+    for filename in filenames:
+        (pool_dir / filename).write_bytes(b'\0' * FILE_SIZE)
+    return str(pool_dir)
+
+
+def get_staged(cache_dir):
+    return sorted(p.name for p in cache_dir.iterdir() if p.name.startswith('EN'))
+
+
+def test_shared_files_stay_staged_until_released_by_all_holders(tmp_path):
+    pool_dir = make_pool(tmp_path, ['EN24010100', 'EN24010103', 'EN24010106'])
+    cache_dir = tmp_path / 'cache'
+    cache = ENFilesStagingCache(cache_dir, max_size=2 * FILE_SIZE)
+    cache.acquire('wdir-1', pool_dir, ['EN24010100', 'EN24010103'])
+    cache.acquire('wdir-2', pool_dir, ['EN24010103', 'EN24010106'])
+    # the cache is too large, but all of its files are held
+    assert get_staged(cache_dir) == ['EN24010100', 'EN24010103', 'EN24010106']
+
+    cache.release('wdir-1')
+    # EN24010103 is still held by wdir-2
+    assert get_staged(cache_dir) == ['EN24010103', 'EN24010106']
+
+    cache.release('wdir-2')
+    assert len(get_staged(cache_dir)) == 2
+
+
+def test_files_of_dead_holder_are_evicted(tmp_path):
+    pool_dir = make_pool(tmp_path, ['EN24010100', 'EN24010103', 'EN24010106'])
+    cache_dir = tmp_path / 'cache'
+    cache = ENFilesStagingCache(cache_dir, max_size=2 * FILE_SIZE)
+    cache.acquire('wdir-killed', pool_dir, ['EN24010100', 'EN24010103'])
+
+    # the holder is killed without releasing its files
+    dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead_process.wait()
+    state_url = cache_dir / ENFilesStagingCache.STATE_FILENAME
+    state = json.loads(state_url.read_text())
+    for info in state['files'].values():
+        info['holders'] = {holder: dead_process.pid for holder in info['holders']}
+    state_url.write_text(json.dumps(state))
+
+    cache.acquire('wdir-2', pool_dir, ['EN24010103', 'EN24010106'])
+    assert get_staged(cache_dir) == ['EN24010103', 'EN24010106']
+    state = json.loads(state_url.read_text())
+    assert all(list(info['holders']) == ['wdir-2'] for info in state['files'].values())
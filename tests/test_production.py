@@ -0,0 +1,113 @@
+import os
+import sys
+
+import production
+
+
+# array task failing at its first attempt for the indices given after the state directory, and always for
+# the negated ones; each attempt is recorded in <state directory>/runs-<index>
+TASK_SCRIPT = """
+import os
+import sys
+state_dir, failing, index = sys.argv[1], [int(i) for i in sys.argv[2].split(",") if i != ""], int(sys.argv[3])
+runs_url = os.path.join(state_dir, f"runs-{index}")
+nb_runs = int(open(runs_url).read()) if os.path.exists(runs_url) else 0
+with open(runs_url, "w") as f:
+    f.write(str(nb_runs + 1))
+sys.exit(1 if -index in failing or (index in failing and nb_runs == 0) else 0)
+"""
+
+
+class RecordingBackend(production.LocalArrayBackend):
+    def __init__(self, max_workers=1):
+        super().__init__(max_workers)
+        self.submitted_indices = []
+
+    def submit(self, name, command, indices, log_filepath, throttle=None):
+        self.submitted_indices.append(list(indices))
+        return super().submit(name, command, indices, log_filepath, throttle)
+
+
+def get_command(tmp_path, failing):
+    script_url = tmp_path / "task.py"
+    script_url.write_text(TASK_SCRIPT)
+    return [sys.executable, str(script_url), str(tmp_path), ",".join(str(i) for i in failing)]
+
+
+def get_nb_runs(tmp_path, index):
+    runs_url = tmp_path / f"runs-{index}"
+    return int(runs_url.read_text()) if runs_url.exists() else 0
+
+
+def test_run_array_resubmits_failed_indices_only(tmp_path):
+    backend = RecordingBackend(max_workers=2)
+    log_filepath = str(tmp_path / "logs" / "array-{job_id}_{index}.out")
+    states = production.run_array(backend, "test", get_command(tmp_path, [2, 4]), 5, log_filepath, max_retries=2)
+    assert states == {index: production.COMPLETED for index in range(1, 6)}
+    assert backend.submitted_indices == [[1, 2, 3, 4, 5], [2, 4]]
+    assert [get_nb_runs(tmp_path, index) for index in range(1, 6)] == [1, 2, 1, 2, 1]
+
+
+def test_run_array_gives_up_after_max_retries(tmp_path):
+    backend = RecordingBackend()
+    log_filepath = str(tmp_path / "logs" / "array-{job_id}_{index}.out")
+    states = production.run_array(backend, "test", get_command(tmp_path, [-3]), 3, log_filepath, max_retries=1)
+    assert states == {1: production.COMPLETED, 2: production.COMPLETED, 3: production.FAILED}
+    assert backend.submitted_indices == [[1, 2, 3], [3]]
+    assert get_nb_runs(tmp_path, 3) == 2
+
+
+def test_get_chains():
+    chains = production.get_chains(list(range(7)), 3)
+    assert chains == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_run_manifest_entries_keeps_marked_simulations_only(tmp_path, monkeypatch):
+    entries = []
+    for release in ("500", "1500"):
+        working_dir = tmp_path / f"wdir-{release}"
+        (working_dir / "output").mkdir(parents=True)
+        config_filepath = working_dir / "actris-config.json"
+        config_filepath.write_text('{"output_profile": "full"}')
+        entries.append(production.ManifestEntry("PUY", "2024010100", release, str(working_dir), str(config_filepath),
+                                                str(tmp_path / "out" / f"PUY-2024010100-{release}.nc")))
+    # marker of a previous attempt
+    (tmp_path / "wdir-1500" / production.COMPLETED_MARKER_FILENAME).write_text("")
+
+    def run_singularity(paths_config, binds, env_name, args, log_file):
+        # both runs write an output, the second one crashes without marker
+        for entry in entries:
+            with open(os.path.join(entry.working_dir, "output", "grid_time_20240101000000.nc"), "w") as f:
+                f.write("")
+        with open(os.path.join(entries[0].working_dir, production.COMPLETED_MARKER_FILENAME), "w") as f:
+            f.write("")
+        return 1
+
+    monkeypatch.setattr(production, "run_singularity", run_singularity)
+    status = production.run_manifest_entries(entries, {"DATA_DIR": "", "ROOT_WDIR": ""}, str(tmp_path / "logs" / "chain.out"))
+    assert status == 1
+    assert os.listdir(tmp_path / "out") == ["PUY-2024010100-500.nc"]
+    assert os.path.exists(tmp_path / "wdir-1500" / "output" / "grid_time_20240101000000.nc")
+
+
+def test_build_tasks_runs_softio_concurrently():
+    config = {"LOGS_DIR": "/logs", "PATHS_CONF_FILEPATH": "/actris-processing.conf"}
+    tasks = production.build_tasks(["PUY", "SAC"], "2024010100", config, {"SRC_DIR": "/src"})
+    flexpart_tasks = {task.station_id: task for task in tasks if task.step == production.STEP_FLEXPART}
+    softio_tasks = [task for task in tasks if task.step == production.STEP_SOFTIO]
+    assert len(softio_tasks) == 2
+    for task in softio_tasks:
+        assert task.dependencies == [(flexpart_tasks[task.station_id], production.AFTER_OK)]
+
+
+def test_run_production_from_manifest_checks_output_dir(tmp_path):
+    paths_conf_filepath = tmp_path / "actris-processing.conf"
+    paths_conf_filepath.write_text('FLEXPART_OUT_DIR="/data/FLEX_OUTPUT"\nSRC_DIR="/src"\n')
+    manifest_filepath = tmp_path / "manifest.txt"
+    manifest_filepath.write_text("# station_id simu_date release working_dir config_filepath output\n"
+                                 "PUY 2024010100 500 /wdir/PUY/wdir-2024010100-500 /wdir/PUY/wdir-2024010100-500/actris-config.json "
+                                 "/other/FLEX_OUTPUT/PUY-2024010100-20231222-500.nc\n")
+    config = {"PATHS_CONF_FILEPATH": str(paths_conf_filepath), "LOGS_DIR": str(tmp_path / "logs")}
+    # no job array is submitted: the backends are not used
+    assert production.run_production_from_manifest(config, str(tmp_path / "actris-production.conf"),
+                                                    str(manifest_filepath), None, None) == 1
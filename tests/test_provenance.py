@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from common import provenance
+from common.provenance import ProvenanceLedger
+
+
+STEP = 'softio'
+KEY = 'PUY-2024010100-500'
+CODE_VERSION = 'abcdef012345'
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    input_url = tmp_path / 'PUY-2024010100-500.nc'
+    input_url.write_bytes(b'flexpart output')
+    output_url = tmp_path / 'softio-PUY-2024010100-500.nc'
+    output_url.write_bytes(b'softio output')
+    ledger = ProvenanceLedger(str(tmp_path / 'ledger.jsonl'))
+    ledger.record(STEP, KEY, str(input_url), CODE_VERSION, str(output_url), {'inventories': ['gfas']})
+    return ledger, input_url, output_url
+
+
+def is_done(ledger, input_url, output_url, code_version=CODE_VERSION, params=None):
+    params = params if params is not None else {'inventories': ['gfas']}
+    return ledger.is_done(STEP, KEY, str(input_url), code_version, params, str(output_url))
+
+
+def touch(url):
+    st = os.stat(url)
+    os.utime(url, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_is_done(recorded):
+    ledger, input_url, output_url = recorded
+    assert is_done(ledger, input_url, output_url)
+    assert not is_done(ledger, input_url, output_url, code_version='012345abcdef')
+    assert not is_done(ledger, input_url, output_url, params={'inventories': ['ceds2', 'gfas']})
+    os.remove(output_url)
+    assert not is_done(ledger, input_url, output_url)
+
+
+def test_is_done_after_touch(recorded, monkeypatch):
+    ledger, input_url, output_url = recorded
+    touch(input_url)
+    assert is_done(ledger, input_url, output_url)
+    # the new modification time is recorded, so that the input is not hashed again
+    assert ledger.get_record(STEP, KEY)['input_mtime_ns'] == os.stat(input_url).st_mtime_ns
+
+    def get_file_sha256(url):
+        raise AssertionError(f'{url} is hashed again')
+    monkeypatch.setattr(provenance, 'get_file_sha256', get_file_sha256)
+    assert is_done(ledger, input_url, output_url)
+
+
+def test_is_not_done_after_content_change(recorded):
+    ledger, input_url, output_url = recorded
+    # same size, new content and modification time
+    input_url.write_bytes(b'FLEXPART OUTPUT')
+    touch(input_url)
+    assert not is_done(ledger, input_url, output_url)
+    input_url.write_bytes(b'longer flexpart output')
+    assert not is_done(ledger, input_url, output_url)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import xarray_extras
+
+
+def make_grid(lon, lat, value=1.):
+    return xr.DataArray(np.full((len(lat), len(lon)), value), dims=('latitude', 'longitude'),
+                        coords={'latitude': lat, 'longitude': lon})
+
+
+def get_cell_centers(start, stop, step):
+    return np.arange(start + step / 2, stop, step)
+
+
+def test_regrid_sum_and_empty_target_cells():
+    source = make_grid(get_cell_centers(0, 2, 0.5), get_cell_centers(0, 2, 0.5))
+    target = make_grid(get_cell_centers(0, 3, 1.), get_cell_centers(0, 2, 1.))
+    regridded = xarray_extras.RegridWeights.from_grids(source, target, method='sum').regrid(source)
+    np.testing.assert_array_equal(regridded.values, [[4., 4., np.nan], [4., 4., np.nan]])
+
+
+def test_check_alignment():
+    source = make_grid(get_cell_centers(-180, 180, 0.05), get_cell_centers(-90, 90, 0.05))
+    aligned = make_grid(get_cell_centers(-180, 180, 1.), get_cell_centers(-90, 90, 1.))
+    xarray_extras.RegridWeights.from_grids(source, aligned, check_alignment=True)
+    # the cells centred on the poles are half out of the source cells
+    pole_centred = make_grid(get_cell_centers(-180, 180, 1.), np.arange(-90., 91., 1.))
+    with pytest.raises(ValueError):
+        xarray_extras.RegridWeights.from_grids(source, pole_centred, check_alignment=True)
+    shifted = make_grid(get_cell_centers(-180, 180, 1.) + 0.02, get_cell_centers(-90, 90, 1.))
+    with pytest.raises(ValueError):
+        xarray_extras.RegridWeights.from_grids(source, shifted, check_alignment=True)
+    with pytest.raises(ValueError):
+        xarray_extras.RegridWeights.from_grids(source, make_grid(get_cell_centers(-180, 180, 1.),
+                                                                 get_cell_centers(-90, 90, 0.12)),
+                                               check_alignment=True)
@@ -0,0 +1,57 @@
+import numpy as np
+import xarray as xr
+
+import xarray_extras
+
+
+APPEND_DIMS = ['station_id', 'time']
+
+
+def make_dataset(station_ids, times, value):
+    data = np.full((len(station_ids), len(times)), value, dtype='f4')
+    return xr.Dataset({'res_time': (('station_id', 'time'), data)},
+                      coords={'station_id': station_ids, 'time': np.array(times, dtype='M8[ns]')})
+
+
+def test_created(tmp_path):
+    url = str(tmp_path / 'store.zarr')
+    ds = make_dataset(['PUY', 'SAC'], ['2024-01-01', '2024-01-02'], 1.)
+    assert xarray_extras.update_zarr_store(ds, url, APPEND_DIMS) == xarray_extras.STORE_CREATED
+    xr.testing.assert_identical(xr.open_zarr(url).load(), ds)
+
+
+def test_updated_with_trailing_label(tmp_path):
+    url = str(tmp_path / 'store.zarr')
+    xarray_extras.update_zarr_store(make_dataset(['PUY', 'SAC'], ['2024-01-01', '2024-01-02'], 1.), url, APPEND_DIMS)
+    ds = make_dataset(['PUY'], ['2024-01-03'], 2.)
+    assert xarray_extras.update_zarr_store(ds, url, APPEND_DIMS) == xarray_extras.STORE_UPDATED
+    store_ds = xr.open_zarr(url).load()
+    assert list(store_ds.indexes['time']) == list(np.array(['2024-01-01', '2024-01-02', '2024-01-03'], dtype='M8[ns]'))
+    res_time = store_ds['res_time']
+    np.testing.assert_array_equal(res_time.sel(time=['2024-01-01', '2024-01-02']), 1.)
+    assert float(res_time.sel(station_id='PUY', time='2024-01-03')) == 2.
+    # the new time is not filled for the stations which are not in ds
+    assert np.isnan(float(res_time.sel(station_id='SAC', time='2024-01-03')))
+
+
+def test_rewritten_with_label_before_existing_ones(tmp_path):
+    url = str(tmp_path / 'store.zarr')
+    xarray_extras.update_zarr_store(make_dataset(['PUY'], ['2024-01-02', '2024-01-03'], 1.), url, APPEND_DIMS)
+    ds = make_dataset(['PUY'], ['2024-01-01'], 2.)
+    assert xarray_extras.update_zarr_store(ds, url, APPEND_DIMS) == xarray_extras.STORE_REWRITTEN
+    res_time = xr.open_zarr(url)['res_time'].sel(station_id='PUY').load()
+    assert list(res_time.indexes['time']) == list(np.array(['2024-01-01', '2024-01-02', '2024-01-03'], dtype='M8[ns]'))
+    np.testing.assert_array_equal(res_time.values, [2., 1., 1.])
+    assert not (tmp_path / 'store.zarr.tmp').exists() and not (tmp_path / 'store.zarr.bak').exists()
+
+
+def test_updated_in_partial_region(tmp_path):
+    url = str(tmp_path / 'store.zarr')
+    xarray_extras.update_zarr_store(make_dataset(['PUY', 'SAC'], ['2024-01-01', '2024-01-02', '2024-01-03'], 1.),
+                                    url, APPEND_DIMS)
+    # ds covers the first and last times of one station: its region also spans the time in between
+    ds = make_dataset(['SAC'], ['2024-01-01', '2024-01-03'], 2.)
+    assert xarray_extras.update_zarr_store(ds, url, APPEND_DIMS) == xarray_extras.STORE_UPDATED
+    res_time = xr.open_zarr(url)['res_time'].load()
+    np.testing.assert_array_equal(res_time.sel(station_id='SAC').values, [2., 1., 2.])
+    np.testing.assert_array_equal(res_time.sel(station_id='PUY').values, [1., 1., 1.])
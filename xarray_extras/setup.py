@@ -16,5 +16,6 @@ setup(
         'pandas',
         'xarray>=0.19',
         'dask',
+        'scipy',
     ],
 )
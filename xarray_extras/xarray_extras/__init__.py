@@ -13,6 +13,17 @@ from .regrid import (
 
 from . import geo_regrid
 
+from .regrid_weights import (
+    RegridWeights,
+)
+
+from .zarr_store import (
+    STORE_CREATED,
+    STORE_UPDATED,
+    STORE_REWRITTEN,
+    update_zarr_store,
+)
+
 
 __all__ = [
     'get_dataset_dims_chunks_sizes_itemsize',
@@ -20,4 +31,6 @@ __all__ = [
     'open_dataset_with_disk_chunks',
     'concat_from_nested_dict',
     'is_coord_regularly_gridded',
+    'RegridWeights',
+    'update_zarr_store',
 ]
@@ -0,0 +1,178 @@
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+from .regrid import is_coord_regularly_gridded
+
+
+def _get_cell_indices(coord, target_coord, circular=False):
+    """
+    Returns the index in target_coord of the cell containing each coordinate of coord, or -1 for coordinates out of
+    the target cells; coordinates are centers of grid cells and target_coord must be regularly gridded
+    """
+    coord = np.asarray(coord, dtype='f8')
+    target_coord = np.asarray(target_coord, dtype='f8')
+    n = len(target_coord)
+    step = (target_coord[-1] - target_coord[0]) / (n - 1) if n > 1 else 1.
+    offsets = (coord - (target_coord[0] - step / 2)) / step
+    if circular:
+        offsets = offsets % (360. / abs(step))
+    indices = np.floor(offsets).astype('i8')
+    indices[(indices < 0) | (indices >= n)] = -1
+    return indices
+
+
+def _check_cells_alignment(label, coord, target_coord, circular=False):
+    """
+    Raises ValueError if the cells of target_coord are not made of whole cells of coord: the target step must be
+    a multiple of the source step, the target cell boundaries must be source cell boundaries and, unless the
+    coordinate is circular, the target cells must lie within the source cells; both coordinates are centers of
+    regularly gridded cells
+    """
+    coord = np.asarray(coord, dtype='f8')
+    target_coord = np.asarray(target_coord, dtype='f8')
+    if len(coord) < 2 or len(target_coord) < 2:
+        return
+    step = abs(coord[1] - coord[0])
+    target_step = abs(target_coord[1] - target_coord[0])
+    ratio = target_step / step
+    offset = ((target_coord.min() - target_step / 2) - (coord.min() - step / 2)) / step
+    if circular:
+        offset = offset % (360. / step)
+    eps = 1e-6
+    if abs(ratio - round(ratio)) > eps or round(ratio) < 1 or abs(offset - round(offset)) > eps:
+        raise ValueError(f'resolution of {label} not compatible: target cells of {target_step} centred on '
+                         f'{target_coord[0]} are not made of whole source cells of {step} centred on {coord[0]}')
+    if not circular and (target_coord.min() - target_step / 2 < coord.min() - step / 2 - eps * step or
+                         target_coord.max() + target_step / 2 > coord.max() + step / 2 + eps * step):
+        raise ValueError(f'target grid is not compatible with a source grid: cells of {label} from '
+                         f'{target_coord.min()} to {target_coord.max()} are out of the source cells')
+
+
+class RegridWeights:
+    """
+    Sparse regridding weights from a source longitude-latitude grid onto a coarser target grid. Each source cell
+    contributes to the target cell containing its center, with the weight of the source cell (e.g. its pixel area,
+    or 1), so that a field is regridded by a single sparse matrix product over its flattened latitude and longitude
+    dimensions. Source cells out of the target grid are ignored; longitudes are compared modulo 360.
+    Target cells containing no source cell are NaN.
+    """
+    def __init__(self, matrix, source_coords, target_coords, method='sum'):
+        """
+        :param matrix: scipy.sparse.csr_matrix of shape (number of target cells, number of source cells); cells are
+        flattened in (latitude, longitude) order
+        :param source_coords: dict; latitude and longitude labels of the source grid with their coordinates (in this order)
+        :param target_coords: dict; latitude and longitude labels of the target grid with their coordinates (in this order)
+        :param method: 'sum' or 'mean'; with 'sum', a target cell gets the weighted sum of the source cells it contains,
+        with 'mean' their weighted mean; NaN are skipped
+        """
+        if method not in ('sum', 'mean'):
+            raise ValueError(f"method must be 'sum' or 'mean'; got {method}")
+        self.matrix = matrix.tocsr()
+        self.source_coords = {label: np.asarray(coord) for label, coord in source_coords.items()}
+        self.target_coords = {label: np.asarray(coord) for label, coord in target_coords.items()}
+        self.method = method
+        self._weights_sum = np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    @classmethod
+    def from_grids(cls, source, target, cell_weights=None, method='sum', check_alignment=False):
+        """
+        Build the regridding weights from a source grid onto a target grid. The target grid must be regularly gridded
+        and each source cell is assigned to the target cell containing its center, so that the target grid should be
+        coarser than the source one, with aligned cells (as for xarray_extras regrid with coarsen).
+        :param source: xarray Dataset or DataArray with the longitude and latitude coordinates of the source grid
+        :param target: xarray Dataset or DataArray with the longitude and latitude coordinates of the target grid
+        :param cell_weights: xarray DataArray or array-like (latitude, longitude) on the source grid, optional;
+        weights of the source cells, e.g. pixel areas; default 1
+        :param method: 'sum' or 'mean'; default 'sum'
+        :param check_alignment: bool; if True, raise ValueError if the target cells are not made of whole source
+        cells (as xarray_extras regrid with coarsen does), instead of summing the source cells whose centers they
+        contain; default False
+        :return: RegridWeights
+        """
+        lon_label, lat_label = source.geo.get_lon_lat_label()
+        target_lon_label, target_lat_label = target.geo.get_lon_lat_label()
+        source_lon, source_lat = np.asarray(source[lon_label]), np.asarray(source[lat_label])
+        target_lon, target_lat = np.asarray(target[target_lon_label]), np.asarray(target[target_lat_label])
+        for label, coord in ((target_lon_label, target_lon), (target_lat_label, target_lat)):
+            if not is_coord_regularly_gridded(coord):
+                raise ValueError(f'target {label} is not regularly gridded: {coord}')
+
+        if check_alignment:
+            _check_cells_alignment(target_lon_label, source_lon, target_lon, circular=True)
+            _check_cells_alignment(target_lat_label, source_lat, target_lat)
+        lon_idx = _get_cell_indices(source_lon, target_lon, circular=True)
+        lat_idx = _get_cell_indices(source_lat, target_lat)
+        if cell_weights is None:
+            cell_weights = np.ones((len(source_lat), len(source_lon)), dtype='f8')
+        elif isinstance(cell_weights, xr.DataArray):
+            cell_weights = cell_weights.transpose(*cell_weights.geo.get_lon_lat_label()[::-1]).values
+        cell_weights = np.asarray(cell_weights, dtype='f8')
+        if cell_weights.shape != (len(source_lat), len(source_lon)):
+            raise ValueError(f'cell_weights must have the shape of the source grid {(len(source_lat), len(source_lon))}; '
+                             f'got {cell_weights.shape}')
+
+        # flattened source and target cells, in (latitude, longitude) order
+        rows = (lat_idx[:, np.newaxis] * len(target_lon) + lon_idx[np.newaxis, :]).ravel()
+        cols = np.arange(len(source_lat) * len(source_lon))
+        valid = ((lat_idx[:, np.newaxis] >= 0) & (lon_idx[np.newaxis, :] >= 0)).ravel()
+        matrix = scipy.sparse.csr_matrix((cell_weights.ravel()[valid], (rows[valid], cols[valid])),
+                                         shape=(len(target_lat) * len(target_lon), len(source_lat) * len(source_lon)))
+        return cls(matrix,
+                   {lat_label: source_lat, lon_label: source_lon},
+                   {target_lat_label: target_lat, target_lon_label: target_lon},
+                   method=method)
+
+    def _regrid_array(self, arr):
+        # arr has the source latitude and longitude as last dimensions
+        shape = arr.shape[:-2]
+        arr = arr.reshape((-1, arr.shape[-2] * arr.shape[-1])).T
+        nan_mask = np.isnan(arr) if np.issubdtype(arr.dtype, np.floating) else None
+        has_nan = nan_mask is not None and nan_mask.any()
+        regridded = self.matrix @ (np.where(nan_mask, 0., arr) if has_nan else arr.astype('f8'))
+        if self.method == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if has_nan:
+                    regridded = regridded / (self.matrix @ (~nan_mask).astype('f8'))
+                else:
+                    regridded = regridded / self._weights_sum[:, np.newaxis]
+        # target cells without source cells have no value
+        regridded[self._weights_sum == 0] = np.nan
+        target_lat, target_lon = self.target_coords.values()
+        return regridded.T.reshape(shape + (len(target_lat), len(target_lon)))
+
+    def _regrid_dataarray(self, da):
+        (lat_label, source_lat), (lon_label, source_lon) = self.source_coords.items()
+        for label, coord in ((lat_label, source_lat), (lon_label, source_lon)):
+            if da[label].shape != coord.shape or not np.allclose(da[label], coord):
+                raise ValueError(f'{label} coordinates of {da.name} are not the ones of the source grid')
+        target_lat, target_lon = self.target_coords.values()
+        regridded = xr.apply_ufunc(self._regrid_array, da,
+                                   input_core_dims=[[lat_label, lon_label]],
+                                   output_core_dims=[[lat_label, lon_label]],
+                                   exclude_dims={lat_label, lon_label},
+                                   dask='parallelized', output_dtypes=['f8'],
+                                   dask_gufunc_kwargs={'output_sizes': {lat_label: len(target_lat),
+                                                                        lon_label: len(target_lon)},
+                                                       'allow_rechunk': True},
+                                   keep_attrs=True)
+        target_labels = list(self.target_coords)
+        regridded = regridded.rename({lat_label: target_labels[0], lon_label: target_labels[1]})
+        return regridded.assign_coords(self.target_coords)
+
+    def regrid(self, obj):
+        """
+        Regrid a data array, or the data variables of a dataset, with longitude and latitude dimensions of the source
+        grid onto the target grid, as a single sparse matrix product; other dimensions (e.g. time or height) are kept.
+        Data variables of a dataset without longitude and latitude dimensions are kept as they are.
+        :param obj: xarray Dataset or DataArray; longitude and latitude coordinates must be the ones of the source grid
+        :return: same type as obj, in float64
+        """
+        source_labels = set(self.source_coords)
+        if isinstance(obj, xr.DataArray):
+            return self._regrid_dataarray(obj)
+        data_vars = {}
+        for v, da in obj.data_vars.items():
+            data_vars[v] = self._regrid_dataarray(da) if source_labels.issubset(da.dims) else da
+        return xr.Dataset(data_vars, attrs=obj.attrs)
+
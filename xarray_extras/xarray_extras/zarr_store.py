@@ -0,0 +1,151 @@
+import os
+import shutil
+import numpy as np
+import xarray as xr
+import dask.array
+
+
+STORE_CREATED = 'created'
+STORE_UPDATED = 'updated'
+STORE_REWRITTEN = 'rewritten'
+
+
+def _new_labels_by_dim(ds, store_ds, append_dims):
+    """
+    Returns a dict dim: new labels (pandas.Index) for the dimensions of ds which have labels not present in store_ds,
+    or None if the new labels cannot be appended at the end of the store's dimension
+    """
+    new_labels_by_dim = {}
+    for dim in append_dims:
+        if dim not in ds.dims:
+            continue
+        store_idx = store_ds.indexes[dim]
+        idx = ds.indexes[dim]
+        new_labels = idx[~idx.isin(store_idx)].sort_values()
+        if len(new_labels) == 0:
+            continue
+        if not store_idx.is_monotonic_increasing or (len(store_idx) > 0 and new_labels[0] <= store_idx[-1]):
+            return None
+        new_labels_by_dim[dim] = new_labels
+    return new_labels_by_dim
+
+
+def _has_same_layout(ds, store_ds, append_dims):
+    if set(ds.data_vars) != set(store_ds.data_vars) or set(ds.dims) != set(store_ds.dims):
+        return False
+    for v, da in ds.data_vars.items():
+        if set(da.dims) != set(store_ds[v].dims) or da.dtype != store_ds[v].dtype:
+            return False
+        if not np.issubdtype(da.dtype, np.floating):
+            return False
+    for dim in ds.dims:
+        if dim not in store_ds.dims or dim not in ds.indexes or dim not in store_ds.indexes:
+            return False
+        if dim not in append_dims and not ds.indexes[dim].equals(store_ds.indexes[dim]):
+            return False
+    # non-index coordinates cannot be extended in place
+    for coord in store_ds.coords:
+        if coord not in store_ds.dims and set(store_ds[coord].dims).intersection(append_dims):
+            return False
+    return True
+
+
+def _empty_slab(store_ds, dim, labels):
+    """
+    Returns a dataset with data variables of store_ds filled with NaN, with labels as coordinates along dim
+    and with the store's coordinates along other dimensions
+    """
+    coords = {d: store_ds.indexes[d] for d in store_ds.dims}
+    coords[dim] = labels
+    data_vars = {}
+    for v, da in store_ds.data_vars.items():
+        shape = tuple(len(coords[d]) for d in da.dims)
+        chunks = tuple(len(labels) if d == dim else da.chunks[i] for i, d in enumerate(da.dims)) \
+            if da.chunks is not None else 'auto'
+        data = dask.array.full(shape, np.nan, dtype=da.dtype, chunks=chunks)
+        data_vars[v] = (da.dims, data, da.attrs)
+    slab = xr.Dataset(data_vars=data_vars, coords={d: coords[d] for d in store_ds.dims})
+    for d in store_ds.dims:
+        slab[d].attrs = store_ds[d].attrs
+    return slab
+
+
+def _chunk_as_encoding(ds, encoding):
+    """
+    Re-chunk variables of ds according to zarr chunks given in encoding and drop encodings inherited from
+    the sources of ds, so that dask chunks do not overlap zarr chunks
+    """
+    for v in ds.variables:
+        ds[v].encoding = {}
+    if encoding is None:
+        return ds
+    for v, v_encoding in encoding.items():
+        v_chunks = v_encoding.get('chunks')
+        if v in ds.data_vars and v_chunks is not None:
+            v_dims = ds[v].dims
+            ds[v] = ds[v].chunk({d: (c if c not in (-1, None) else ds.sizes[d]) for d, c in zip(v_dims, v_chunks)})
+    return ds
+
+
+def _rewrite_zarr_store(ds, url, encoding=None):
+    tmp_url = f'{url}.tmp'
+    bak_url = f'{url}.bak'
+    if os.path.exists(tmp_url):
+        shutil.rmtree(tmp_url)
+    with xr.open_zarr(url) as store_ds:
+        output = _chunk_as_encoding(ds.combine_first(store_ds), encoding)
+        output.to_zarr(store=tmp_url, mode='w', encoding=encoding)
+    os.rename(url, bak_url)
+    os.rename(tmp_url, url)
+    shutil.rmtree(bak_url)
+
+
+def update_zarr_store(ds, url, append_dims, encoding=None):
+    """
+    Insert a dataset into a zarr store, indexed by append_dims. Dimensions in append_dims which get new labels
+    are extended in place (the labels must come after the store's labels along that dimension), and values of ds
+    are then written to the region of the store they cover, so that only chunks containing the new data are
+    written. Values of ds overwrite values already present in the store. If the layout of the store would change
+    otherwise (new labels inserted before existing ones, different variables or other coordinates), the store
+    is rewritten from scratch into a temporary store which then replaces the original one.
+
+    :param ds: xarray Dataset; its dimensions must have index coordinates
+    :param url: str; path to a zarr store; created if it does not exist
+    :param append_dims: iterable of str; dimensions along which ds can extend the store
+    :param encoding: dict, optional; encoding used when the store is created or rewritten
+    :return: str; STORE_CREATED, STORE_UPDATED or STORE_REWRITTEN
+    """
+    append_dims = list(append_dims)
+    if not os.path.exists(url):
+        ds.to_zarr(store=url, mode='w', encoding=encoding)
+        return STORE_CREATED
+
+    with xr.open_zarr(url) as store_ds:
+        new_labels_by_dim = None
+        if _has_same_layout(ds, store_ds, append_dims):
+            new_labels_by_dim = _new_labels_by_dim(ds, store_ds, append_dims)
+    if new_labels_by_dim is None:
+        _rewrite_zarr_store(ds, url, encoding=encoding)
+        return STORE_REWRITTEN
+
+    # extend dimensions with NaN slabs
+    for dim, labels in new_labels_by_dim.items():
+        with xr.open_zarr(url) as store_ds:
+            slab = _empty_slab(store_ds, dim, labels)
+            slab.to_zarr(store=url, append_dim=dim)
+
+    # write ds into the region of the store it covers
+    with xr.open_zarr(url) as store_ds:
+        region = {}
+        for dim in ds.dims:
+            positions = store_ds.indexes[dim].get_indexer(ds.indexes[dim])
+            region[dim] = slice(int(positions.min()), int(positions.max()) + 1)
+        block = store_ds[list(ds.data_vars)].isel(region)
+        if all(ds.sizes[dim] == block.sizes[dim] for dim in ds.dims):
+            data = ds.reindex({dim: block.indexes[dim] for dim in ds.dims})
+        else:
+            # ds does not fill the whole region: keep the values already in the store
+            data = ds.combine_first(block.load()).reindex({dim: block.indexes[dim] for dim in ds.dims})
+        data = xr.Dataset({v: data[v].transpose(*store_ds[v].dims) for v in ds.data_vars})
+    data.reset_coords(drop=True).drop_vars(list(data.indexes)).to_zarr(store=url, mode='r+', region=region)
+    return STORE_UPDATED